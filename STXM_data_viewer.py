@@ -1,16 +1,43 @@
+import csv
 import datetime
 import getopt
-import pickle
+import math
+import os
+import statistics
 import sys
-from PIL import Image, ImageOps
+import threading
+import time
 from PyQt5 import QtGui
 from PyQt5 import uic
-from PyQt5.QtCore import QRunnable, pyqtSignal, QObject, QThreadPool
-from PyQt5.QtWidgets import QFileDialog, QMainWindow, QApplication
-from pymongo import MongoClient
+from PyQt5.QtCore import QRunnable, pyqtSignal, QObject, QThreadPool, QEvent, QRect, QSize, Qt, QTimer
+from PyQt5.QtWidgets import QFileDialog, QInputDialog, QMainWindow, QApplication, QRubberBand
+import batch_export
+import bulk_writer
+import catalog
+import catalog_query
+import data_store
+import disk_cache
 import prepare_database
-
-USAGE = f"Usage: python {sys.argv[0]} [--help] | [-v] [--version] [-p] [--progress] [-d <dir>] [--directory <dir>]"
+import rendering
+import spectrum
+import watcher
+from contact_sheet import ContactSheet, ContactSheetModel
+from file_list_model import FileListModel
+import frame_cache
+import intensity
+import ingest_stats
+
+# number of frames read ahead on each side of the selected energy of a stack
+READ_AHEAD = 3
+# milliseconds live filtering waits after the last filter change before querying
+FILTER_DELAY = 300
+# export formats offered in the UI
+EXPORT_CHOICES = {"PNG images, one per frame": ["png"],
+                  "TIFF images, one per frame": ["tiff"],
+                  "NumPy arrays (.npy)": ["npy"],
+                  "NumPy arrays with energies (.npz)": ["npz"]}
+
+USAGE = f"Usage: python {sys.argv[0]} [--help] | [-v] [--version] [-p] [--progress] [-s] [--sync] [--hash] [-d <dir>] [--directory <dir>] [-w <n>] [--workers <n>] [-b <n>] [--batch-size <n>] [-m <mode>] [--storage <mode>] [-c <MB>] [--cache <MB>] [-k <MB>] [--disk-cache <MB>] [--cache-dir <dir>] [-u <uri>] [--uri <uri>]"
 VERSION = f"{sys.argv[0]} version 1.0"
 
 
@@ -18,6 +45,18 @@ class WorkerSignals(QObject):
     # define worker signals
     finished = pyqtSignal()
     progress = pyqtSignal(int)
+    result = pyqtSignal(object)
+
+
+class WatchSignals(QObject):
+    # new files that have finished being written, emitted from the watcher thread
+    ready = pyqtSignal(object)
+
+
+class ExportSignals(QObject):
+    # percent completion, then the number of files exported and the failures, emitted from the export thread
+    progress = pyqtSignal(int)
+    finished = pyqtSignal(object)
 
 
 class Worker(QRunnable):
@@ -31,7 +70,8 @@ class Worker(QRunnable):
         self.kwargs['progress_callback'] = self.signals.progress
 
     def run(self):
-        self.fn(*self.args, **self.kwargs)
+        result = self.fn(*self.args, **self.kwargs)
+        self.signals.result.emit(result)
         self.signals.finished.emit()
 
 
@@ -64,12 +104,42 @@ class UI(QMainWindow):
         self.emaxSB.setMaximum(9999)
         self.emaxSB.setMinimum(0)
 
+        self.peakMinSB.setMaximum(99999999)
+        self.peakMinSB.setMinimum(0)
+
+        self.peakMaxSB.setMaximum(99999999)
+        self.peakMaxSB.setMinimum(0)
+
         self.textBrowser.moveCursor(QtGui.QTextCursor.End)
 
         self.dirLE.setReadOnly(True)
 
         self.progressBar.hide()
 
+        self.contrastCB.addItems(rendering.CONTRAST_MODES.keys())
+
+        # edge length of the image label, which picks the pyramid level to load
+        self.displaySize = max(self.imgLBL.width(), self.imgLBL.height())
+
+        # file, entry and frame currently on display and how long recent frames took to render
+        self.currentName = ""
+        self.currentEntry = None
+        self.currentFrame = None
+        # whether the current frame is a stored 8 bit thumbnail or pyramid level rather than raw intensities
+        self.currentPreview = False
+        # frame of the current stack selected with the energy slider
+        self.stackIndex = 0
+        # embedded stack last decoded for its frames, so stepping through it decodes it once even without the disk
+        # cache, as a (file, entry id, modification time) key and array tuple. Left out of the frame cache, which
+        # only holds the frames read from it.
+        self.currentStack = None
+
+        # drag a rectangle over the image to get the spectrum of that region
+        self.rubberBand = QRubberBand(QRubberBand.Rectangle, self.imgLBL)
+        self.roiOrigin = None
+        self.imgLBL.installEventFilter(self)
+        self.renderTimes = []
+
         # clear filters
         self.scan_type = False
         self.start_date = False
@@ -79,19 +149,61 @@ class UI(QMainWindow):
         self.xrange = False
         self.yrange = False
         self.energy = False
+        self.peak = False
 
         # set up threadpool
         self.threadpool = QThreadPool()
 
-        # set up mongodb database
-        self.cluster = "mongodb://localhost:27017"
-        self.client = MongoClient(self.cluster)
-        self.db = self.client["STXM_data_viewer"]
-        self.collection = self.db["STXM_data"]
+        # watches the directory for new scans on its own thread, so it does not hold one of the threadpool's
+        self.watcher = None
+        self.watchSignals = WatchSignals()
+        self.watchSignals.ready.connect(self.ingest_new_files)
+
+        # exports run on their own thread too, the parsing and encoding being done by worker processes
+        self.exportCancelled = None
+        self.exportSignals = ExportSignals()
+        self.exportSignals.progress.connect(self.export_progress)
+        self.exportSignals.finished.connect(self.export_finished)
+
+        self.directory, self.trackP, self.workers, self.batch_size, self.storage, cache_bytes, disk_bytes, \
+            cache_dir, sync, use_hash, self.uri = self.parse(sys.argv[1:])
+
+        # decoded frames of recently displayed and prefetched files
+        self.frameCache = frame_cache.FrameCache(cache_bytes)
+
+        # decoded stacks of files viewed in this and earlier sessions, None when disabled or unusable
+        self.diskCache = None
+        if disk_bytes > 0:
+            try:
+                self.diskCache = disk_cache.DiskCache(cache_dir, disk_bytes)
+            except OSError as e:
+                print(f"Disk cache disabled: {e}")
+
+        # timings and throughput of the current database creation, filled in by the worker thread
+        self.ingestStats = ingest_stats.IngestStats()
+
+        # set up the catalog database, a MongoDB server or an embedded SQLite file
+        self.collection = catalog.open_catalog(self.uri)
+        catalog_query.ensure_indexes(self.collection)
+        # list files lazily, a page of names at a time fetched on the threadpool
+        self.fileModel = FileListModel(self, self.threadpool)
+        self.fileModel.failed.connect(self.filter_failed)
+        self.fileCB.setModel(self.fileModel)
+        # thumbnails of the listed files, loaded as the contact sheet shows them
+        self.sheetModel = ContactSheetModel(self.fileModel, self.threadpool, parent=self)
+        self.contactSheet = None
+
+        # live filtering waits for the filters to stop changing
+        self.filterTimer = QTimer(self)
+        self.filterTimer.setSingleShot(True)
+        self.filterTimer.setInterval(FILTER_DELAY)
+        self.filterTimer.timeout.connect(lambda: self.filter_data(live=True))
+
         # check if db is created at time of launch
         directory = ""
-        for item in self.collection.find({}):
-            self.fileCB.addItem(item["name"])
+        item = self.collection.find_one({}, {"directory": 1})
+        if item is not None:
+            self.fileModel.set_query(self.collection, {})
             directory = item["directory"]
 
         # database is already active
@@ -111,11 +223,28 @@ class UI(QMainWindow):
         # connect signals to slots
         self.submitBTN.clicked.connect(self.submit_database)
         self.clearBTN.clicked.connect(self.clear_selections)
-        self.filterBTN.clicked.connect(self.filter_data)
+        self.filterBTN.clicked.connect(lambda: self.filter_data())
         self.toolBTN.clicked.connect(self.select_directory)
         self.fileCB.activated.connect(lambda: self.display_hdf(self.fileCB.currentText()))
-
-        self.directory, self.trackP = self.parse(sys.argv[1:])
+        self.sheetBTN.clicked.connect(self.show_contact_sheet)
+        self.exportBTN.clicked.connect(self.export_files)
+        self.contrastCB.currentIndexChanged.connect(self.render_frame)
+        self.gammaSB.valueChanged.connect(self.render_frame)
+        self.energySL.valueChanged.connect(self.show_energy)
+        self.watchCB.toggled.connect(self.toggle_watch)
+        for spin_box in (self.xrangeSB, self.yrangeSB, self.xresSB, self.yresSB, self.eminSB, self.emaxSB,
+                         self.peakMinSB, self.peakMaxSB):
+            spin_box.valueChanged.connect(self.filters_changed)
+        self.startDT.dateTimeChanged.connect(self.filters_changed)
+        self.endDT.dateTimeChanged.connect(self.filters_changed)
+        self.scanCB.currentIndexChanged.connect(self.filters_changed)
+        self.liveCB.toggled.connect(self.filters_changed)
+        # copies are only looked for when updating incrementally
+        self.syncCB.toggled.connect(self.hashCB.setEnabled)
+
+        if sync:
+            self.syncCB.setChecked(True)
+        self.hashCB.setChecked(use_hash)
 
         if self.directory != "":
             self.submit_database()
@@ -124,8 +253,9 @@ class UI(QMainWindow):
         try:
             options, arguments = getopt.getopt(
                 args,
-                "vhpd:",
-                ["version", "help", "progress", "directory="])
+                "vhpsd:w:b:m:c:k:u:",
+                ["version", "help", "progress", "sync", "hash", "directory=", "workers=", "batch-size=", "storage=",
+                 "cache=", "disk-cache=", "cache-dir=", "uri="])
         except getopt.GetoptError as err:
             print(err)
             print(USAGE)
@@ -133,6 +263,15 @@ class UI(QMainWindow):
 
         directory = ""
         progress = False
+        workers = 1
+        batch_size = bulk_writer.BATCH_SIZE
+        storage = data_store.DEFAULT_STORAGE
+        cache_bytes = frame_cache.CACHE_BYTES
+        disk_bytes = disk_cache.DISK_CACHE_BYTES
+        cache_dir = None
+        sync = False
+        use_hash = False
+        uri = catalog.URI
         for o, a in options:
             if o in ("-v", "--version"):
                 print(VERSION)
@@ -142,16 +281,69 @@ class UI(QMainWindow):
                 sys.exit()
             if o in ("-p", "--progress"):
                 progress = True
+            if o in ("-s", "--sync"):
+                sync = True
+            if o == "--hash":
+                # incremental updates hash files to find copies, rather than only comparing size and mtime
+                use_hash = True
             if o in ("-d", "--directory"):
                 directory = a
+            if o in ("-w", "--workers"):
+                # number of processes reading files during database creation, 0 uses every core
+                try:
+                    workers = int(a)
+                except ValueError:
+                    print("Workers must be an integer")
+                    raise SystemExit(USAGE)
+                if workers <= 0:
+                    workers = os.cpu_count() or 1
+            if o in ("-b", "--batch-size"):
+                # number of entries written to the database at once
+                try:
+                    batch_size = int(a)
+                except ValueError:
+                    print("Batch size must be an integer")
+                    raise SystemExit(USAGE)
+            if o in ("-m", "--storage"):
+                # where pixel data is kept: in the entries, referenced in the source files, or in GridFS
+                if a not in data_store.STORAGE_MODES:
+                    print(f"Storage must be one of {', '.join(data_store.STORAGE_MODES)}")
+                    raise SystemExit(USAGE)
+                storage = a
+            if o in ("-c", "--cache"):
+                # memory budget of the decoded frame cache
+                try:
+                    cache_bytes = int(float(a) * 2 ** 20)
+                except ValueError:
+                    print("Cache size must be a number of megabytes")
+                    raise SystemExit(USAGE)
+            if o in ("-k", "--disk-cache"):
+                # disk budget of the decoded stacks kept between sessions, 0 turns the disk cache off
+                try:
+                    disk_bytes = int(float(a) * 2 ** 20)
+                except ValueError:
+                    print("Disk cache size must be a number of megabytes")
+                    raise SystemExit(USAGE)
+            if o == "--cache-dir":
+                cache_dir = a
+            if o in ("-u", "--uri"):
+                # mongodb://host:port for a MongoDB server, sqlite://path for an embedded catalog file
+                if not a.startswith(catalog.SCHEMES):
+                    print(f"Database URI must start with one of {', '.join(catalog.SCHEMES)}")
+                    raise SystemExit(USAGE)
+                uri = a
 
         if len(arguments) > 4:
             raise SystemExit(USAGE)
-        elif len(options) == 1 and progress:
+        elif progress and directory == "":
             print("Progress flag may not be used without -d option")
             raise SystemExit(USAGE)
+        elif use_hash and not sync:
+            print("Hash flag may not be used without -s option")
+            raise SystemExit(USAGE)
 
-        return directory, progress
+        return directory, progress, workers, batch_size, storage, cache_bytes, disk_bytes, cache_dir, sync, use_hash, \
+            uri
 
     def select_directory(self):
         '''
@@ -178,13 +370,20 @@ class UI(QMainWindow):
         self.yresSB.setValue(0)
         self.eminSB.setValue(0)
         self.emaxSB.setValue(0)
+        self.peakMinSB.setValue(0)
+        self.peakMaxSB.setValue(0)
         self.scanCB.setCurrentIndex(0)
         self.startDT.setDateTime(datetime.datetime(2000, 1, 1, 00, 00))
         self.endDT.setDateTime(datetime.datetime(2000, 1, 1, 00, 00))
 
+        # stop watching the old directory and any pending live filter
+        self.watchCB.setChecked(False)
+        self.filterTimer.stop()
+
         # clear filter combo box
-        self.fileCB.clear()
-        self.fileCB.addItem("Select a File")
+        self.fileModel.clear()
+        self.frameCache.clear()
+        self.currentStack = None
 
         # reset and hide progress bar from view
         self.progressBar.hide()
@@ -199,48 +398,436 @@ class UI(QMainWindow):
         self.xrange = False
         self.yrange = False
         self.energy = False
+        self.peak = False
 
         # disallow filters
         self.filterAllowed = False
 
         # reset image
+        self.reset_stack(None)
+        self.currentFrame = None
         pixmap = QtGui.QPixmap("white.png")
         self.imgLBL.setPixmap(pixmap)
 
-        # clear db
-        self.collection.delete_many({})
+        # clear db, unless it is kept for incremental updates
+        if not self.syncCB.isChecked():
+            data_store.clear(self.collection)
 
-    def display_hdf(self, filename):
+    def fetch_view(self, filename, db_file=None):
         '''
-        Displays an HDF5 file's data to the screen as an image
-        :param filename: the filename of the file to be displayed, as a string
+        Reads what is displayed for a file: the pyramid level that fills the image label, or the first frame of
+        files too small for a pyramid. Adds it to the frame cache.
+        :param filename: the filename of the file, as a string
+        :param db_file: the file's entry without its pixel data, as a dictionary, or None to look it up
+        :return: the entry without its pixel data, as a dictionary, and the image, as a numpy array
         '''
-        if filename == "Select a File":
-            # no file selected
-            pixmap = QtGui.QPixmap("white.png")
+        if db_file is None:
+            # leave the pixel data out, only what is displayed is loaded
+            db_file = self.collection.find_one({"name": filename}, {"data": 0})
+            if db_file is None:
+                raise KeyError(f"{filename} is not in the database")
+
+        if "pyramid" not in db_file and data_store.storage_of(db_file) == "embedded":
+            # small enough to be shown whole, decoded from the catalog or paged in from the disk cache
+            data = self.load_stack(db_file)
+            # copied, so the cache does not keep the whole stack or its memory map alive
+            image = (data[0] if data.ndim >= 3 else data).copy()
+        else:
+            image = data_store.load_view(self.collection, db_file, self.displaySize)
+        self.frameCache.put((filename, "view"), (db_file, image), image.nbytes)
+        return db_file, image
+
+    def load_view(self, filename, db_file, progress_callback):
+        '''
+        Reads what is displayed for a file on the threadpool
+        :param filename: the filename of the file, as a string
+        :param db_file: the file's entry without its pixel data, as a dictionary
+        :param progress_callback: unused, required by Worker
+        :return: the filename, the entry, the image (None on failure) and the error message, as a tuple
+        '''
+        try:
+            db_file, image = self.fetch_view(filename, db_file)
+        except Exception as e:
+            return filename, db_file, None, str(e)
+        return filename, db_file, image, ""
+
+    def view_loaded(self, result):
+        '''
+        Replaces the thumbnail with the loaded image, unless another file has been selected since
+        :param result: the filename, entry, image and error message, as a tuple
+        '''
+        filename, db_file, image, error = result
+        if filename != self.currentName or self.stackIndex != 0:
+            return
+
+        if image is None:
+            self.textBrowser.append(self.format_msg("log_error", "ERROR: " + error))
+            self.textBrowser.moveCursor(QtGui.QTextCursor.End)
+            return
+
+        self.currentFrame = image
+        self.currentPreview = "pyramid" in db_file
+        self.render_frame()
+
+    def prefetch(self, filenames, progress_callback):
+        '''
+        Loads what is displayed for files into the frame cache ahead of them being displayed
+        :param filenames: the filenames of the files, as a list of strings
+        :param progress_callback: unused, required by Worker
+        '''
+        for filename in filenames:
+            if (filename, "view") not in self.frameCache:
+                try:
+                    self.fetch_view(filename)
+                except Exception as e:
+                    pass
+
+    def prefetch_neighbours(self, filename):
+        '''
+        Starts loading the files before and after a file in the file list on the threadpool
+        :param filename: the filename of the current file, as a string
+        '''
+        names = self.fileModel.names
+        try:
+            row = names.index(filename)
+        except ValueError:
+            return
+
+        # row 0 is the placeholder
+        neighbours = [names[i] for i in (row + 1, row - 1) if 0 < i < len(names)]
+        if neighbours:
+            self.threadpool.start(Worker(self.prefetch, neighbours))
+
+    def load_stack(self, db_file):
+        '''
+        Loads the embedded pixel data of a file, memory mapped from the disk cache when it was decoded before, in
+        this or an earlier session, and written to the disk cache otherwise
+        :param db_file: the file's entry without its pixel data, as a dictionary
+        :return: the data, as a numpy array
+        '''
+        if self.diskCache is not None:
+            data = self.diskCache.get(db_file)
+            if data is not None:
+                return data
+
+        data = data_store.load_data(self.collection, db_file)
+        if self.diskCache is not None:
+            self.diskCache.put(db_file, data)
+        return data
+
+    def read_stack_frame(self, db_file, index):
+        '''
+        Reads one full resolution frame of a stack and adds it to the frame cache. Only that frame is read, except
+        for embedded data, which is decoded once, or paged in from the disk cache, and kept until another stack is
+        read.
+        :param db_file: the file's entry without its pixel data, as a dictionary
+        :param index: the frame (energy) index, as an integer
+        :return: the frame, as a 2D numpy array
+        '''
+        if data_store.storage_of(db_file) == "embedded":
+            key = (db_file["name"], db_file.get("_id"), db_file.get("file_mtime"))
+            stack = self.currentStack
+            if stack is None or stack[0] != key:
+                stack = self.currentStack = (key, self.load_stack(db_file))
+            data = stack[1]
+            # copied, so the cache does not keep the whole stack or its memory map alive
+            frame = (data[index] if data.ndim >= 3 else data).copy()
         else:
-            # display selected file
+            frame = data_store.load_frame(self.collection, db_file, index)
+
+        self.frameCache.put((db_file["name"], "frame", index), frame, frame.nbytes)
+        return frame
+
+    def read_ahead(self, db_file, indices, progress_callback):
+        '''
+        Reads frames around the selected energy into the frame cache, giving up on frames the slider has moved away from
+        :param db_file: the file's entry without its pixel data, as a dictionary
+        :param indices: the frame indices, nearest first, as a list of integers
+        :param progress_callback: unused, required by Worker
+        '''
+        for index in indices:
+            if db_file["name"] != self.currentName or abs(index - self.stackIndex) > 2 * READ_AHEAD:
+                return
+            if (db_file["name"], "frame", index) not in self.frameCache:
+                try:
+                    self.read_stack_frame(db_file, index)
+                except Exception as e:
+                    return
+
+    def show_energy(self, index):
+        '''
+        Displays the frame of the current stack at the energy selected with the slider
+        :param index: the frame (energy) index, as an integer
+        '''
+        db_file = self.currentEntry
+        if db_file is None:
+            return
+
+        self.stackIndex = index
+        energies = db_file.get("energies", [])
+        self.energyValLBL.setText(f"{energies[index]:.2f} eV" if index < len(energies) else f"frame {index}")
+
+        frame = self.frameCache.get((db_file["name"], "frame", index))
+        if frame is None:
             try:
-                self.textBrowser.append(
-                    "<p style='color:black; margin:0; padding:0'>Displaying file " + filename + "</p>")
+                frame = self.read_stack_frame(db_file, index)
+            except Exception as e:
+                self.textBrowser.append(self.format_msg("log_error", "ERROR: " + str(e)))
                 self.textBrowser.moveCursor(QtGui.QTextCursor.End)
-                db_file = self.collection.find_one({"name": filename})
-                data = pickle.loads(db_file["data"])
+                return
+
+        self.currentFrame = frame
+        self.currentPreview = False
+        self.render_frame()
+
+        # read the frames around this one, nearest first
+        count = self.energySL.maximum() + 1
+        indices = [i for step in range(1, READ_AHEAD + 1) for i in (index + step, index - step) if 0 <= i < count]
+        if indices:
+            self.threadpool.start(Worker(self.read_ahead, db_file, indices))
+
+    def eventFilter(self, obj, event):
+        '''
+        Draws a region of interest over the image with the mouse and starts computing its spectrum on release
+        '''
+        if obj is self.imgLBL and self.currentEntry is not None:
+            if event.type() == QEvent.MouseButtonPress and event.button() == Qt.LeftButton:
+                self.roiOrigin = event.pos()
+                self.rubberBand.setGeometry(QRect(self.roiOrigin, QSize()))
+                self.rubberBand.show()
+                return True
+            if event.type() == QEvent.MouseMove and self.roiOrigin is not None:
+                self.rubberBand.setGeometry(QRect(self.roiOrigin, event.pos()).normalized())
+                return True
+            if event.type() == QEvent.MouseButtonRelease and self.roiOrigin is not None:
+                rect = QRect(self.roiOrigin, event.pos()).normalized()
+                self.roiOrigin = None
+                self.rubberBand.hide()
+                self.start_spectrum(rect)
+                return True
+        return super(UI, self).eventFilter(obj, event)
+
+    def start_spectrum(self, rect):
+        '''
+        Computes the spectrum of a region of the current stack on the threadpool
+        :param rect: the region, in image label coordinates, as a QRect
+        '''
+        db_file = self.currentEntry
+        if data_store.frame_count(db_file) < 2:
+            self.textBrowser.append(self.format_msg("log_error", "ERROR: Region spectra need an image stack."))
+            self.textBrowser.moveCursor(QtGui.QTextCursor.End)
+            return
+
+        # label to data pixels, the image is shown flipped vertically
+        height, width = db_file["data_ref"]["shape"][-2:]
+        scale_x = width / self.imgLBL.width()
+        scale_y = height / self.imgLBL.height()
+        x0 = min(width - 1, max(0, int(rect.left() * scale_x)))
+        x1 = min(width, max(x0 + 1, math.ceil((rect.right() + 1) * scale_x)))
+        y0 = min(height - 1, max(0, int(height - (rect.bottom() + 1) * scale_y)))
+        y1 = min(height, max(y0 + 1, math.ceil(height - rect.top() * scale_y)))
+
+        self.progressBar.setFormat("%p%")
+        self.progressBar.setValue(0)
+        self.progressBar.show()
+        worker = Worker(self.compute_spectrum, db_file, (x0, y0, x1, y1))
+        worker.signals.progress.connect(self.progressBar.setValue)
+        worker.signals.result.connect(self.spectrum_ready)
+        self.threadpool.start(worker)
+
+    def compute_spectrum(self, db_file, roi, progress_callback):
+        '''
+        Computes the mean spectrum of a rectangular region, timing it
+        :param db_file: the file's entry without its pixel data, as a dictionary
+        :param roi: the region, as an (x0, y0, x1, y1) rectangle in data pixels
+        :param progress_callback: the percent completion, as an integer
+        :return: the filename, region, energies, intensities, time taken in ms and error message, as a tuple
+        '''
+        start = time.perf_counter()
+        try:
+            energies, values = spectrum.roi_spectrum(self.collection, db_file, roi,
+                                                     progress_callback=progress_callback)
+        except Exception as e:
+            return db_file["name"], roi, None, None, 0, str(e)
+        return db_file["name"], roi, energies, values, (time.perf_counter() - start) * 1000, ""
+
+    def spectrum_ready(self, result):
+        '''
+        Logs a computed region spectrum and offers to save it as a CSV file
+        :param result: the filename, region, energies, intensities, time taken in ms and error message, as a tuple
+        '''
+        filename, roi, energies, values, elapsed, error = result
+        self.progressBar.hide()
+        if values is None:
+            self.textBrowser.append(self.format_msg("log_error", "ERROR: " + error))
+            self.textBrowser.moveCursor(QtGui.QTextCursor.End)
+            return
+
+        x0, y0, x1, y1 = roi
+        self.textBrowser.append(self.format_msg("log_msg", f"Spectrum of {filename} over x {x0}-{x1 - 1}, y {y0}-{y1 - 1}: "
+                                                           f"{values.size} energies in {elapsed:.0f} ms."))
+        self.textBrowser.moveCursor(QtGui.QTextCursor.End)
+
+        path, _ = QFileDialog.getSaveFileName(self, "Save Spectrum", os.path.splitext(filename)[0] + "_spectrum.csv",
+                                              "CSV files (*.csv)")
+        if path != "":
+            with open(path, "w", newline="") as f:
+                writer = csv.writer(f)
+                writer.writerow(["energy_eV", "mean_intensity"])
+                writer.writerows(zip(energies.tolist(), values.tolist()))
+
+    def reset_stack(self, db_file):
+        '''
+        Sets up the energy slider for a newly displayed file, enabling it for stacks
+        :param db_file: the file's entry without its pixel data, as a dictionary, or None for no file
+        '''
+        self.currentEntry = db_file
+        self.stackIndex = 0
+        count = data_store.frame_count(db_file) if db_file is not None else 1
+
+        # move the slider back without loading frame 0 again
+        self.energySL.blockSignals(True)
+        self.energySL.setMaximum(count - 1)
+        self.energySL.setValue(0)
+        self.energySL.blockSignals(False)
+        self.energySL.setEnabled(count > 1)
+
+        energies = db_file.get("energies", []) if db_file is not None else []
+        self.energyValLBL.setText(f"{energies[0]:.2f} eV" if count > 1 and energies else "")
+
+    def show_contact_sheet(self):
+        '''
+        Shows the listed files as a grid of thumbnails, in a window of its own that follows the filters
+        '''
+        if self.contactSheet is None:
+            self.contactSheet = ContactSheet(self.sheetModel, self)
+            self.contactSheet.selected.connect(self.select_file)
+        self.contactSheet.show()
+        self.contactSheet.raise_()
+        self.contactSheet.activateWindow()
+
+    def select_file(self, filename):
+        '''
+        Selects a file picked from the contact sheet in the file list and displays it
+        :param filename: the filename of the file, as a string
+        '''
+        self.fileCB.setCurrentIndex(self.fileModel.names.index(filename))
+        self.display_hdf(filename)
 
-                # normalize data
-                data /= (data.max() / 255)
+    def export_files(self):
+        '''
+        Exports the listed files to a directory in a chosen format, or cancels the export under way
+        '''
+        if self.exportCancelled is not None:
+            self.exportCancelled.set()
+            self.exportBTN.setEnabled(False)
+            return
+
+        if not self.filterAllowed or self.fileModel.query is None:
+            self.textBrowser.append(self.format_msg("log_error", "ERROR: No files to export. Create a database and filter it first."))
+            self.textBrowser.moveCursor(QtGui.QTextCursor.End)
+            return
+
+        directory = QFileDialog.getExistingDirectory(self, "Export To")
+        if directory == "":
+            # cancel pressed
+            return
+        choice, ok = QInputDialog.getItem(self, "Export Format", "Export the filtered files as:",
+                                          list(EXPORT_CHOICES), 0, False)
+        if not ok:
+            return
+
+        self.textBrowser.append(self.format_msg("log_msg", f"Exporting the filtered files to {directory}."))
+        self.textBrowser.moveCursor(QtGui.QTextCursor.End)
+        self.progressBar.setFormat("Export %p%")
+        self.progressBar.setValue(0)
+        self.progressBar.show()
+        self.exportBTN.setText("Cancel Export")
+
+        self.exportCancelled = threading.Event()
+        percentile = rendering.CONTRAST_MODES[self.contrastCB.currentText()]
+        threading.Thread(target=self.run_export, daemon=True,
+                         args=(self.fileModel.query, directory, EXPORT_CHOICES[choice], percentile,
+                               self.exportCancelled)).start()
+
+    def run_export(self, query, directory, formats, percentile, cancelled):
+        try:
+            result = batch_export.export(self.collection, self.uri, query, directory, formats,
+                                         os.cpu_count() or 1, percentile, self.exportSignals.progress, cancelled)
+        except Exception as e:
+            result = (0, [(directory, str(e))])
+        self.exportSignals.finished.emit((directory, cancelled.is_set()) + result)
+
+    def export_progress(self, progress):
+        self.progressBar.setValue(progress)
 
-                # convert numpy array to image
-                img = Image.fromarray(data[0].astype("uint8"), "L")
-                ImageOps.flip(img).save("temp.png")
+    def export_finished(self, result):
+        '''
+        Logs the outcome of an export
+        :param result: the export directory, whether the export was cancelled, the number of files exported and the
+        failures, as a tuple
+        '''
+        directory, cancelled, exported, failures = result
+        self.exportCancelled = None
+        self.exportBTN.setText("Export...")
+        self.exportBTN.setEnabled(True)
+        self.progressBar.hide()
+
+        for file_path, reason in failures:
+            self.textBrowser.append(self.format_msg("log_error", f"ERROR: {file_path} not exported: {reason}"))
+        stopped = " before it was cancelled" if cancelled else ""
+        self.textBrowser.append(self.format_msg("log_msg", f"Exported {exported} files to {directory}{stopped}."))
+        self.textBrowser.moveCursor(QtGui.QTextCursor.End)
+
+    def display_hdf(self, filename):
+        '''
+        Displays an HDF5 file's data to the screen as an image. The stored thumbnail is shown straight away and
+        replaced once the full image has loaded.
+        :param filename: the filename of the file to be displayed, as a string
+        '''
+        self.currentName = filename
+        if filename == "Select a File":
+            # no file selected
+            self.reset_stack(None)
+            self.currentFrame = None
+            self.imgLBL.setPixmap(QtGui.QPixmap("white.png"))
+            self.imgLBL.setToolTip("")
+            return
+
+        # display selected file
+        self.textBrowser.append(
+            "<p style='color:black; margin:0; padding:0'>Displaying file " + filename + "</p>")
+        self.textBrowser.moveCursor(QtGui.QTextCursor.End)
 
-                pixmap = QtGui.QPixmap("temp.png")
+        cached = self.frameCache.get((filename, "view"))
+        if cached is not None:
+            db_file, self.currentFrame = cached
+            self.currentPreview = "pyramid" in db_file
+            self.reset_stack(db_file)
+            self.render_frame()
+        else:
+            try:
+                # leave the pixel data out, only what is displayed is loaded
+                db_file = self.collection.find_one({"name": filename}, {"data": 0})
+                if db_file is None:
+                    raise KeyError(f"{filename} is not in the database")
             except Exception as e:
                 self.textBrowser.append("<p style='color:red; margin:0; padding:0'>ERROR: " + str(e) + "</p>")
                 self.textBrowser.moveCursor(QtGui.QTextCursor.End)
-
-        # display pixmap
-        self.imgLBL.setPixmap(pixmap)
+                self.reset_stack(None)
+                return
+
+            # the stored contrast limits of the new file apply from the thumbnail on
+            self.reset_stack(db_file)
+            thumbnail = data_store.load_thumbnail(db_file)
+            if thumbnail is not None:
+                self.currentFrame = thumbnail
+                self.currentPreview = True
+                self.render_frame()
+
+            worker = Worker(self.load_view, filename, db_file)
+            worker.signals.result.connect(self.view_loaded)
+            self.threadpool.start(worker)
 
         # rearrange start data to a viewable form
         date = db_file['start_time']
@@ -255,16 +842,60 @@ class UI(QMainWindow):
         # show tool tip for 30s
         self.imgLBL.setToolTipDuration(30000)
 
+        # get the files around this one ready
+        self.prefetch_neighbours(filename)
+
+    def render_frame(self):
+        '''
+        Maps the current frame to grey levels with the selected contrast and shows it, timing the render
+        '''
+        if self.currentFrame is None:
+            return
+
+        start = time.perf_counter()
+        percentile = rendering.CONTRAST_MODES[self.contrastCB.currentText()]
+
+        # limits stored at ingest save a pass over the frame, found from the frame for older entries
+        limits = intensity.contrast_limits(self.currentEntry, self.stackIndex, percentile)
+        if limits is not None and self.currentPreview:
+            limits = intensity.preview_limits(self.currentEntry, *limits)
+        low, high = limits or (None, None)
+
+        grey = rendering.to_uint8(self.currentFrame, low, high, percentile=percentile, gamma=self.gammaSB.value())
+        self.imgLBL.setPixmap(QtGui.QPixmap.fromImage(rendering.to_qimage(grey)))
+
+        # keep the latest render times for the status bar
+        self.renderTimes = self.renderTimes[-99:] + [(time.perf_counter() - start) * 1000]
+        self.show_cache_stats()
+
+    def show_cache_stats(self):
+        '''
+        Shows the render latency and frame cache counters on the status bar
+        '''
+        stats = self.frameCache.stats()
+        render = ""
+        if self.renderTimes:
+            render = (f"Render: {self.renderTimes[-1]:.1f} ms "
+                      f"(median {statistics.median(self.renderTimes):.1f} ms) | ")
+        disk = ""
+        if self.diskCache is not None:
+            disk_stats = self.diskCache.stats()
+            disk = (f" | Disk cache: {disk_stats['hits']} hits, {disk_stats['misses']} misses, "
+                    f"{disk_stats['bytes'] / 2 ** 20:.0f} of {disk_stats['max_bytes'] / 2 ** 20:.0f} MB")
+        self.statusbar.showMessage(render + f"Frame cache: {stats['hits']} hits, {stats['misses']} misses, "
+                                   f"{stats['entries']} frames, {stats['bytes'] / 2 ** 20:.1f} of "
+                                   f"{stats['max_bytes'] / 2 ** 20:.0f} MB" + disk)
+
     def thread_finished(self):
         '''
         Declares the thread finished on the log and allows filtering of database files
         '''
 
+        # entries may have changed
+        self.frameCache.clear()
+
         # populate dropdown
-        self.fileCB.clear()
-        self.fileCB.addItem("Select a File")
-        for item in self.collection.find({}):
-            self.fileCB.addItem(item["name"])
+        self.fileModel.set_query(self.collection, {})
 
         self.textBrowser.append(self.format_msg("log_msg", "Database ready."))
         self.textBrowser.moveCursor(QtGui.QTextCursor.End)
@@ -282,6 +913,22 @@ class UI(QMainWindow):
         # hide progress bar
         self.progressBar.hide()
 
+    def report_failures(self, failures):
+        '''
+        Logs the files that could not be added to the database, then the summary of the run
+        :param failures: the files that failed, as a list of (file path, reason) tuples
+        '''
+        for file_path, reason in failures:
+            self.textBrowser.append(self.format_msg("log_error", f"ERROR: {file_path} not added to database: {reason}"))
+            if self.trackP:
+                print(f"{file_path} not added to database: {reason}")
+
+        for line in self.ingestStats.report():
+            self.textBrowser.append(self.format_msg("log_msg", line))
+            if self.trackP:
+                print(line)
+        self.textBrowser.moveCursor(QtGui.QTextCursor.End)
+
     def submit_database(self):
         '''
         Creates a thread for database preparation and updates status on log
@@ -292,15 +939,28 @@ class UI(QMainWindow):
         if self.trackP:
             print("Directory submitted. Preparing database.")
 
+        # the database is rebuilt, watch again once it is ready
+        self.watchCB.setChecked(False)
+
         # directory specified from command line
         if self.directory != "":
             self.dirLE.setText(self.directory)
 
         # directory specified in GUI
         if self.dirLE.text() != "":
+            self.progressBar.setFormat("%p%")
             self.progressBar.setValue(0)
             self.progressBar.show()
-            worker = Worker(prepare_database.prepare_database, self.collection, self.dirLE.text())
+            if self.syncCB.isChecked():
+                # only read what changed since the last submit
+                worker = Worker(prepare_database.sync_database, self.collection, self.dirLE.text(),
+                                workers=self.workers, use_hash=self.hashCB.isChecked(),
+                                batch_size=self.batch_size, storage=self.storage, stats=self.ingestStats)
+            else:
+                worker = Worker(prepare_database.prepare_database, self.collection, self.dirLE.text(),
+                                workers=self.workers, batch_size=self.batch_size, storage=self.storage,
+                                stats=self.ingestStats)
+            worker.signals.result.connect(self.report_failures)
             worker.signals.finished.connect(self.thread_finished)
             worker.signals.progress.connect(self.track_progress)
             self.threadpool.start(worker)
@@ -310,13 +970,89 @@ class UI(QMainWindow):
             self.textBrowser.append(self.format_msg("log_error", "ERROR: File Directory field is required."))
             self.textBrowser.moveCursor(QtGui.QTextCursor.End)
 
-    def filter_data(self):
+    def toggle_watch(self, checked):
+        '''
+        Starts or stops watching the database directory for new scans
+        :param checked: whether watching was turned on, as a boolean
+        '''
+        if not checked:
+            if self.watcher is not None:
+                self.watcher.stop()
+                self.watcher = None
+                self.textBrowser.append(self.format_msg("log_msg", "Stopped watching for new scans."))
+                self.textBrowser.moveCursor(QtGui.QTextCursor.End)
+            return
+
+        if not self.filterAllowed or self.dirLE.text() == "":
+            self.textBrowser.append(self.format_msg("log_error", "ERROR: Create a database before watching for new scans."))
+            self.textBrowser.moveCursor(QtGui.QTextCursor.End)
+            self.watchCB.setChecked(False)
+            return
+
+        # files already in the database are not read again when watching starts
+        known = [item["file_path"] for item in self.collection.find({}, {"file_path": 1})]
+        self.watcher = watcher.Watcher(self.dirLE.text(), self.watchSignals.ready.emit, known)
+        self.watcher.start()
+        self.textBrowser.append(self.format_msg("log_msg", f"Watching {self.dirLE.text()} for new scans."))
+        self.textBrowser.moveCursor(QtGui.QTextCursor.End)
+
+    def ingest_new_files(self, file_paths):
+        '''
+        Adds files the watcher found to the database on the threadpool
+        :param file_paths: the full filepaths of the new files, as a list of strings
+        '''
+        if self.watcher is None:
+            return
+        worker = Worker(self.add_new_files, self.watcher.directory, file_paths)
+        worker.signals.result.connect(self.new_files_added)
+        self.threadpool.start(worker)
+
+    def add_new_files(self, directory, file_paths, progress_callback):
+        return prepare_database.add_files(self.collection, directory, file_paths, storage=self.storage,
+                                          batch_size=self.batch_size)
+
+    def new_files_added(self, result):
+        '''
+        Appends new entries to the file list when they match the current filters, and logs the files added
+        :param result: the entries added and the files that failed, as returned by prepare_database.add_files
+        '''
+        entries, failures = result
+
+        # a rewritten file may have stale frames cached
+        if any((entry["name"], "view") in self.frameCache for entry in entries):
+            self.frameCache.clear()
+
+        self.fileModel.add_entries(entries)
+        for entry in entries:
+            self.textBrowser.append(self.format_msg("log_msg", f"New scan added: {entry['name']}"))
+        for file_path, reason in failures:
+            self.textBrowser.append(self.format_msg("log_error", f"ERROR: {file_path} not added to database: {reason}"))
+        self.textBrowser.moveCursor(QtGui.QTextCursor.End)
+
+    def filters_changed(self):
+        '''
+        Restarts the wait before live filtering, cancelling the query of the previous filters
+        '''
+        if self.liveCB.isChecked() and self.filterAllowed:
+            self.fileModel.cancel()
+            self.filterTimer.start()
+
+    def filter_failed(self, error):
+        self.textBrowser.append(self.format_msg("log_error", "ERROR: Filter query failed: " + error))
+        self.textBrowser.moveCursor(QtGui.QTextCursor.End)
+
+    def filter_data(self, live=False):
         '''
-        Filters files in database according to user selections
+        Filters files in database according to user selections. The query runs on the threadpool and the file list
+        fills in as pages of results arrive.
+        :param live: whether this is live filtering after a filter changed, as a boolean. Filters that do not make
+        sense yet are left until they do, without logging.
         '''
+        if live and (not self.filterAllowed or self.eminSB.value() > self.emaxSB.value()
+                     or (self.peakMaxSB.value() != 0 and self.peakMinSB.value() > self.peakMaxSB.value())):
+            return
 
-        self.fileCB.clear()
-        self.fileCB.addItem("Select a File")
+        self.fileModel.clear()
 
         if not self.filterAllowed:
             self.textBrowser.append(self.format_msg("log_error", "ERROR: No filters to submit. Create a database first."))
@@ -324,115 +1060,109 @@ class UI(QMainWindow):
         elif self.eminSB.value() > self.emaxSB.value():
             self.textBrowser.append(self.format_msg("log_error", "ERROR: Energy maximum cannot be less than energy minimum."))
             self.textBrowser.moveCursor(QtGui.QTextCursor.End)
+        elif self.peakMaxSB.value() != 0 and self.peakMinSB.value() > self.peakMaxSB.value():
+            self.textBrowser.append(self.format_msg("log_error", "ERROR: Peak intensity maximum cannot be less than peak intensity minimum."))
+            self.textBrowser.moveCursor(QtGui.QTextCursor.End)
         else:
+            self.reset_stack(None)
+            self.currentFrame = None
             pixmap = QtGui.QPixmap("white.png")
             self.imgLBL.setPixmap(pixmap)
 
-            self.textBrowser.append(self.format_msg("log_msg", "Filters submitted."))
-            self.textBrowser.moveCursor(QtGui.QTextCursor.End)
-
-            if self.scanCB.currentText() != "Scan Type...":
-                self.scan_type = True
-                scan = [self.scanCB.currentText()]
-            else:
-                self.scan_type = False
-                scan = ["coarse image scan", "sample image", "sample focus", "generic scan", "sample point spectrum",
-                        "sample line spectrum", "sample image stack", "osa image", "osa focus", "detector image"]
+            if not live:
+                self.textBrowser.append(self.format_msg("log_msg", "Filters submitted."))
+                self.textBrowser.moveCursor(QtGui.QTextCursor.End)
 
-            if self.startDT.dateTime() != datetime.datetime(2000, 1, 1, 00, 00):
-                self.start_date = True
+            # only filters in use become part of the query
+            scan = None
+            start_int = None
+            end_int = None
+            xresolution = None
+            yresolution = None
+            xrang = None
+            yrang = None
+            emin = None
+            emax = None
+            peak_min = None
+            peak_max = None
+
+            self.scan_type = self.scanCB.currentText() != "Scan Type..."
+            if self.scan_type:
+                scan = self.scanCB.currentText()
+
+            self.start_date = self.startDT.dateTime() != datetime.datetime(2000, 1, 1, 00, 00)
+            if self.start_date:
                 # find startDT object to use with filter
                 start_str = self.startDT.dateTime().toString()
                 # datetime object
                 start_dt = datetime.datetime.strptime(start_str, "%a %b %d %H:%M:00 %Y")
                 # turn into a comparable integer
                 start_int = int(datetime.datetime.strftime(start_dt, "%Y%m%d%H%M"))
-            else:
-                self.start_date = False
-                start_dt = datetime.datetime(1970, 1, 1, 00, 00)
-                # turn into a comparable integer
-                start_int = int(datetime.datetime.strftime(start_dt, "%Y%m%d%H%M"))
 
-            if self.endDT.dateTime() != datetime.datetime(2000, 1, 1, 00, 00):
-                self.end_date = True
+            self.end_date = self.endDT.dateTime() != datetime.datetime(2000, 1, 1, 00, 00)
+            if self.end_date:
                 # find endtDT object to use with filter
                 end_str = self.endDT.dateTime().toString()
                 # datetime object
                 end_dt = datetime.datetime.strptime(end_str, "%a %b %d %H:%M:00 %Y")
                 # turn into a comparable integer
                 end_int = int(datetime.datetime.strftime(end_dt, "%Y%m%d%H%M"))
-            else:
-                self.end_date = False
-                end_dt = datetime.datetime.now()
-                end_int = int(datetime.datetime.strftime(end_dt, "%Y%m%d%H%M"))
 
-            if self.xresSB.value() != 0:
-                self.xres = True
-                xresolution = [self.xresSB.value()]
-            else:
-                self.xres = False
-                xresolution = list(range(0, 1000))
+            self.xres = self.xresSB.value() != 0
+            if self.xres:
+                xresolution = self.xresSB.value()
 
-            if self.yresSB.value() != 0:
-                self.yres = True
-                yresolution = [self.xresSB.value()]
-            else:
-                self.yres = False
-                yresolution = list(range(0, 1000))
+            self.yres = self.yresSB.value() != 0
+            if self.yres:
+                yresolution = self.yresSB.value()
 
-            if self.xrangeSB.value() != 0:
-                self.xrange = True
-                xrang = [self.xrangeSB.value()]
-            else:
-                self.xrange = False
-                xrang = list(range(0, 1000))
+            self.xrange = self.xrangeSB.value() != 0
+            if self.xrange:
+                xrang = self.xrangeSB.value()
 
-            if self.yrangeSB.value() != 0:
-                self.yrange = True
-                yrang = [self.yrangeSB.value()]
-            else:
-                self.yrange = False
-                yrang = list(range(0, 1000))
+            self.yrange = self.yrangeSB.value() != 0
+            if self.yrange:
+                yrang = self.yrangeSB.value()
 
-            if self.emaxSB.value() != 0:
-                self.energy = True
+            self.energy = self.emaxSB.value() != 0
+            if self.energy:
                 emax = self.emaxSB.value()
-            else:
-                self.energy = False
-                emax = 9999
 
-            emin = self.eminSB.value()
+            if self.eminSB.value() != 0:
+                emin = self.eminSB.value()
+
+            self.peak = self.peakMinSB.value() != 0 or self.peakMaxSB.value() != 0
+            if self.peakMinSB.value() != 0:
+                peak_min = self.peakMinSB.value()
+            if self.peakMaxSB.value() != 0:
+                peak_max = self.peakMaxSB.value()
 
-            if (not self.scan_type and not self.start_date and not self.end_date and not self.xrange and not self.yrange
-                    and not self.xres and not self.yres and not self.energy):
+            if (not live and not self.scan_type and not self.start_date and not self.end_date and not self.xrange
+                    and not self.yrange and not self.xres and not self.yres and not self.energy and not self.peak):
                 self.textBrowser.append(self.format_msg("log_msg", "No filters applied."))
                 self.textBrowser.append(self.format_msg("log_msg", "Default values may not be used as filters."))
                 self.textBrowser.moveCursor(QtGui.QTextCursor.End)
 
-            filtered = self.collection.find({"scan_type": {"$in": scan},
-                                             "xresolution": {"$in": xresolution},
-                                             "yresolution": {"$in": yresolution},
-                                             "xrange": {"$in": xrang},
-                                             "yrange": {"$in": yrang},
-                                             "energy_min": {"$gte": emin},
-                                             "energy_max": {"$lte": emax},
-                                             "start_time": {"$gte": start_int},
-                                             "end_time": {"$lte": end_int}
-                                             })
+            query = catalog_query.build_query(scan_type=scan, start_time=start_int, end_time=end_int,
+                                              xresolution=xresolution, yresolution=yresolution,
+                                              xrange=xrang, yrange=yrang, energy_min=emin, energy_max=emax,
+                                              peak_min=peak_min, peak_max=peak_max)
 
             # populate dropdown with filtered items
-            for item in filtered:
-                self.fileCB.addItem(item['name'])
+            self.fileModel.set_query(self.collection, query)
 
     def track_progress(self, progress):
         '''
-        Displays progress of database creation to screen
+        Displays progress of database creation to screen, with the throughput and time left
         :param progress: the percent completion of the database, as an integer
         '''
+        text = self.ingestStats.progress_text()
+        self.progressBar.setFormat(f"%p%  {text}")
         self.progressBar.setValue(progress)
 
         if self.trackP:
-            print(f"Database creation: {progress}%", end="\r")
+            # pad over the end of a longer previous line
+            print(f"Database creation: {progress}%  {text:<60}", end="\r")
             if progress == 100:
                 print(end="\n")
 
@@ -0,0 +1,163 @@
+import io
+import pickle
+import struct
+import zlib
+import numpy as np
+
+try:
+    import lz4.frame
+except ImportError as e:
+    lz4 = None
+
+# encoded arrays start with a fixed header, then the dtype string and shape, then the little-endian pixel bytes
+#   magic, format version, compression, number of dimensions, length of the dtype string
+MAGIC = b"STXA"
+VERSION = 1
+HEADER = struct.Struct("<4sBBBB")
+
+COMPRESSIONS = ("none", "zlib", "lz4")
+# "auto" picks per scan between the fastest available compression and none
+DEFAULT_COMPRESSION = "auto"
+# fraction of the size a compression must save to be kept, zlib decoding several times slower than lz4
+MIN_SAVING = {"lz4": 0.1, "zlib": 0.5}
+# bytes compressed to judge whether a scan is worth compressing
+SAMPLE_BYTES = 1 << 18
+ZLIB_LEVEL = 1
+
+# the only globals a pickled numpy array needs, for entries written before the compact format
+LEGACY_GLOBALS = {("numpy", "ndarray"),
+                  ("numpy", "dtype"),
+                  ("numpy.core.multiarray", "_reconstruct"),
+                  ("numpy.core.multiarray", "scalar"),
+                  ("numpy._core.multiarray", "_reconstruct"),
+                  ("numpy._core.multiarray", "scalar"),
+                  ("_codecs", "encode")}
+
+
+def available_compressions():
+    '''
+    Gets the compressions that can be used here, lz4 needing the optional lz4 package
+    :return: the compressions, as a list of strings
+    '''
+    return [compression for compression in COMPRESSIONS if compression != "lz4" or lz4 is not None]
+
+
+def check_compression(compression):
+    '''
+    Raises a ValueError unless a compression can be used here
+    :param compression: one of COMPRESSIONS, or "auto"
+    '''
+    if compression != "auto" and compression not in available_compressions():
+        raise ValueError(f"Unknown compression {compression}, expected auto or one of "
+                         f"{', '.join(available_compressions())}")
+
+
+def compress(compression, raw):
+    if compression == "zlib":
+        return zlib.compress(raw, ZLIB_LEVEL)
+    if compression == "lz4":
+        return lz4.frame.compress(raw)
+    return raw
+
+
+def decompress(compression, payload):
+    if compression == "zlib":
+        return zlib.decompress(payload)
+    if compression == "lz4":
+        if lz4 is None:
+            raise ValueError("Data is lz4 compressed but the lz4 package is not installed")
+        return lz4.frame.decompress(payload)
+    return payload
+
+
+def choose_compression(raw):
+    '''
+    Picks the compression for one scan by compressing a sample of its bytes. Noisy float data barely compresses,
+    so it is left raw and decodes without a copy.
+    :param raw: the pixel data, as bytes
+    :return: the compression, one of COMPRESSIONS
+    '''
+    compression = "lz4" if lz4 is not None else "zlib"
+    sample = raw[:SAMPLE_BYTES]
+    if not sample or len(compress(compression, sample)) > (1 - MIN_SAVING[compression]) * len(sample):
+        return "none"
+    return compression
+
+
+def encode(data, compression=DEFAULT_COMPRESSION):
+    '''
+    Serializes an array as a header of its dtype and shape followed by its little-endian bytes, optionally
+    compressed
+    :param data: the array, as a numpy array of a numeric dtype
+    :param compression: one of COMPRESSIONS, or "auto" to choose per array
+    :return: the encoded array, as bytes
+    '''
+    data = np.asarray(data)
+    if data.dtype.hasobject:
+        raise ValueError("Cannot encode arrays of Python objects")
+    dtype = data.dtype.newbyteorder("<") if data.dtype.byteorder == ">" else data.dtype
+    raw = np.ascontiguousarray(data, dtype=dtype).tobytes()
+
+    check_compression(compression)
+    if compression == "auto":
+        compression = choose_compression(raw)
+
+    dtype_str = dtype.str.encode("ascii")
+    header = HEADER.pack(MAGIC, VERSION, COMPRESSIONS.index(compression), data.ndim, len(dtype_str))
+    return b"".join([header, dtype_str, struct.pack(f"<{data.ndim}Q", *data.shape), compress(compression, raw)])
+
+
+def is_encoded(buffer):
+    return bytes(buffer[:len(MAGIC)]) == MAGIC
+
+
+def describe(buffer):
+    '''
+    Reads the header of an encoded array
+    :param buffer: the encoded array, as a bytes-like object
+    :return: the compression, dtype, shape and offset of the pixel bytes, as a tuple
+    '''
+    magic, version, compression, ndim, dtype_length = HEADER.unpack_from(buffer)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError("Not an encoded array, or written by a newer version")
+    offset = HEADER.size
+    dtype = np.dtype(bytes(buffer[offset:offset + dtype_length]).decode("ascii"))
+    offset += dtype_length
+    shape = struct.unpack_from(f"<{ndim}Q", buffer, offset)
+    return COMPRESSIONS[compression], dtype, shape, offset + 8 * ndim
+
+
+def decode(buffer):
+    '''
+    Deserializes an array written by encode, or a pickled array written before the compact format. Uncompressed
+    arrays are views of the buffer rather than copies, so they are read only.
+    :param buffer: the encoded array, as a bytes-like object
+    :return: the array, as a numpy array
+    '''
+    if not is_encoded(buffer):
+        return load_legacy(buffer)
+
+    compression, dtype, shape, offset = describe(buffer)
+    if compression == "none":
+        return np.frombuffer(buffer, dtype=dtype, offset=offset).reshape(shape)
+    return np.frombuffer(decompress(compression, memoryview(buffer)[offset:]), dtype=dtype).reshape(shape)
+
+
+class LegacyUnpickler(pickle.Unpickler):
+    def find_class(self, module, name):
+        # anything else in a shared database could run arbitrary code when loaded
+        if (module, name) not in LEGACY_GLOBALS:
+            raise pickle.UnpicklingError(f"Refusing to load {module}.{name} from pickled pixel data")
+        return super(LegacyUnpickler, self).find_class(module, name)
+
+
+def load_legacy(buffer):
+    '''
+    Loads pixel data pickled by earlier versions, allowing nothing but numpy arrays
+    :param buffer: the pickled array, as a bytes-like object
+    :return: the array, as a numpy array
+    '''
+    data = LegacyUnpickler(io.BytesIO(buffer)).load()
+    if not isinstance(data, np.ndarray):
+        raise pickle.UnpicklingError(f"Expected pickled pixel data to be a numpy array, got {type(data).__name__}")
+    return data
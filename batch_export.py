@@ -0,0 +1,192 @@
+import csv
+import os
+from functools import partial
+import numpy as np
+import catalog
+import catalog_query
+import data_store
+import intensity
+import rendering
+from prepare_database import map_files
+
+# file formats scans are exported to
+#   png, tiff: one 8 bit greyscale image per frame (energy), contrast mapped as in the viewer
+#   npy: the raw pixel data
+#   npz: the raw pixel data with the energies of its frames
+FORMATS = ("png", "tiff", "npy", "npz")
+IMAGE_FORMATS = {"png": "PNG", "tiff": "TIFF"}
+METADATA_FILE = "metadata.csv"
+# columns of the metadata file, after the catalog fields
+EXPORT_FIELDS = ["frames", "exported_files"]
+
+# catalog connections of a worker process, opened on its first scan
+collections = {}
+
+
+def check_formats(formats):
+    '''
+    Raises a ValueError unless every format can be exported
+    :param formats: the formats, as a list of strings
+    '''
+    if not formats:
+        raise ValueError(f"No export format given, expected some of {', '.join(FORMATS)}")
+    for export_format in formats:
+        if export_format not in FORMATS:
+            raise ValueError(f"Unknown export format {export_format}, expected some of {', '.join(FORMATS)}")
+
+
+def output_stem(entry, used):
+    '''
+    Picks where a scan's files are written, without the extension: its path below the directory the catalog was built
+    from, so scans with the same file name in different subdirectories do not overwrite each other. A numbered
+    suffix is added if the stem is still taken, e.g. by a scan from outside that directory.
+    :param entry: the entry, as a dictionary
+    :param used: the stems already picked, as a set of strings, added to
+    :return: the stem, relative to the export directory, as a string
+    '''
+    stem = os.path.splitext(entry["name"])[0]
+    if "file_path" in entry and "directory" in entry:
+        relative = os.path.relpath(entry["file_path"], entry["directory"])
+        if not relative.startswith(os.pardir):
+            stem = os.path.splitext(relative)[0]
+
+    unique = stem
+    copy = 1
+    while os.path.normcase(unique) in used:
+        copy += 1
+        unique = f"{stem}_{copy}"
+    used.add(os.path.normcase(unique))
+    return unique
+
+
+def open_collection(uri):
+    '''
+    Gets the catalog of a worker, connecting once per process rather than once per scan
+    :param uri: the database URI, as a string
+    :return: the database collection
+    '''
+    if uri not in collections:
+        collections[uri] = catalog.open_catalog(uri)
+    return collections[uri]
+
+
+def write_frames(data, entry, stem, image_format, percentile):
+    '''
+    Writes each frame of a scan as an 8 bit greyscale image, flipped as in the viewer
+    :param data: the pixel data, as a 2D or 3D numpy array
+    :param entry: the entry, as a dictionary
+    :param stem: the path of the images without an extension, as a string
+    :param image_format: one of IMAGE_FORMATS
+    :param percentile: the percentage of pixels clipped at each end, as a float, or None for the full range
+    :return: the paths written, as a list of strings
+    '''
+    # point spectra are written as a single row
+    frames = data.reshape((-1,) + data.shape[-2:]) if data.ndim >= 2 else data.reshape(1, 1, -1)
+    paths = []
+    for index, frame in enumerate(frames):
+        # stored statistics save a pass over the pixels
+        limits = intensity.contrast_limits(entry, index, percentile) or rendering.contrast_limits(frame, percentile)
+        image = rendering.to_qimage(rendering.to_uint8(frame, *limits))
+        path = f"{stem}_{index:03d}.{image_format}" if len(frames) > 1 else f"{stem}.{image_format}"
+        if not image.save(path, IMAGE_FORMATS[image_format]):
+            raise OSError(f"Could not write {path}")
+        paths.append(path)
+    return paths
+
+
+def export_entry(job, directory, formats, percentile=None, collection=None, uri=None):
+    '''
+    Exports one scan, loading its pixel data in the calling process so only the entry's metadata is sent to it
+    :param job: the entry without its pixel data, as a dictionary, and its stem, as picked by output_stem, as a tuple
+    :param directory: the directory to write to, as a string
+    :param formats: the formats to write, as a list of FORMATS
+    :param percentile: the percentage of pixels clipped at each end of exported images, as a float, or None for the
+    full range
+    :param collection: the database collection, when exporting in this process
+    :param uri: the database URI, as a string, opened once per worker process when no collection is given
+    :return: the number of frames and the paths written relative to the directory, or None and the reason the scan
+    could not be exported, as a tuple
+    '''
+    entry, stem = job
+    try:
+        data = data_store.load_data(collection if collection is not None else open_collection(uri), entry)
+        stem = os.path.join(directory, stem)
+        os.makedirs(os.path.dirname(stem), exist_ok=True)
+
+        paths = []
+        for export_format in formats:
+            if export_format == "npy":
+                np.save(f"{stem}.npy", data)
+                paths.append(f"{stem}.npy")
+            elif export_format == "npz":
+                np.savez(f"{stem}.npz", data=data, energies=np.asarray(entry.get("energies", []), dtype=np.float64))
+                paths.append(f"{stem}.npz")
+            else:
+                paths.extend(write_frames(data, entry, stem, export_format, percentile))
+        frames = data.shape[0] if data.ndim >= 3 else 1
+        return frames, [os.path.relpath(path, directory) for path in paths]
+    except Exception as e:
+        return None, str(e)
+
+
+def export(collection, uri, query, directory, formats, workers=1, percentile=None, progress_callback=None,
+           cancelled=None):
+    '''
+    Exports the scans matching a query, each in its own files, and writes their catalog fields to a metadata file.
+    Entries are streamed from the catalog and read in parallel worker processes, which fetch the pixel data
+    themselves, so memory is bounded by the scans being worked on however many match.
+    :param collection: the database collection
+    :param uri: the database URI, as a string, opened again by each worker process
+    :param query: the scans to export, as a database query
+    :param directory: the directory to write to, as a string, created if needed
+    :param formats: the formats to write, as a list of FORMATS
+    :param workers: the number of worker processes to use, as an integer. 1 exports in a single thread.
+    :param percentile: the percentage of pixels clipped at each end of exported images, as a float, or None for the
+    full range
+    :param progress_callback: the percent completion, as an integer, or None
+    :param cancelled: set to stop early, leaving the scans exported so far, as a threading.Event, or None
+    :return: the number of scans exported and the scans that could not be, as a list of (file path, reason) tuples
+    '''
+    check_formats(formats)
+    total = collection.count_documents(query)
+    if total == 0:
+        if progress_callback is not None:
+            progress_callback.emit(100)
+        return 0, []
+    os.makedirs(directory, exist_ok=True)
+
+    # the pixel data and thumbnail are left for the workers, stems are picked here where all of them are known
+    used = set()
+    jobs = ((entry, output_stem(entry, used)) for entry in collection.find(query, {"data": 0, "thumbnail": 0}))
+    if workers <= 1:
+        # the single worker thread shares the caller's connection, so in-memory catalogs work too
+        export_job = partial(export_entry, directory=directory, formats=formats, percentile=percentile,
+                             collection=collection)
+    else:
+        export_job = partial(export_entry, directory=directory, formats=formats, percentile=percentile, uri=uri)
+
+    exported = 0
+    failures = []
+    percent = -1
+    with open(os.path.join(directory, METADATA_FILE), "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=catalog_query.FIELDS + EXPORT_FIELDS, extrasaction="ignore")
+        writer.writeheader()
+
+        results = map_files(export_job, jobs, workers)
+        try:
+            for done, ((entry, stem), (frames, result)) in enumerate(results, 1):
+                if frames is None:
+                    failures.append((entry.get("file_path", entry["name"]), result))
+                else:
+                    writer.writerow({**entry, "frames": frames, "exported_files": ";".join(result)})
+                    exported += 1
+                # scans added since the count was taken would go past 100%
+                if progress_callback is not None and min(100, 100 * done // total) != percent:
+                    percent = min(100, 100 * done // total)
+                    progress_callback.emit(percent)
+                if cancelled is not None and cancelled.is_set():
+                    break
+        finally:
+            # stops the workers, dropping scans not started yet
+            results.close()
+    return exported, failures
@@ -0,0 +1,99 @@
+import getopt
+import json
+import pickle
+import statistics
+import sys
+import time
+import numpy as np
+import array_codec
+from benchmarks import synthetic_data
+
+USAGE = (f"Usage: python -m benchmarks.codec_benchmark [--help] | [-r <n>] [--repeats <n>] [-o <file>] "
+         f"[--output <file>]")
+
+# (energies, rows, columns) of the stacks encoded
+SHAPES = [(1, 250, 250), (1, 1000, 1000), (50, 250, 250)]
+# detector counts are stored as integers or floats depending on the beamline software
+DTYPES = ["float64", "int32"]
+
+
+def encoders():
+    '''
+    Gets the serializations compared: the pickle earlier versions stored and each array_codec compression
+    :return: the encode and decode functions by label, as a dictionary of tuples
+    '''
+    codecs = {"pickle": (lambda data: pickle.dumps(data, protocol=2), pickle.loads)}
+    for compression in ["auto"] + array_codec.available_compressions():
+        codecs[compression] = (lambda data, compression=compression: array_codec.encode(data, compression),
+                               array_codec.decode)
+    return codecs
+
+
+def time_decode(decode, buffer, repeats):
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        decode(buffer)
+        times.append((time.perf_counter() - start) * 1000)
+    return statistics.median(times)
+
+
+def run(repeats):
+    '''
+    Encodes synthetic stacks of each shape and dtype every way, measuring the size and decode time
+    :param repeats: the number of timed decodes per encoding, as an integer
+    :return: the results, as a list of dictionaries
+    '''
+    rng = np.random.default_rng(0)
+    results = []
+    for shape in SHAPES:
+        frames = synthetic_data.synthetic_frames(rng, shape[1:], shape[0])
+        for dtype in DTYPES:
+            data = frames.astype(dtype)
+            for label, (encode, decode) in encoders().items():
+                start = time.perf_counter()
+                buffer = encode(data)
+                encode_ms = (time.perf_counter() - start) * 1000
+                if not np.array_equal(decode(buffer), data):
+                    raise AssertionError(f"{label} did not round trip {dtype} {shape}")
+
+                result = {"shape": list(shape), "dtype": dtype, "encoding": label,
+                          "megabytes": round(len(buffer) / 2 ** 20, 3),
+                          "ratio": round(len(buffer) / data.nbytes, 3),
+                          "encode_ms": round(encode_ms, 3),
+                          "decode_ms": round(time_decode(decode, buffer, repeats), 3)}
+                results.append(result)
+                print(f"{str(shape):<16} {dtype:<8} {label:<7} {result['megabytes']:>9.3f} MB "
+                      f"({result['ratio']:.2f})  encode {result['encode_ms']:>9.3f} ms  "
+                      f"decode {result['decode_ms']:>9.3f} ms")
+    return results
+
+
+def main():
+    try:
+        options, arguments = getopt.getopt(sys.argv[1:], "hr:o:", ["help", "repeats=", "output="])
+    except getopt.GetoptError as err:
+        print(err)
+        print(USAGE)
+        sys.exit()
+
+    repeats = 20
+    output = ""
+    for o, a in options:
+        if o in ("-h", "--help"):
+            print(USAGE)
+            sys.exit()
+        if o in ("-r", "--repeats"):
+            repeats = int(a)
+        if o in ("-o", "--output"):
+            output = a
+
+    results = run(repeats)
+
+    if output != "":
+        with open(output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
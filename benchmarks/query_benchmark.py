@@ -0,0 +1,215 @@
+import getopt
+import json
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+import catalog
+import catalog_query
+import sqlite_catalog
+
+USAGE = (f"Usage: python -m benchmarks.query_benchmark [--help] | [-u <uri>] [--uri <uri>] [--force] "
+         f"[-s <n,n,...>] [--sizes <n,n,...>] [-r <n>] [--repeats <n>] [-o <file>] [--output <file>]")
+
+SIZES = [10000, 100000, 1000000]
+RESOLUTIONS = [50, 100, 150, 200, 250, 300, 500, 1000, 2000]
+# directory of the synthetic entries, which tells them apart from real scans
+DIRECTORY = "/synthetic"
+
+# representative filter_data and display_hdf queries
+QUERIES = {
+    "name lookup": lambda: {"name": "scan_00004321.hdf5"},
+    "scan type": lambda: catalog_query.build_query(scan_type="sample image stack"),
+    "scan type + dates": lambda: catalog_query.build_query(scan_type="sample image", start_time=202103010000,
+                                                           end_time=202103312359),
+    "date range": lambda: catalog_query.build_query(start_time=202206010000, end_time=202206072359),
+    "energy range": lambda: catalog_query.build_query(energy_min=700, energy_max=710),
+    "resolution": lambda: catalog_query.build_query(xresolution=150, yresolution=150),
+    "all filters": lambda: catalog_query.build_query(scan_type="sample image", start_time=202101010000,
+                                                     end_time=202212312359, xresolution=100, yresolution=100,
+                                                     energy_min=280, energy_max=320),
+}
+
+
+def synthetic_entries(count, seed=0):
+    '''
+    Generates catalog entries with realistic metadata and no pixel data
+    :param count: the number of entries, as an integer
+    :param seed: the random seed, as an integer
+    :return: a generator of entries, as dictionaries
+    '''
+    rng = random.Random(seed)
+    for index in range(count):
+        start = (2019 + rng.randrange(5)) * 100000000 + (1 + rng.randrange(12)) * 1000000 \
+            + (1 + rng.randrange(28)) * 10000 + rng.randrange(24) * 100 + rng.randrange(60)
+        res = rng.choice(RESOLUTIONS)
+        energy = rng.choice([280, 520, 700, 850])
+        yield {"name": f"scan_{index:08d}.hdf5",
+               "directory": DIRECTORY,
+               "file_path": f"{DIRECTORY}/scan_{index:08d}.hdf5",
+               "scan_type": rng.choice(catalog_query.SCAN_TYPES),
+               "start_time": start,
+               "end_time": start + rng.randrange(1, 59),
+               "xrange": rng.randrange(1, 100),
+               "yrange": rng.randrange(1, 100),
+               "xresolution": res,
+               "yresolution": res,
+               "energy_min": energy + rng.randrange(5),
+               "energy_max": energy + rng.randrange(5, 40)}
+
+
+def is_scratch(collection):
+    '''
+    Tells whether a collection can be dropped, holding nothing but the synthetic entries of earlier runs
+    :param collection: the database collection
+    :return: whether it is empty or only holds synthetic entries, as a boolean
+    '''
+    return collection.count_documents({"directory": {"$ne": DIRECTORY}}, limit=1) == 0
+
+
+def populate(collection, size):
+    '''
+    Fills a collection with synthetic entries, replacing what was there
+    :param collection: the database collection
+    :param size: the number of entries, as an integer
+    '''
+    collection.drop()
+    batch = []
+    for entry in synthetic_entries(size):
+        batch.append(entry)
+        if len(batch) == 10000:
+            collection.insert_many(batch, ordered=False)
+            batch = []
+    if batch:
+        collection.insert_many(batch, ordered=False)
+
+
+def explain(collection, query):
+    '''
+    Gets how the database executes a listing query
+    :param collection: the database collection
+    :param query: the query, as a dictionary
+    :return: the plan summary, as a dictionary, or None if the backend cannot explain queries
+    '''
+    if isinstance(collection, sqlite_catalog.SQLiteCollection):
+        result = collection.explain_query(query)
+        return {"plan": " <- ".join(result["plan"]),
+                "index_used": not result["unindexed"] and any("USING" in step for step in result["plan"])}
+
+    try:
+        result = collection.database.command("explain", {"find": collection.name, "filter": query,
+                                                         "projection": {"name": 1}},
+                                             verbosity="executionStats")
+    except Exception as e:
+        return None
+
+    # walk down the winning plan to the stage that reads the data
+    stage = result["queryPlanner"]["winningPlan"]
+    stages = []
+    while stage is not None:
+        stages.append(stage["stage"] + (f"({stage['indexName']})" if "indexName" in stage else ""))
+        stage = stage.get("inputStage")
+
+    stats = result["executionStats"]
+    return {"plan": " <- ".join(stages),
+            "index_used": any(s.startswith("IXSCAN") or s.startswith("IDHACK") for s in stages),
+            "keys_examined": stats["totalKeysExamined"],
+            "docs_examined": stats["totalDocsExamined"],
+            "returned": stats["nReturned"]}
+
+
+def time_query(collection, query, repeats):
+    '''
+    Times a listing query the way the file list runs it, fetching names only
+    :param collection: the database collection
+    :param query: the query, as a dictionary
+    :param repeats: the number of timed runs, as an integer
+    :return: the median latency, in milliseconds
+    '''
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        list(collection.find(query, {"name": 1}))
+        times.append((time.perf_counter() - start) * 1000)
+    return statistics.median(times)
+
+
+def run(collection, sizes, repeats):
+    '''
+    Benchmarks every query at every catalog size, without and then with indexes
+    :param collection: a scratch database collection, which is dropped
+    :param sizes: the catalog sizes, as a list of integers
+    :param repeats: the number of timed runs per query, as an integer
+    :return: the results, as a list of dictionaries
+    '''
+    results = []
+    for size in sizes:
+        populate(collection, size)
+        for indexed in (False, True):
+            if indexed:
+                catalog_query.ensure_indexes(collection)
+            for label, make_query in QUERIES.items():
+                query = make_query()
+                result = {"size": size, "indexed": indexed, "query": label,
+                          "latency_ms": round(time_query(collection, query, repeats), 3)}
+                result.update(explain(collection, query) or {})
+                results.append(result)
+                print(f"{size:>8} {'indexed' if indexed else 'no index':<9} {label:<18} "
+                      f"{result['latency_ms']:>10.3f} ms  {result.get('plan', '')}")
+    collection.drop()
+    return results
+
+
+def main():
+    try:
+        options, arguments = getopt.getopt(sys.argv[1:], "hu:s:r:o:",
+                                           ["help", "uri=", "force", "sizes=", "repeats=", "output="])
+    except getopt.GetoptError as err:
+        print(err)
+        print(USAGE)
+        sys.exit()
+
+    # a SQLite file in a temporary directory by default, as the catalog is dropped
+    uri = ""
+    force = False
+    sizes = SIZES
+    repeats = 5
+    output = ""
+    for o, a in options:
+        if o in ("-h", "--help"):
+            print(USAGE)
+            sys.exit()
+        if o in ("-u", "--uri"):
+            uri = a
+        if o == "--force":
+            # drop the catalog even if it holds real scans
+            force = True
+        if o in ("-s", "--sizes"):
+            sizes = [int(size) for size in a.split(",")]
+        if o in ("-r", "--repeats"):
+            repeats = int(a)
+        if o in ("-o", "--output"):
+            output = a
+
+    if uri == "":
+        with tempfile.TemporaryDirectory() as scratch:
+            collection = catalog.open_catalog(f"sqlite://{os.path.join(scratch, 'catalog.db')}")
+            results = run(collection, sizes, repeats)
+            collection.database.close()
+    else:
+        collection = catalog.open_catalog(uri, database="STXM_data_viewer_benchmark")
+        if not force and not is_scratch(collection):
+            print(f"The catalog at {uri} holds scans that are not from this benchmark and would be dropped, "
+                  f"pass --force to drop it anyway")
+            raise SystemExit(USAGE)
+        results = run(collection, sizes, repeats)
+
+    if output != "":
+        with open(output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,333 @@
+import getopt
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+import h5py
+import numpy as np
+import catalog
+import catalog_query
+import data_store
+import intensity
+import prepare_database
+import rendering
+from ingest_stats import IngestStats
+from benchmarks import synthetic_data
+
+USAGE = (f"Usage: python -m benchmarks.suite [--help] | [-u <uri>] [--uri <uri>] [-d <dir>] [--directory <dir>] "
+         f"[-n <n>] [--files <n>] [-t <type,type,...>] [--scan-types <type,type,...>] [-r <n,n,...>] "
+         f"[--resolutions <n,n,...>] [-e <n,n,...>] [--energies <n,n,...>] [-m <mode>] [--storage <mode>] "
+         f"[-w <n>] [--workers <n>] [--repeats <n>] [-o <file>] [--output <file>]")
+
+# the catalog is rebuilt from scratch, so the default is an in-memory stand-in rather than a real server
+URI = "mongomock://"
+REPEATS = 5
+# edge length of the viewer's image label, which picks the pyramid level displayed
+DISPLAY_SIZE = 630
+# share of the files marked as changed before timing a sync
+SYNC_CHANGED = 0.1
+
+
+class NoProgress:
+    def emit(self, progress):
+        pass
+
+
+def summarize(times):
+    '''
+    Reduces repeated timings to the figures tracked between runs
+    :param times: the timings, in seconds, as a list of floats
+    :return: the median, 95th percentile, fastest and slowest times, in milliseconds, and the run count,
+    as a dictionary
+    '''
+    ms = sorted(t * 1000 for t in times)
+    return {"median_ms": round(statistics.median(ms), 3),
+            "p95_ms": round(ms[min(len(ms) - 1, int(round(0.95 * (len(ms) - 1))))], 3),
+            "min_ms": round(ms[0], 3),
+            "max_ms": round(ms[-1], 3),
+            "runs": len(ms)}
+
+
+def bench_ingest(collection, directory, workers, storage):
+    '''
+    Times prepare_database building the catalog from a directory
+    :param collection: the database collection, which is cleared
+    :param directory: the directory of HDF5 files, as a string
+    :param workers: the number of worker processes reading files, as an integer
+    :param storage: where pixel data is kept, one of data_store.STORAGE_MODES
+    :return: the duration, file counts, throughput and time per phase, as a dictionary
+    '''
+    stats = IngestStats()
+    prepare_database.prepare_database(collection, directory, NoProgress(), workers=workers, storage=storage,
+                                      stats=stats)
+    summary = stats.summary()
+    summary["skipped"] = len(summary["skipped"])
+    summary["failed"] = len(summary["failed"])
+    return summary
+
+
+def bench_sync(collection, directory, workers, storage, changed=SYNC_CHANGED):
+    '''
+    Times sync_database on the built catalog, first with nothing changed, then with a share of the entries marked as
+    out of date. The files themselves are left alone: their entries get a modification time the files do not have.
+    :param collection: the database collection, built from the directory
+    :param directory: the directory of HDF5 files, as a string
+    :param workers: the number of worker processes reading files, as an integer
+    :param storage: where pixel data is kept, one of data_store.STORAGE_MODES
+    :param changed: the share of the entries marked as changed, as a float
+    :return: the duration of the sync with nothing changed, and the duration, files read and left alone and time per
+    phase of the other, as a dictionary
+    '''
+    start = time.perf_counter()
+    prepare_database.sync_database(collection, directory, NoProgress(), workers=workers, storage=storage)
+    unchanged = time.perf_counter() - start
+
+    files = sorted(item["file_path"] for item in collection.find({}, {"file_path": 1}))
+    stale = files[::max(1, round(1 / changed))] if changed > 0 else []
+    for file in stale:
+        collection.update_one({"file_path": file}, {"$set": {"file_mtime": 0}})
+
+    stats = IngestStats()
+    prepare_database.sync_database(collection, directory, NoProgress(), workers=workers, storage=storage,
+                                   stats=stats)
+    summary = stats.summary()
+    return {"entries": len(files),
+            "unchanged_s": round(unchanged, 3),
+            "changed": len(stale),
+            "seconds": summary["seconds"],
+            "read": summary["files"],
+            "unchanged": summary["unchanged"],
+            "phase_seconds": summary["phase_seconds"]}
+
+
+def bench_startup(collection, repeats):
+    '''
+    Times the catalog work the viewer does at launch: creating indexes, checking for a database and listing the
+    first page of files
+    :param collection: the database collection
+    :param repeats: the number of timed runs, as an integer
+    :return: the timings, as a dictionary
+    '''
+    # Qt is only needed for the list model, not for an application or a display
+    from file_list_model import FileListModel
+
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        catalog_query.ensure_indexes(collection)
+        collection.find_one({}, {"directory": 1})
+        model = FileListModel()
+        model.set_query(collection, {})
+        times.append(time.perf_counter() - start)
+    return summarize(times)
+
+
+def filter_queries(scan_types, resolutions):
+    '''
+    Builds filter_data queries matching some of the generated files
+    :param scan_types: the scan types generated, as a list of strings
+    :param resolutions: the resolutions generated, as a list of integers
+    :return: the queries by label, as a dictionary
+    '''
+    return {"scan type": catalog_query.build_query(scan_type=scan_types[0]),
+            "date range": catalog_query.build_query(start_time=202101010000, end_time=202101072359),
+            "resolution": catalog_query.build_query(xresolution=resolutions[0], yresolution=resolutions[0]),
+            "energy range": catalog_query.build_query(energy_min=690, energy_max=730),
+            # synthetic frames peak near 1000 counts plus noise
+            "intensity": catalog_query.build_query(peak_min=1040),
+            "all filters": catalog_query.build_query(scan_type=scan_types[0], start_time=202101010000,
+                                                     end_time=202112312359, xresolution=resolutions[0],
+                                                     yresolution=resolutions[0])}
+
+
+def bench_filters(collection, queries, repeats):
+    '''
+    Times filter queries the way filter_data runs them, listing the first page of matching names
+    :param collection: the database collection
+    :param queries: the queries by label, as a dictionary
+    :param repeats: the number of timed runs per query, as an integer
+    :return: the timings and match counts by label, as a dictionary
+    '''
+    from file_list_model import FileListModel
+
+    results = {}
+    for label, query in queries.items():
+        times = []
+        model = FileListModel()
+        for _ in range(repeats):
+            start = time.perf_counter()
+            model.set_query(collection, query)
+            times.append(time.perf_counter() - start)
+        results[label] = summarize(times)
+        results[label]["matches"] = collection.count_documents(query)
+    return results
+
+
+def bench_render(collection, names, repeats, size=DISPLAY_SIZE):
+    '''
+    Times display_hdf for a few files: the thumbnail shown first, then the full view with its lookup, read,
+    contrast mapping and conversion to a QImage
+    :param collection: the database collection
+    :param names: the file names to display, as a list of strings
+    :param repeats: the number of timed runs per file, as an integer
+    :param size: the edge length of the display, in pixels
+    :return: the thumbnail and view timings, as a dictionary
+    '''
+    thumbnail_times = []
+    view_times = []
+    for _ in range(repeats):
+        for name in names:
+            start = time.perf_counter()
+            entry = collection.find_one({"name": name}, {"data": 0})
+            # contrast limits stored at ingest, converted to grey levels for the 8 bit previews
+            limits = intensity.contrast_limits(entry) or (None, None)
+            preview = (intensity.preview_limits(entry, *limits) if limits[0] is not None else None) or (None, None)
+            thumbnail = data_store.load_thumbnail(entry)
+            if thumbnail is not None:
+                rendering.to_qimage(rendering.to_uint8(thumbnail, *preview))
+            thumbnail_times.append(time.perf_counter() - start)
+
+            start = time.perf_counter()
+            image = data_store.load_view(collection, entry, size)
+            rendering.to_qimage(rendering.to_uint8(image, *(preview if "pyramid" in entry else limits)))
+            view_times.append(time.perf_counter() - start)
+    return {"thumbnail": summarize(thumbnail_times), "view": summarize(view_times)}
+
+
+def environment(uri, storage, workers, config):
+    '''
+    Describes what a run measured, so results from different machines and settings can be told apart
+    :param uri: the database URI, as a string
+    :param storage: where pixel data is kept, as a string
+    :param workers: the number of worker processes reading files, as an integer
+    :param config: the synthetic_data.generate keyword arguments, as a dictionary
+    :return: the description, as a dictionary
+    '''
+    return {"uri": uri.split("@")[-1],
+            "storage": storage,
+            "workers": workers,
+            "data": config,
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "numpy": np.__version__,
+            "h5py": h5py.__version__,
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S")}
+
+
+def run(uri, directory, config, storage=data_store.DEFAULT_STORAGE, workers=1, repeats=REPEATS):
+    '''
+    Generates synthetic scans if the directory has none, then benchmarks ingest, sync, startup, filtering and display
+    :param uri: the database URI, as a string. The catalog is cleared.
+    :param directory: the directory of HDF5 files, as a string
+    :param config: the synthetic_data.generate keyword arguments, as a dictionary
+    :param storage: where pixel data is kept, one of data_store.STORAGE_MODES
+    :param workers: the number of worker processes reading files, as an integer
+    :param repeats: the number of timed runs of each query and render, as an integer
+    :return: the results, as a dictionary
+    '''
+    if not prepare_database.find_files(directory):
+        print(f"Generating {config.get('files', synthetic_data.FILES)} files in {directory}")
+        synthetic_data.generate(directory, **config)
+
+    collection = catalog.open_catalog(uri, database="STXM_data_viewer_benchmark")
+    results = {"environment": environment(uri, storage, workers, config)}
+
+    results["ingest"] = bench_ingest(collection, directory, workers, storage)
+    print(f"ingest   {results['ingest']['files']} files in {results['ingest']['seconds']} s, "
+          f"{results['ingest']['files_per_s']} files/s, {results['ingest']['mb_per_s']} MB/s")
+
+    results["sync"] = bench_sync(collection, directory, workers, storage)
+    print(f"sync     {results['sync']['unchanged_s']} s unchanged, {results['sync']['seconds']} s with "
+          f"{results['sync']['changed']} of {results['sync']['entries']} files changed")
+
+    results["startup"] = bench_startup(collection, repeats)
+    print(f"startup  {results['startup']['median_ms']} ms")
+
+    queries = filter_queries(config.get("scan_types", synthetic_data.SCAN_TYPES),
+                             config.get("resolutions", synthetic_data.RESOLUTIONS))
+    results["filter"] = bench_filters(collection, queries, repeats)
+    for label, result in results["filter"].items():
+        print(f"filter   {label:<13} {result['median_ms']:>9.3f} ms  {result['matches']} matches")
+
+    names = [item["name"] for item in collection.find({}, {"name": 1}).sort("_id", 1).limit(5)]
+    results["render"] = bench_render(collection, names, repeats)
+    print(f"render   thumbnail {results['render']['thumbnail']['median_ms']} ms, "
+          f"view {results['render']['view']['median_ms']} ms")
+
+    data_store.clear(collection)
+    return results
+
+
+def main():
+    try:
+        options, arguments = getopt.getopt(sys.argv[1:], "hu:d:n:t:r:e:m:w:o:",
+                                           ["help", "uri=", "directory=", "files=", "scan-types=", "resolutions=",
+                                            "energies=", "storage=", "workers=", "repeats=", "output="])
+    except getopt.GetoptError as err:
+        print(err)
+        print(USAGE)
+        sys.exit()
+
+    uri = URI
+    directory = ""
+    config = {}
+    storage = data_store.DEFAULT_STORAGE
+    workers = 1
+    repeats = REPEATS
+    output = ""
+    try:
+        for o, a in options:
+            if o in ("-h", "--help"):
+                print(USAGE)
+                sys.exit()
+            if o in ("-u", "--uri"):
+                uri = a
+            if o in ("-d", "--directory"):
+                directory = a
+            if o in ("-n", "--files"):
+                config["files"] = int(a)
+            if o in ("-t", "--scan-types"):
+                config["scan_types"] = synthetic_data.parse_list(a, str)
+            if o in ("-r", "--resolutions"):
+                config["resolutions"] = synthetic_data.parse_list(a)
+            if o in ("-e", "--energies"):
+                config["energy_counts"] = synthetic_data.parse_list(a)
+            if o in ("-m", "--storage"):
+                if a not in data_store.STORAGE_MODES:
+                    raise ValueError(f"Storage must be one of {', '.join(data_store.STORAGE_MODES)}")
+                storage = a
+            if o in ("-w", "--workers"):
+                workers = int(a)
+                if workers <= 0:
+                    workers = os.cpu_count() or 1
+            if o == "--repeats":
+                repeats = int(a)
+            if o in ("-o", "--output"):
+                output = a
+    except ValueError as err:
+        print(err)
+        raise SystemExit(USAGE)
+
+    if arguments:
+        raise SystemExit(USAGE)
+
+    if directory == "":
+        with tempfile.TemporaryDirectory() as scratch:
+            results = run(uri, scratch, config, storage, workers, repeats)
+    else:
+        results = run(uri, directory, config, storage, workers, repeats)
+
+    if output != "":
+        with open(output, "w") as f:
+            json.dump(results, f, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+
+
+if __name__ == "__main__":
+    main()
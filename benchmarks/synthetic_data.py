@@ -0,0 +1,145 @@
+import getopt
+import os
+import random
+import sys
+import h5py
+import numpy as np
+
+USAGE = (f"Usage: python -m benchmarks.synthetic_data [--help] | -d <dir> [--directory <dir>] [-n <n>] [--files <n>] "
+         f"[-t <type,type,...>] [--scan-types <type,type,...>] [-r <n,n,...>] [--resolutions <n,n,...>] "
+         f"[-e <n,n,...>] [--energies <n,n,...>] [--seed <n>]")
+
+FILES = 100
+SCAN_TYPES = ["sample image", "sample image stack", "osa image", "detector image"]
+RESOLUTIONS = [100, 250, 500]
+ENERGY_COUNTS = [1]
+# absorption edges scans are centred on, in eV
+EDGES = [285, 530, 708, 853]
+
+
+def synthetic_frames(rng, shape, count):
+    '''
+    Makes a stack of frames with smooth features whose contrast changes with energy, plus noise
+    :param rng: the random generator, as a numpy Generator
+    :param shape: the frame shape, as a (rows, columns) tuple
+    :param count: the number of frames, as an integer
+    :return: the frames, as a 3D float64 numpy array
+    '''
+    rows, cols = shape
+    y = np.linspace(-1.0, 1.0, rows, dtype=np.float64)[:, np.newaxis]
+    x = np.linspace(-1.0, 1.0, cols, dtype=np.float64)[np.newaxis, :]
+    sample = np.zeros(shape)
+    for _ in range(5):
+        cy, cx = rng.uniform(-0.8, 0.8, 2)
+        width = rng.uniform(0.05, 0.3)
+        sample += np.exp(-((y - cy) ** 2 + (x - cx) ** 2) / (2 * width ** 2))
+
+    absorption = np.linspace(0.5, 1.5, count)
+    frames = 1000.0 * np.exp(-sample[np.newaxis] * absorption[:, np.newaxis, np.newaxis])
+    frames += rng.normal(0.0, 10.0, frames.shape)
+    return frames
+
+
+def write_scan(file, rng, scan_type, resolution, energies, start):
+    '''
+    Writes one scan in the entry0/counter0 layout that prepare_database reads
+    :param file: the full filepath of the new file, as a string
+    :param rng: the random generator, as a numpy Generator
+    :param scan_type: the scan type, as a string
+    :param resolution: the number of points along x and y, as an integer
+    :param energies: the number of energies (frames), as an integer
+    :param start: the start time, as a string in the form "YYYY-MM-DDTHH:MM:SS"
+    '''
+    edge = EDGES[int(rng.integers(len(EDGES)))]
+    span = float(rng.uniform(10.0, 50.0))
+    with h5py.File(file, "w") as f:
+        entry = f.create_group("entry0")
+        counter = entry.create_group("counter0")
+        counter["data"] = synthetic_frames(rng, (resolution, resolution), energies)
+        counter["stxm_scan_type"] = np.bytes_(scan_type)
+        counter["sample_x"] = np.linspace(0.0, float(rng.uniform(5.0, 100.0)), resolution)
+        counter["sample_y"] = np.linspace(0.0, float(rng.uniform(5.0, 100.0)), resolution)
+        counter["energy"] = np.linspace(edge - span / 2, edge + span / 2, energies) if energies > 1 \
+            else np.array([float(edge)])
+        entry["start_time"] = np.bytes_(start)
+        entry["end_time"] = np.bytes_(start[:14] + "59:59")
+
+
+def generate(directory, files=FILES, scan_types=SCAN_TYPES, resolutions=RESOLUTIONS, energy_counts=ENERGY_COUNTS,
+             seed=0):
+    '''
+    Fills a directory with synthetic STXM scans, cycling through the scan types and picking resolutions and energy
+    counts at random
+    :param directory: the directory to write to, created if needed, as a string
+    :param files: the number of files, as an integer
+    :param scan_types: the scan types to use, as a list of strings
+    :param resolutions: the resolutions to pick from, as a list of integers
+    :param energy_counts: the numbers of energies to pick from, as a list of integers
+    :param seed: the random seed, as an integer
+    :return: the full filepaths of the files written, as a list of strings
+    '''
+    os.makedirs(directory, exist_ok=True)
+    picker = random.Random(seed)
+    rng = np.random.default_rng(seed)
+
+    file_paths = []
+    for index in range(files):
+        # one scan an hour from the start of 2021
+        day, hour = divmod(index, 24)
+        month, day = divmod(day, 28)
+        year, month = divmod(month, 12)
+        start = f"{2021 + year:04d}-{month + 1:02d}-{day + 1:02d}T{hour:02d}:00:00"
+
+        file = os.path.join(directory, f"synthetic_{index:06d}.hdf5")
+        write_scan(file, rng, scan_types[index % len(scan_types)], picker.choice(resolutions),
+                   picker.choice(energy_counts), start)
+        file_paths.append(file)
+    return file_paths
+
+
+def parse_list(text, kind=int):
+    return [kind(item) for item in text.split(",") if item != ""]
+
+
+def main():
+    try:
+        options, arguments = getopt.getopt(sys.argv[1:], "hd:n:t:r:e:",
+                                           ["help", "directory=", "files=", "scan-types=", "resolutions=",
+                                            "energies=", "seed="])
+    except getopt.GetoptError as err:
+        print(err)
+        print(USAGE)
+        sys.exit()
+
+    directory = ""
+    kwargs = {}
+    try:
+        for o, a in options:
+            if o in ("-h", "--help"):
+                print(USAGE)
+                sys.exit()
+            if o in ("-d", "--directory"):
+                directory = a
+            if o in ("-n", "--files"):
+                kwargs["files"] = int(a)
+            if o in ("-t", "--scan-types"):
+                kwargs["scan_types"] = parse_list(a, str)
+            if o in ("-r", "--resolutions"):
+                kwargs["resolutions"] = parse_list(a)
+            if o in ("-e", "--energies"):
+                kwargs["energy_counts"] = parse_list(a)
+            if o == "--seed":
+                kwargs["seed"] = int(a)
+    except ValueError as err:
+        print(err)
+        raise SystemExit(USAGE)
+
+    if directory == "" or arguments:
+        raise SystemExit(USAGE)
+
+    file_paths = generate(directory, **kwargs)
+    print(f"Wrote {len(file_paths)} files to {directory}")
+
+
+if __name__ == "__main__":
+    main()
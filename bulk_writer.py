@@ -0,0 +1,120 @@
+import bson
+from pymongo.errors import BulkWriteError
+
+# defaults for when a batch is sent to the database
+BATCH_SIZE = 500
+BATCH_BYTES = 32 * 1024 * 1024
+# largest document the database accepts
+MAX_DOCUMENT_BYTES = 16 * 1024 * 1024
+
+
+def encoded_size(value):
+    '''
+    Works out the BSON encoded size of a document without encoding it, which would copy its pixel data once more
+    before the driver encodes it again to send it
+    :param value: the document, or a value in it
+    :return: the size in bytes, as an integer
+    '''
+    if isinstance(value, dict):
+        # length, elements of a type byte, the key and its terminator, then the value, and a terminator
+        return 5 + sum(2 + len(str(key).encode()) + encoded_size(item) for key, item in value.items())
+    if isinstance(value, (list, tuple)):
+        # arrays are documents keyed by index
+        return 5 + sum(2 + len(str(index)) + encoded_size(item) for index, item in enumerate(value))
+    if isinstance(value, bytes):
+        # length and subtype, then the payload
+        return 5 + len(value)
+    if isinstance(value, str):
+        return 5 + len(value.encode())
+    if value is None:
+        return 0
+    if isinstance(value, bool):
+        return 1
+    if isinstance(value, int) and -2 ** 31 <= value < 2 ** 31:
+        return 4
+    if isinstance(value, (int, float)):
+        return 8
+    # anything else is small, encoding it alone checks the driver can
+    return len(bson.encode({"": value})) - 7
+
+
+class BulkWriter:
+    def __init__(self, collection, batch_size=BATCH_SIZE, batch_bytes=BATCH_BYTES):
+        '''
+        Creates a writer that buffers documents and inserts them in unordered batches
+        :param collection: the database collection to write to
+        :param batch_size: the number of buffered documents that triggers a write, as an integer
+        :param batch_bytes: the encoded size of buffered documents that triggers a write, as an integer
+        '''
+        self.collection = collection
+        self.batch_size = max(1, batch_size)
+        self.batch_bytes = batch_bytes
+
+        self.batch = []
+        self.nbytes = 0
+
+        # number of documents written and the documents that could not be, as (file path, reason) tuples
+        self.inserted = 0
+        self.failures = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.flush()
+
+    def insert(self, document):
+        '''
+        Buffers a document, writing the batch once it is full
+        :param document: the document to insert, as a dictionary
+        '''
+        try:
+            size = encoded_size(document)
+        except Exception as e:
+            self.fail(document, str(e))
+            return
+
+        if size > MAX_DOCUMENT_BYTES:
+            self.fail(document, f"document is {size} bytes, over the {MAX_DOCUMENT_BYTES} byte limit")
+            return
+
+        if self.batch and self.nbytes + size > self.batch_bytes:
+            self.flush()
+
+        self.batch.append(document)
+        self.nbytes += size
+
+        if len(self.batch) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        '''
+        Writes all buffered documents to the database
+        '''
+        if not self.batch:
+            return
+
+        batch = self.batch
+        self.batch = []
+        self.nbytes = 0
+
+        try:
+            result = self.collection.insert_many(batch, ordered=False)
+            self.inserted += len(result.inserted_ids)
+        except BulkWriteError as e:
+            # unordered, so everything but the reported documents was written
+            errors = e.details.get("writeErrors", [])
+            self.inserted += e.details.get("nInserted", len(batch) - len(errors))
+            for error in errors:
+                self.fail(batch[error["index"]], error.get("errmsg", "write error"))
+        except Exception as e:
+            for document in batch:
+                self.fail(document, str(e))
+
+    def fail(self, document, reason):
+        '''
+        Records a document that could not be written
+        :param document: the document, as a dictionary
+        :param reason: why it could not be written, as a string
+        '''
+        self.failures.append((document.get("file_path", document.get("name", "")), reason))
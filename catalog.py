@@ -0,0 +1,34 @@
+# catalog backends, chosen by the scheme of the database URI
+#   mongodb://host:port    a MongoDB server
+#   sqlite://path          an embedded SQLite file, e.g. sqlite:///home/me/stxm.db or sqlite://stxm.db
+#   mongomock://           an in-memory MongoDB stand-in for tests and benchmarks, needs the mongomock package
+URI = "mongodb://localhost:27017"
+DATABASE = "STXM_data_viewer"
+COLLECTION = "STXM_data"
+SCHEMES = ("mongodb://", "mongodb+srv://", "sqlite://", "mongomock://")
+
+
+def open_catalog(uri=URI, database=DATABASE, collection=COLLECTION):
+    '''
+    Connects to the catalog collection of a MongoDB server or an embedded SQLite file
+    :param uri: the database URI, as a string
+    :param database: the MongoDB database name, as a string. SQLite files hold a single database.
+    :param collection: the collection name, as a string
+    :return: the collection, as a pymongo Collection or a sqlite_catalog.SQLiteCollection
+    '''
+    # backends are imported on use, so neither needs the other installed
+    if uri.startswith("sqlite://"):
+        import sqlite_catalog
+        return sqlite_catalog.SQLiteDatabase(uri[len("sqlite://"):])[collection]
+
+    if uri.startswith(("mongodb://", "mongodb+srv://")):
+        from pymongo import MongoClient
+        return MongoClient(uri)[database][collection]
+
+    if uri.startswith("mongomock://"):
+        import mongomock
+        import mongomock.gridfs
+        mongomock.gridfs.enable_gridfs_integration()
+        return mongomock.MongoClient()[database][collection]
+
+    raise ValueError(f"Unknown database URI {uri}, expected one of {', '.join(SCHEMES)}")
@@ -0,0 +1,133 @@
+import pymongo
+
+SCAN_TYPES = ["coarse image scan", "sample image", "sample focus", "generic scan", "sample point spectrum",
+              "sample line spectrum", "sample image stack", "osa image", "osa focus", "detector image"]
+
+# indexes serving display lookups, incremental syncs and every filter, equality fields ahead of range fields
+INDEXES = [
+    [("name", pymongo.ASCENDING)],
+    [("file_path", pymongo.ASCENDING)],
+    [("scan_type", pymongo.ASCENDING), ("start_time", pymongo.ASCENDING)],
+    [("start_time", pymongo.ASCENDING), ("end_time", pymongo.ASCENDING)],
+    [("energy_min", pymongo.ASCENDING), ("energy_max", pymongo.ASCENDING)],
+    [("xresolution", pymongo.ASCENDING), ("yresolution", pymongo.ASCENDING)],
+    [("xrange", pymongo.ASCENDING), ("yrange", pymongo.ASCENDING)],
+    [("intensity_max", pymongo.ASCENDING)],
+    # finding the entries that still use a stored blob or pyramid when others are deleted
+    [("data_ref.blob_id", pymongo.ASCENDING)],
+    [("pyramid.id", pymongo.ASCENDING)],
+]
+
+# catalog fields listed by queries and exports
+FIELDS = ["name", "file_path", "scan_type", "start_time", "end_time", "xrange", "yrange", "xresolution",
+          "yresolution", "energy_min", "energy_max", "intensity_min", "intensity_max", "intensity_mean"]
+
+
+def ensure_indexes(collection):
+    '''
+    Creates the indexes used by lookups and filters, if they do not exist yet
+    :param collection: the database collection
+    '''
+    for keys in INDEXES:
+        collection.create_index(keys)
+
+
+def build_query(scan_type=None, start_time=None, end_time=None, xresolution=None, yresolution=None,
+                xrange=None, yrange=None, energy_min=None, energy_max=None, peak_min=None, peak_max=None):
+    '''
+    Builds a database query from filter values. Filters left as None are not part of the query.
+    :param scan_type: the scan type to match, as a string
+    :param start_time: the earliest start time, as an integer in the form YYYYMMDDHHMM
+    :param end_time: the latest end time, as an integer in the form YYYYMMDDHHMM
+    :param xresolution: the x resolution to match, as an integer
+    :param yresolution: the y resolution to match, as an integer
+    :param xrange: the x range to match, as an integer
+    :param yrange: the y range to match, as an integer
+    :param energy_min: the lowest energy a scan may start at, as an integer in eV
+    :param energy_max: the highest energy a scan may end at, as an integer in eV
+    :param peak_min: the lowest maximum intensity a scan may have, as a number, e.g. to leave out empty scans
+    :param peak_max: the highest maximum intensity a scan may have, as a number, e.g. to leave out saturated scans
+    :return: the query, as a dictionary
+    '''
+    query = {}
+
+    # equality predicates
+    for field, value in (("scan_type", scan_type), ("xresolution", xresolution), ("yresolution", yresolution),
+                         ("xrange", xrange), ("yrange", yrange)):
+        if value is not None:
+            query[field] = value
+
+    # range predicates
+    if start_time is not None:
+        query["start_time"] = {"$gte": start_time}
+    if end_time is not None:
+        query["end_time"] = {"$lte": end_time}
+    if energy_min is not None:
+        query["energy_min"] = {"$gte": energy_min}
+    if energy_max is not None:
+        query["energy_max"] = {"$lte": energy_max}
+    if peak_min is not None:
+        query["intensity_max"] = {"$gte": peak_min}
+    if peak_max is not None:
+        query.setdefault("intensity_max", {})["$lte"] = peak_max
+
+    return query
+
+
+def get_field(document, field):
+    '''
+    Gets a field of a document, following dotted paths into embedded documents
+    :param document: the document, as a dictionary
+    :param field: the field name, as a string such as "data_ref.storage"
+    :return: the value, or None if the field is missing
+    '''
+    value = document
+    for part in field.split("."):
+        if not isinstance(value, dict) or part not in value:
+            return None
+        value = value[part]
+    return value
+
+
+def _compare(op, value, operand):
+    if op == "$eq":
+        return value == operand
+    if op == "$ne":
+        return value != operand
+    if op == "$in":
+        return value in operand
+    if op == "$nin":
+        return value not in operand
+    if value is None:
+        return False
+    try:
+        if op == "$gt":
+            return value > operand
+        if op == "$gte":
+            return value >= operand
+        if op == "$lt":
+            return value < operand
+        if op == "$lte":
+            return value <= operand
+    except TypeError:
+        # values of different types never match, as in MongoDB
+        return False
+    raise ValueError(f"Unsupported query operator {op}")
+
+
+def matches(query, document):
+    '''
+    Checks a document against a query without the database, supporting the equality and comparison predicates
+    build_query makes plus $ne, $in and $nin
+    :param query: the query, as a dictionary
+    :param document: the document, as a dictionary
+    :return: whether the document matches, as a boolean
+    '''
+    for field, condition in query.items():
+        value = get_field(document, field)
+        if isinstance(condition, dict) and condition and all(op.startswith("$") for op in condition):
+            if not all(_compare(op, value, operand) for op, operand in condition.items()):
+                return False
+        elif value != condition:
+            return False
+    return True
@@ -0,0 +1,224 @@
+from PyQt5 import QtGui
+from PyQt5.QtCore import QIdentityProxyModel, QObject, QRunnable, QSize, Qt, QTimer, pyqtSignal
+from PyQt5.QtWidgets import QListView, QVBoxLayout, QWidget
+import data_store
+import rendering
+from file_list_model import PLACEHOLDER
+from frame_cache import FrameCache
+
+# memory budget for decoded thumbnails, about 4000 of the largest size
+CACHE_BYTES = 64 * 1024 * 1024
+# most thumbnails fetched by one query
+BATCH_SIZE = 50
+# pixels around each thumbnail in the grid, leaving room for the name
+TILE_SIZE = QSize(150, 160)
+ICON_SIZE = QSize(128, 128)
+
+
+class ThumbnailSignals(QObject):
+    # generation, the names asked for and the decoded thumbnails by name
+    loaded = pyqtSignal(int, object, object)
+
+
+class ThumbnailLoader(QRunnable):
+    def __init__(self, collection, names, generation, is_wanted, signals):
+        '''
+        Fetches and decodes a batch of thumbnails on a threadpool
+        :param collection: the database collection
+        :param names: the file names, as a list of strings
+        :param generation: the file list the names belong to, as an integer
+        :param is_wanted: tells whether a name is still in view, as a function of a string returning a boolean.
+        Names scrolled out of view by the time they are reached are left out.
+        :param signals: the signals to report the thumbnails with, as a ThumbnailSignals
+        '''
+        super(ThumbnailLoader, self).__init__()
+        self.collection = collection
+        self.names = names
+        self.generation = generation
+        self.is_wanted = is_wanted
+        self.signals = signals
+
+    def run(self):
+        # None for files without a thumbnail, names left out were skipped
+        images = {}
+        names = [name for name in self.names if self.is_wanted(name)]
+        try:
+            if names:
+                # one indexed query for the batch, fetching only the thumbnails
+                for entry in self.collection.find({"name": {"$in": names}},
+                                                  {"name": 1, "thumbnail": 1, "thumbnail_shape": 1}):
+                    if not self.is_wanted(entry["name"]):
+                        continue
+                    thumbnail = data_store.load_thumbnail(entry)
+                    # QImages, unlike QPixmaps, can be made off the GUI thread
+                    images[entry["name"]] = rendering.to_qimage(thumbnail) if thumbnail is not None else None
+                images.update((name, None) for name in names if name not in images and self.is_wanted(name))
+        finally:
+            self.signals.loaded.emit(self.generation, self.names, images)
+
+
+class ContactSheetModel(QIdentityProxyModel):
+    def __init__(self, source, threadpool, cache_bytes=CACHE_BYTES, parent=None):
+        '''
+        Adds thumbnails to a file list as the decoration of each name. Thumbnails are only loaded once a view asks for
+        them, i.e. once they are visible, a batch at a time on the threadpool, and kept in a bounded cache.
+        :param source: the file list, as a FileListModel
+        :param threadpool: the threadpool thumbnails are loaded on, as a QThreadPool
+        :param cache_bytes: the memory budget of decoded thumbnails, as an integer number of bytes
+        :param parent: the parent object, as a QObject
+        '''
+        super(ContactSheetModel, self).__init__(parent)
+        self.setSourceModel(source)
+        self.threadpool = threadpool
+        self.cache = FrameCache(cache_bytes)
+
+        # names asked for since the last scroll, names waiting for a batch and names in a running batch
+        self.wanted = set()
+        self.pending = []
+        self.in_flight = set()
+        # files without a thumbnail, e.g. catalogued before thumbnails were stored
+        self.missing = set()
+        self.generation = 0
+
+        self.placeholder = QtGui.QPixmap(ICON_SIZE)
+        self.placeholder.fill(Qt.lightGray)
+
+        self.signals = ThumbnailSignals()
+        self.signals.loaded.connect(self.thumbnails_loaded)
+        self.flushTimer = QTimer(self)
+        self.flushTimer.setSingleShot(True)
+        self.flushTimer.timeout.connect(self.flush)
+        source.modelReset.connect(self.reset_requests)
+
+    def reset_requests(self):
+        '''
+        Forgets the thumbnails asked for by a file list that has been replaced
+        '''
+        self.generation += 1
+        self.wanted = set()
+        self.pending = []
+        self.in_flight = set()
+        self.missing = set()
+
+    def cancel_hidden(self):
+        '''
+        Cancels the thumbnails not loaded yet, e.g. after a scroll. The view asks again for those still visible
+        when it repaints.
+        '''
+        self.wanted = set()
+        self.pending = []
+
+    def data(self, index, role=Qt.DisplayRole):
+        if role != Qt.DecorationRole or not index.isValid():
+            return super(ContactSheetModel, self).data(index, role)
+
+        name = self.sourceModel().names[index.row()]
+        if name == PLACEHOLDER:
+            return None
+        image = self.cache.get(name)
+        if image is not None:
+            return image
+        if name not in self.missing:
+            self.request(name)
+        return self.placeholder
+
+    def request(self, name):
+        if name in self.wanted:
+            return
+        self.wanted.add(name)
+        if name not in self.in_flight:
+            self.pending.append(name)
+            if not self.flushTimer.isActive():
+                # batch the names asked for during one paint
+                self.flushTimer.start(0)
+
+    def flush(self):
+        '''
+        Starts loading the thumbnails asked for, a batch per threadpool task
+        '''
+        collection = self.sourceModel().collection
+        if collection is None:
+            return
+        pending, self.pending = self.pending, []
+        for start in range(0, len(pending), BATCH_SIZE):
+            batch = pending[start:start + BATCH_SIZE]
+            self.in_flight.update(batch)
+            # looked up on the model each time, as cancel_hidden replaces the set
+            self.threadpool.start(ThumbnailLoader(collection, batch, self.generation,
+                                                  lambda name: name in self.wanted, self.signals))
+
+    def thumbnails_loaded(self, generation, names, images):
+        if generation != self.generation:
+            return
+        self.in_flight.difference_update(names)
+
+        for name, image in images.items():
+            self.wanted.discard(name)
+            if image is None:
+                self.missing.add(name)
+            else:
+                self.cache.put(name, image, image.sizeInBytes())
+
+        # files skipped while scrolled away may have come back into view since
+        for name in names:
+            if name in self.wanted and name not in images:
+                self.wanted.discard(name)
+                self.request(name)
+
+        if images:
+            for row, name in enumerate(self.sourceModel().names):
+                if images.get(name) is not None:
+                    index = self.index(row, 0)
+                    self.dataChanged.emit(index, index, [Qt.DecorationRole])
+
+
+class ContactSheet(QWidget):
+    # a file was picked from the sheet, with its name
+    selected = pyqtSignal(str)
+
+    def __init__(self, model, parent=None):
+        '''
+        Creates a window showing a file list as a scrollable grid of thumbnails. The grid only lays out and paints
+        the visible tiles, so it scrolls smoothly however many files are listed.
+        :param model: the file list with thumbnails, as a ContactSheetModel
+        :param parent: the parent widget, as a QWidget
+        '''
+        super(ContactSheet, self).__init__(parent, Qt.Window)
+        self.setWindowTitle("Contact Sheet")
+        self.resize(960, 720)
+        self.model = model
+
+        self.view = QListView(self)
+        self.view.setViewMode(QListView.IconMode)
+        self.view.setResizeMode(QListView.Adjust)
+        self.view.setMovement(QListView.Static)
+        self.view.setUniformItemSizes(True)
+        self.view.setLayoutMode(QListView.Batched)
+        self.view.setBatchSize(200)
+        self.view.setGridSize(TILE_SIZE)
+        self.view.setIconSize(ICON_SIZE)
+        self.view.setWordWrap(True)
+        self.view.setModel(model)
+        # the first row is the file list's placeholder
+        self.view.setRowHidden(0, True)
+        model.modelReset.connect(lambda: self.view.setRowHidden(0, True))
+
+        self.view.clicked.connect(self.pick)
+        self.view.verticalScrollBar().valueChanged.connect(self.scrolled)
+
+        layout = QVBoxLayout(self)
+        layout.setContentsMargins(0, 0, 0, 0)
+        layout.addWidget(self.view)
+
+    def scrolled(self):
+        self.model.cancel_hidden()
+        self.view.viewport().update()
+
+    def resizeEvent(self, event):
+        super(ContactSheet, self).resizeEvent(event)
+        self.scrolled()
+
+    def pick(self, index):
+        name = self.model.data(index, Qt.DisplayRole)
+        if name and name != PLACEHOLDER:
+            self.selected.emit(name)
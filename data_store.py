@@ -0,0 +1,386 @@
+import bson
+import gridfs
+import h5py
+import numpy as np
+import array_codec
+import intensity
+import pyramid
+import sqlite_catalog
+
+# where the pixel data of an entry is kept
+#   embedded: encoded by array_codec into the "data" field of the entry itself
+#   hdf5: read on demand from the source file, the entry only references the dataset
+#   gridfs: raw bytes in chunked GridFS storage next to the collection
+STORAGE_MODES = ("embedded", "hdf5", "gridfs")
+DEFAULT_STORAGE = "embedded"
+
+DATASET = "entry0/counter0/data"
+
+
+def blob_store(collection):
+    '''
+    Gets the GridFS store holding the pixel data of a collection's entries, or the equivalent store of an embedded
+    catalog
+    :param collection: the database collection
+    :return: the GridFS store
+    '''
+    if isinstance(collection.database, sqlite_catalog.SQLiteDatabase):
+        return collection.database.blob_store(collection.name + "_blobs")
+    return gridfs.GridFS(collection.database, collection=collection.name + "_blobs")
+
+
+def make_ref(storage, file, dataset):
+    '''
+    Describes where the pixel data of a new entry is kept
+    :param storage: the storage mode, one of STORAGE_MODES
+    :param file: the full filepath of the source HDF5 file, as a string
+    :param dataset: the source dataset, as an h5py dataset
+    :return: the data reference to put in the entry, as a dictionary
+    '''
+    if storage not in STORAGE_MODES:
+        raise ValueError(f"Unknown storage mode {storage}, expected one of {', '.join(STORAGE_MODES)}")
+
+    ref = {"storage": storage,
+           "shape": list(dataset.shape),
+           "dtype": dataset.dtype.str}
+    if storage == "hdf5":
+        ref["file_path"] = file
+        ref["dataset"] = DATASET
+    return ref
+
+
+def store_blob(collection, entry):
+    '''
+    Moves the pixel data of a new gridfs entry into GridFS. Entries in other storage modes are left unchanged.
+    :param collection: the database collection the entry will be written to
+    :param entry: the entry, as a dictionary holding the raw bytes under "_blob"
+    '''
+    blob = entry.pop("_blob", None)
+    if blob is not None:
+        entry["data_ref"]["blob_id"] = blob_store(collection).put(blob, filename=entry["name"])
+
+
+def tile_store(collection):
+    '''
+    Gets the collection holding the pyramid tiles of a collection's entries
+    :param collection: the database collection
+    :return: the tile collection
+    '''
+    return collection.database[collection.name + "_tiles"]
+
+
+def make_preview(pyramid_id, frame, limits=None):
+    '''
+    Builds the thumbnail and pyramid fields of a new entry
+    :param pyramid_id: a unique identifier of the pyramid, as a string
+    :param frame: the displayed frame, as a 2D numpy array
+    :param limits: the frame's minimum and maximum, as a tuple of floats, or None to find them
+    :return: the fields to put in the entry, as a dictionary, holding the tile documents under "_tiles"
+    '''
+    thumb, levels = pyramid.preview(frame, *(limits or (None, None)))
+    fields = {"thumbnail": bson.Binary(thumb.tobytes()),
+              "thumbnail_shape": list(thumb.shape)}
+
+    if levels:
+        fields["pyramid"] = {"id": pyramid_id,
+                             "tile_size": pyramid.TILE_SIZE,
+                             "shapes": [list(level.shape) for level in levels]}
+        fields["_tiles"] = [{"pyramid_id": pyramid_id,
+                             "level": index,
+                             "row": row,
+                             "col": col,
+                             "shape": list(tile.shape),
+                             "data": bson.Binary(tile.tobytes())}
+                            for index, level in enumerate(levels)
+                            for row, col, tile in pyramid.split_tiles(level)]
+    return fields
+
+
+def ensure_tile_index(collection):
+    '''
+    Creates the index used to fetch the tiles of one pyramid level, if it does not exist yet
+    :param collection: the database collection
+    '''
+    tile_store(collection).create_index([("pyramid_id", 1), ("level", 1)])
+
+
+def store_tiles(entry, tile_writer):
+    '''
+    Writes the pyramid tiles of a new entry. Entries without a pyramid are left unchanged.
+    :param entry: the entry, as a dictionary holding the tile documents under "_tiles"
+    :param tile_writer: the writer for the tile collection, as a BulkWriter
+    '''
+    for tile in entry.pop("_tiles", []):
+        tile_writer.insert(tile)
+
+
+def load_thumbnail(entry):
+    '''
+    Decodes the thumbnail of an entry
+    :param entry: the entry, as a dictionary
+    :return: the thumbnail, as a 2D uint8 numpy array, or None if the entry has none
+    '''
+    if "thumbnail" not in entry:
+        return None
+    return np.frombuffer(entry["thumbnail"], dtype=np.uint8).reshape(entry["thumbnail_shape"])
+
+
+def load_level(collection, entry, level):
+    '''
+    Loads one level of an entry's pyramid, fetching only that level's tiles
+    :param collection: the database collection the entry belongs to
+    :param entry: the entry, as a dictionary with a "pyramid" field
+    :param level: the level index, as an integer
+    :return: the level, as a 2D uint8 numpy array
+    '''
+    info = entry["pyramid"]
+    tiles = []
+    for tile in tile_store(collection).find({"pyramid_id": info["id"], "level": level}):
+        tiles.append((tile["row"], tile["col"],
+                      np.frombuffer(tile["data"], dtype=np.uint8).reshape(tile["shape"])))
+    return pyramid.assemble(tiles, info["shapes"][level])
+
+
+def load_view(collection, entry, size):
+    '''
+    Loads what is displayed for an entry: the coarsest pyramid level that fills the display, or the first frame of
+    entries too small for a pyramid
+    :param collection: the database collection the entry belongs to
+    :param entry: the entry, as a dictionary. Only its _id is needed for embedded data.
+    :param size: the edge length of the display, in pixels
+    :return: the image, as a 2D numpy array
+    '''
+    if "pyramid" in entry:
+        # only the tiles of one level
+        return load_level(collection, entry, pyramid.level_for(entry["pyramid"]["shapes"], size))
+    return load_frame(collection, entry, 0)
+
+
+def storage_of(entry):
+    '''
+    Gets the storage mode of an entry
+    :param entry: the entry, as a dictionary
+    :return: the storage mode, as a string. Entries without a data reference are embedded.
+    '''
+    return entry.get("data_ref", {}).get("storage", "embedded")
+
+
+def frame_count(entry):
+    '''
+    Gets the number of frames (energies) of an entry's data
+    :param entry: the entry, as a dictionary
+    :return: the number of frames, as an integer
+    '''
+    shape = entry.get("data_ref", {}).get("shape")
+    if shape is None or len(shape) < 3:
+        return 1
+    return shape[0]
+
+
+def load_data(collection, entry):
+    '''
+    Loads the full pixel data of an entry
+    :param collection: the database collection the entry belongs to
+    :param entry: the entry, as a dictionary. Only its _id is needed for embedded data.
+    :return: the data, as a numpy array
+    '''
+    storage = storage_of(entry)
+    if storage == "embedded":
+        if "data" not in entry:
+            entry = collection.find_one({"_id": entry["_id"]}, {"data": 1})
+        return array_codec.decode(entry["data"])
+
+    ref = entry["data_ref"]
+    if storage == "hdf5":
+        with h5py.File(ref["file_path"], "r") as f:
+            return f[ref["dataset"]][()]
+
+    blob = blob_store(collection).get(ref["blob_id"])
+    return np.frombuffer(blob.read(), dtype=ref["dtype"]).reshape(ref["shape"])
+
+
+def load_frame(collection, entry, index=0):
+    '''
+    Loads a single frame of an entry's pixel data, reading only that frame where the storage mode allows it
+    :param collection: the database collection the entry belongs to
+    :param entry: the entry, as a dictionary. Only its _id is needed for embedded data.
+    :param index: the frame (energy) index, as an integer
+    :return: the frame, as a 2D numpy array
+    '''
+    storage = storage_of(entry)
+    if storage == "embedded":
+        data = load_data(collection, entry)
+        return data[index] if data.ndim >= 3 else data
+
+    ref = entry["data_ref"]
+    shape = ref["shape"]
+    if len(shape) < 3:
+        return load_data(collection, entry)
+
+    if storage == "hdf5":
+        # hyperslab read of just this frame
+        with h5py.File(ref["file_path"], "r") as f:
+            return f[ref["dataset"]][index]
+
+    # seek straight to the frame in the chunked blob
+    dtype = np.dtype(ref["dtype"])
+    frame_bytes = int(np.prod(shape[1:])) * dtype.itemsize
+    blob = blob_store(collection).get(ref["blob_id"])
+    blob.seek(index * frame_bytes)
+    return np.frombuffer(blob.read(frame_bytes), dtype=dtype).reshape(shape[1:])
+
+
+def iter_blocks(collection, entry, chunk_frames, rows=slice(None), cols=slice(None)):
+    '''
+    Streams an entry's pixel data a few frames at a time, cropped to a region, without loading the whole stack
+    :param collection: the database collection the entry belongs to
+    :param entry: the entry, as a dictionary. Only its _id is needed for embedded data.
+    :param chunk_frames: the number of frames per block, as an integer
+    :param rows: the rows of the region, as a slice
+    :param cols: the columns of the region, as a slice
+    :return: a generator of blocks, as 3D numpy arrays of (frames, rows, columns)
+    '''
+    storage = storage_of(entry)
+    if storage == "embedded":
+        data = load_data(collection, entry)
+        data = data.reshape((-1,) + data.shape[-2:])
+        for start in range(0, data.shape[0], chunk_frames):
+            yield data[start:start + chunk_frames, rows, cols]
+        return
+
+    ref = entry["data_ref"]
+    shape = ref["shape"]
+    count = shape[0] if len(shape) >= 3 else 1
+
+    if storage == "hdf5":
+        # hyperslab reads of only the region
+        with h5py.File(ref["file_path"], "r") as f:
+            dataset = f[ref["dataset"]]
+            if dataset.ndim < 3:
+                yield dataset[rows, cols][np.newaxis]
+                return
+            for start in range(0, count, chunk_frames):
+                yield dataset[start:start + chunk_frames, rows, cols]
+        return
+
+    # frames are contiguous in the blob, read a block of them at a time
+    dtype = np.dtype(ref["dtype"])
+    frame_shape = shape[-2:]
+    frame_bytes = int(np.prod(frame_shape)) * dtype.itemsize
+    blob = blob_store(collection).get(ref["blob_id"])
+    for start in range(0, count, chunk_frames):
+        frames = min(chunk_frames, count - start)
+        block = np.frombuffer(blob.read(frames * frame_bytes), dtype=dtype).reshape([frames] + frame_shape)
+        yield block[:, rows, cols]
+
+
+def migrate_embedded(collection, compression=array_codec.DEFAULT_COMPRESSION, page_size=100):
+    '''
+    Re-encodes embedded pixel data pickled by earlier versions in the compact array_codec format, a page of entries
+    at a time
+    :param collection: the database collection
+    :param compression: one of array_codec.COMPRESSIONS, or "auto" to choose per scan
+    :param page_size: the number of entries loaded at once, as an integer
+    :return: the number of entries migrated and their total data size before and after, in bytes, as a tuple of
+    integers
+    '''
+    array_codec.check_compression(compression)
+
+    migrated = 0
+    size_before = 0
+    size_after = 0
+    last_id = None
+    while True:
+        query = {} if last_id is None else {"_id": {"$gt": last_id}}
+        page = list(collection.find(query, {"data": 1}).sort("_id", 1).limit(page_size))
+        if not page:
+            break
+        last_id = page[-1]["_id"]
+
+        for item in page:
+            if "data" not in item or array_codec.is_encoded(item["data"]):
+                continue
+            encoded = array_codec.encode(array_codec.load_legacy(item["data"]), compression)
+            collection.update_one({"_id": item["_id"]}, {"$set": {"data": bson.Binary(encoded)}})
+            migrated += 1
+            size_before += len(item["data"])
+            size_after += len(encoded)
+    return migrated, size_before, size_after
+
+
+def backfill_intensity(collection, page_size=100):
+    '''
+    Computes the intensity statistics of entries built before they were stored, a page of entries at a time
+    :param collection: the database collection
+    :param page_size: the number of entries loaded at once, as an integer
+    :return: the number of entries updated, as an integer, and the entries whose data could not be read, as a list
+    of (file path, reason) tuples
+    '''
+    updated = 0
+    failed = []
+    last_id = None
+    while True:
+        query = {} if last_id is None else {"_id": {"$gt": last_id}}
+        page = list(collection.find(query, {"data": 0, "thumbnail": 0}).sort("_id", 1).limit(page_size))
+        if not page:
+            break
+        last_id = page[-1]["_id"]
+
+        for entry in page:
+            if "intensity" in entry:
+                continue
+            try:
+                fields = intensity.compute(load_data(collection, entry))
+            except Exception as e:
+                failed.append((entry.get("file_path", entry["_id"]), f"cannot read data: {e}"))
+                continue
+            collection.update_one({"_id": entry["_id"]}, {"$set": fields})
+            updated += 1
+    return updated, failed
+
+
+def delete_entries(collection, query):
+    '''
+    Deletes entries from the collection along with any GridFS data and pyramid tiles no other entry still uses
+    :param collection: the database collection
+    :param query: the entries to delete, as a database query
+    '''
+    blob_ids = set()
+    pyramid_ids = set()
+    for item in collection.find(query, {"data_ref.blob_id": 1, "pyramid.id": 1}):
+        if "blob_id" in item.get("data_ref", {}):
+            blob_ids.add(item["data_ref"]["blob_id"])
+        if "pyramid" in item:
+            pyramid_ids.add(item["pyramid"]["id"])
+
+    collection.delete_many(query)
+
+    # copies of a scan share one blob and one pyramid, which are kept while any entry still uses them. Both fields
+    # are indexed by catalog_query.ensure_indexes, so each takes one lookup however many entries were deleted.
+    if blob_ids:
+        used = {item["data_ref"]["blob_id"]
+                for item in collection.find({"data_ref.blob_id": {"$in": list(blob_ids)}}, {"data_ref.blob_id": 1})}
+        fs = blob_store(collection)
+        for blob_id in blob_ids - used:
+            fs.delete(blob_id)
+
+    if pyramid_ids:
+        used = {item["pyramid"]["id"]
+                for item in collection.find({"pyramid.id": {"$in": list(pyramid_ids)}}, {"pyramid.id": 1})}
+        unused = list(pyramid_ids - used)
+        if unused:
+            tile_store(collection).delete_many({"pyramid_id": {"$in": unused}})
+
+
+def clear(collection):
+    '''
+    Deletes every entry from the collection along with all GridFS data and pyramid tiles
+    :param collection: the database collection
+    '''
+    collection.delete_many({})
+    if isinstance(collection.database, sqlite_catalog.SQLiteDatabase):
+        blob_store(collection).clear()
+    else:
+        collection.database.drop_collection(collection.name + "_blobs.files")
+        collection.database.drop_collection(collection.name + "_blobs.chunks")
+    tile_store(collection).delete_many({})
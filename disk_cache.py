@@ -0,0 +1,187 @@
+import hashlib
+import os
+import re
+import threading
+import numpy as np
+
+# default disk budget for decoded stacks kept between sessions
+DISK_CACHE_BYTES = 2 * 1024 * 1024 * 1024
+EXTENSION = ".npy"
+
+
+def default_directory():
+    '''
+    Gets the per-user cache directory, following the XDG convention where it is set
+    :return: the directory, as a string
+    '''
+    root = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(root, "stxm_data_viewer")
+
+
+def source_changed(entry):
+    '''
+    Tells whether an entry's source file has changed since it was read into the catalog
+    :param entry: the entry, as a dictionary
+    :return: whether the size or modification time differ, as a boolean. Files that cannot be reached, e.g. on
+    another machine sharing the catalog, count as unchanged.
+    '''
+    try:
+        stat = os.stat(entry["file_path"])
+    except (KeyError, OSError):
+        return False
+    return (stat.st_size, stat.st_mtime_ns) != (entry.get("file_size"), entry.get("file_mtime"))
+
+
+class DiskCache:
+    def __init__(self, directory=None, max_bytes=DISK_CACHE_BYTES):
+        '''
+        Creates a cache of decoded stacks in .npy files that lasts across sessions and evicts the least recently used
+        files past a byte budget. Cached stacks are opened memory mapped, so reading one costs a page in rather than
+        a database fetch and decode.
+        :param directory: the cache directory, as a string, created if needed, or None for default_directory()
+        :param max_bytes: the disk budget, as an integer number of bytes
+        '''
+        self.directory = directory or default_directory()
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        os.makedirs(self.directory, exist_ok=True)
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        # size of each cached file, in least recently used order as left by earlier sessions
+        self.files = {}
+        found = []
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if name.endswith(".tmp"):
+                # left by a session that stopped while writing
+                self.remove(path)
+            elif name.endswith(EXTENSION):
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                found.append((stat.st_mtime_ns, name, stat.st_size))
+        for _, name, size in sorted(found):
+            self.files[name] = size
+        self.nbytes = sum(self.files.values())
+
+    def key(self, entry):
+        '''
+        Names the cache file of an entry after its catalog entry and the size and modification time of its source
+        file, so a rescanned file gets a new name and its old one ages out
+        :param entry: the entry, as a dictionary
+        :return: the prefix shared by every version of the entry and the file name, as strings, or None for
+        entries without a source file signature
+        '''
+        if entry.get("file_mtime") is None:
+            return None
+        identity = hashlib.sha1(f"{entry['_id']}|{entry.get('file_path', entry['name'])}".encode()).hexdigest()[:16]
+        prefix = f"{re.sub(r'[^A-Za-z0-9_.-]', '_', os.path.splitext(entry['name'])[0])}-{identity}-"
+        return prefix, f"{prefix}{entry.get('file_size')}-{entry['file_mtime']}{EXTENSION}"
+
+    def get(self, entry):
+        '''
+        Opens an entry's cached stack and marks it as recently used
+        :param entry: the entry, as a dictionary
+        :return: the stack, as a read only memory mapped numpy array, or None if it is not cached or its source file
+        has changed since
+        '''
+        key = self.key(entry)
+        if key is None or source_changed(entry):
+            with self.lock:
+                self.misses += 1
+            return None
+
+        prefix, name = key
+        path = os.path.join(self.directory, name)
+        with self.lock:
+            if name not in self.files:
+                self.misses += 1
+                return None
+            self.files[name] = self.files.pop(name)
+        try:
+            data = np.load(path, mmap_mode="r")
+            # the modification time orders files by use for later sessions
+            os.utime(path)
+        except (OSError, ValueError):
+            with self.lock:
+                self.misses += 1
+                self.nbytes -= self.files.pop(name, 0)
+            return None
+        with self.lock:
+            self.hits += 1
+        return data
+
+    def put(self, entry, data):
+        '''
+        Writes an entry's decoded stack to the cache, replacing earlier versions of it and evicting the least
+        recently used files until it fits the budget. Entries whose source file has changed since they were read
+        into the catalog are not cached.
+        :param entry: the entry, as a dictionary
+        :param data: the stack, as a numpy array
+        '''
+        key = self.key(entry)
+        nbytes = data.nbytes
+        if key is None or nbytes > self.max_bytes or source_changed(entry):
+            return
+
+        prefix, name = key
+        path = os.path.join(self.directory, name)
+        # written under a temporary name and renamed, so no session ever opens a partly written file
+        temp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            with open(temp, "wb") as f:
+                np.save(f, data)
+            os.replace(temp, path)
+            nbytes = os.path.getsize(path)
+        except OSError:
+            self.remove(temp)
+            return
+
+        with self.lock:
+            self.nbytes -= self.files.pop(name, 0)
+            for old in [other for other in self.files if other.startswith(prefix)]:
+                self.evict(old)
+            while self.files and self.nbytes + nbytes > self.max_bytes:
+                self.evict(next(iter(self.files)))
+            self.files[name] = nbytes
+            self.nbytes += nbytes
+
+    def evict(self, name):
+        # callers hold the lock
+        self.nbytes -= self.files.pop(name)
+        self.evictions += 1
+        self.remove(os.path.join(self.directory, name))
+
+    def remove(self, path):
+        try:
+            os.remove(path)
+        except OSError:
+            # e.g. still memory mapped on Windows, it is evicted again by a later session
+            pass
+
+    def clear(self):
+        '''
+        Deletes every cached file, keeping the hit and miss counts
+        '''
+        with self.lock:
+            for name in list(self.files):
+                self.remove(os.path.join(self.directory, name))
+            self.files.clear()
+            self.nbytes = 0
+
+    def stats(self):
+        '''
+        Gets the cache counters
+        :return: the hits, misses, evictions, cached files, bytes used and byte budget, as a dictionary
+        '''
+        with self.lock:
+            return {"hits": self.hits,
+                    "misses": self.misses,
+                    "evictions": self.evictions,
+                    "entries": len(self.files),
+                    "bytes": self.nbytes,
+                    "max_bytes": self.max_bytes}
@@ -0,0 +1,118 @@
+import os
+import queue
+import threading
+
+# paths waiting to be read; discovery pauses when readers fall this far behind
+QUEUE_SIZE = 1000
+
+
+def scan_directory(path):
+    '''
+    Lists one directory, without descending into it
+    :param path: the directory, as a string
+    :return: the subdirectories, as a list of strings, and the HDF5 files with their sizes in bytes, as a list of
+    tuples. Both are empty if the directory cannot be read.
+    '''
+    directories = []
+    files = []
+    try:
+        with os.scandir(path) as entries:
+            for entry in entries:
+                try:
+                    # symlinked directories are not followed, as with os.walk
+                    if entry.is_dir(follow_symlinks=False):
+                        directories.append(entry.path)
+                    elif entry.name.endswith(".hdf5"):
+                        # cached by scandir on Windows, one stat call elsewhere
+                        files.append((entry.path, entry.stat().st_size))
+                except OSError as e:
+                    continue
+    except OSError as e:
+        pass
+    return directories, files
+
+
+def iter_files(directory, on_directory=None):
+    '''
+    Walks a directory tree top down with os.scandir, yielding HDF5 files as they are found
+    :param directory: the root directory, as a string
+    :param on_directory: called with the numbers of directories scanned and still to scan after each directory, or
+    None
+    :return: a generator of the full filepaths and sizes in bytes of the HDF5 files, as tuples
+    '''
+    pending = [directory]
+    scanned = 0
+    while pending:
+        directories, files = scan_directory(pending.pop())
+        # visit subdirectories in the order they were listed
+        pending.extend(reversed(directories))
+        scanned += 1
+        if on_directory is not None:
+            on_directory(scanned, len(pending))
+        for file in files:
+            yield file
+
+
+class Discoverer(threading.Thread):
+    def __init__(self, directory, stats, queue_size=QUEUE_SIZE):
+        '''
+        Walks a directory tree in the background, feeding the HDF5 files it finds to a bounded queue as it goes so
+        reading can start straight away. Iterate over the discoverer to consume the files.
+        :param directory: the root directory, as a string
+        :param stats: the counters whose totals are kept up to date, as an IngestStats
+        :param queue_size: the most files waiting to be read, as an integer
+        '''
+        super(Discoverer, self).__init__(daemon=True)
+        self.directory = directory
+        self.stats = stats
+        self.queue = queue.Queue(queue_size)
+        self.stopped = threading.Event()
+        self.files = 0
+        self.bytes = 0
+        self.scanned = 0
+        self.pending = 0
+
+    def on_directory(self, scanned, pending):
+        self.scanned = scanned
+        self.pending = pending
+
+    def run(self):
+        try:
+            for file, size in iter_files(self.directory, self.on_directory):
+                self.files += 1
+                self.bytes += size
+                # assume the directories left hold as many files as those scanned so far
+                scale = (self.scanned + self.pending) / max(1, self.scanned)
+                self.stats.set_total(round(self.files * scale), round(self.bytes * scale), final=False)
+                if not self.put(file):
+                    return
+            self.stats.set_total(self.files, self.bytes)
+        finally:
+            self.put(None)
+
+    def put(self, item):
+        '''
+        Queues an item, waiting while the queue is full unless the discoverer is stopped
+        :param item: the filepath, or None once every file is queued
+        :return: whether the item was queued, as a boolean
+        '''
+        while not self.stopped.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def stop(self):
+        '''
+        Stops the walk, e.g. when the consumer gives up early
+        '''
+        self.stopped.set()
+
+    def __iter__(self):
+        while True:
+            file = self.queue.get()
+            if file is None:
+                return
+            yield file
@@ -0,0 +1,206 @@
+import threading
+from PyQt5.QtCore import QAbstractListModel, QModelIndex, QObject, QRunnable, Qt, pyqtSignal
+import catalog_query
+
+# number of names fetched from the database at a time
+PAGE_SIZE = 200
+PLACEHOLDER = "Select a File"
+
+
+def fetch_page(collection, query, last_id=None, cancelled=None):
+    '''
+    Fetches the next page of names matching a query, in _id order
+    :param collection: the database collection to list
+    :param query: the entries to list, as a database query
+    :param last_id: the _id of the last entry already listed, or None for the first page
+    :param cancelled: set once the page is no longer wanted, as a threading.Event, or None
+    :return: the _id and name of each entry, as a list of dictionaries, or None if cancelled
+    '''
+    if last_id is not None:
+        query = {**query, "_id": {"$gt": last_id}}
+    page = []
+    for item in collection.find(query, {"name": 1}).sort("_id", 1).limit(PAGE_SIZE):
+        # checked between entries, as queries filtered outside the database can scan many documents per match
+        if cancelled is not None and cancelled.is_set():
+            return None
+        page.append(item)
+    return page
+
+
+class PageSignals(QObject):
+    # generation of the query, then the page (None if cancelled) or the error message
+    loaded = pyqtSignal(int, object)
+    failed = pyqtSignal(int, str)
+
+
+class PageLoader(QRunnable):
+    def __init__(self, collection, query, last_id, generation, cancelled, signals):
+        '''
+        Fetches one page of a query on a threadpool
+        :param collection: the database collection to list
+        :param query: the entries to list, as a database query
+        :param last_id: the _id of the last entry already listed, or None for the first page
+        :param generation: the query the page belongs to, as an integer
+        :param cancelled: set once the query is replaced, as a threading.Event
+        :param signals: the signals to report the page with, as a PageSignals
+        '''
+        super(PageLoader, self).__init__()
+        self.collection = collection
+        self.query = query
+        self.last_id = last_id
+        self.generation = generation
+        self.cancelled = cancelled
+        self.signals = signals
+
+    def run(self):
+        if self.cancelled.is_set():
+            return
+        try:
+            page = fetch_page(self.collection, self.query, self.last_id, self.cancelled)
+        except Exception as e:
+            self.signals.failed.emit(self.generation, str(e))
+            return
+        if page is not None:
+            self.signals.loaded.emit(self.generation, page)
+
+
+class FileListModel(QAbstractListModel):
+    # the query could not be run, with the error message
+    failed = pyqtSignal(str)
+
+    def __init__(self, parent=None, threadpool=None):
+        '''
+        Creates a list of file names that is filled from the database one page at a time, as the list is scrolled
+        :param parent: the parent object, as a QObject
+        :param threadpool: the threadpool pages are fetched on, as a QThreadPool, or None to fetch them on the
+        calling thread
+        '''
+        super(FileListModel, self).__init__(parent)
+        self.threadpool = threadpool
+        self.collection = None
+        self.query = {}
+        self.names = [PLACEHOLDER]
+        # _id of the last fetched entry, pages continue after it
+        self.last_id = None
+        self.exhausted = True
+
+        # pages of replaced queries are dropped when they arrive, and their fetches stopped early
+        self.generation = 0
+        self.cancelled = threading.Event()
+        self.loading = False
+        self.signals = PageSignals()
+        self.signals.loaded.connect(self.page_loaded)
+        self.signals.failed.connect(self.page_failed)
+
+    def cancel(self):
+        '''
+        Stops any page being fetched and drops it when it arrives
+        '''
+        self.cancelled.set()
+        self.cancelled = threading.Event()
+        self.generation += 1
+        self.loading = False
+
+    def set_query(self, collection, query):
+        '''
+        Lists the entries matching a query, replacing the current list and cancelling the previous query
+        :param collection: the database collection to list
+        :param query: the entries to list, as a database query
+        '''
+        self.cancel()
+        self.beginResetModel()
+        self.collection = collection
+        self.query = query
+        self.names = [PLACEHOLDER]
+        self.last_id = None
+        self.exhausted = False
+        self.endResetModel()
+
+        self.fetchMore(QModelIndex())
+
+    def clear(self):
+        '''
+        Empties the list, leaving only the placeholder
+        '''
+        self.cancel()
+        self.beginResetModel()
+        self.query = None
+        self.names = [PLACEHOLDER]
+        self.last_id = None
+        self.exhausted = True
+        self.endResetModel()
+
+    def add_entries(self, entries):
+        '''
+        Appends entries just added to the database that match the current query, leaving the rest of the list as it
+        is. Until the last page has been fetched, new entries are left to come with a later page instead.
+        :param entries: the new entries, as a list of dictionaries
+        '''
+        if self.query is None or not self.exhausted:
+            return
+
+        names = [entry["name"] for entry in entries if catalog_query.matches(self.query, entry)]
+        if not names:
+            return
+        self.beginInsertRows(QModelIndex(), len(self.names), len(self.names) + len(names) - 1)
+        self.names.extend(names)
+        self.endInsertRows()
+
+    def rowCount(self, parent=QModelIndex()):
+        if parent.isValid():
+            return 0
+        return len(self.names)
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid() or index.row() >= len(self.names):
+            return None
+        if role in (Qt.DisplayRole, Qt.EditRole):
+            return self.names[index.row()]
+        return None
+
+    def canFetchMore(self, parent):
+        return not parent.isValid() and not self.exhausted and not self.loading
+
+    def fetchMore(self, parent):
+        '''
+        Appends the next page of names, fetching only the name of each entry. With a threadpool the page is fetched
+        there and appended when it arrives.
+        '''
+        if not self.canFetchMore(parent):
+            return
+
+        if self.threadpool is None:
+            self.append_page(fetch_page(self.collection, self.query, self.last_id))
+            return
+
+        self.loading = True
+        self.threadpool.start(PageLoader(self.collection, self.query, self.last_id, self.generation, self.cancelled,
+                                         self.signals))
+
+    def page_loaded(self, generation, page):
+        if generation != self.generation:
+            return
+        self.loading = False
+        self.append_page(page)
+
+    def page_failed(self, generation, error):
+        if generation != self.generation:
+            return
+        self.loading = False
+        self.exhausted = True
+        self.failed.emit(error)
+
+    def append_page(self, page):
+        '''
+        Appends a fetched page to the list
+        :param page: the _id and name of each entry, as a list of dictionaries
+        '''
+        if len(page) < PAGE_SIZE:
+            self.exhausted = True
+        if not page:
+            return
+
+        self.last_id = page[-1]["_id"]
+        self.beginInsertRows(QModelIndex(), len(self.names), len(self.names) + len(page) - 1)
+        self.names.extend(item["name"] for item in page)
+        self.endInsertRows()
@@ -0,0 +1,84 @@
+import threading
+from collections import OrderedDict
+
+# default memory budget for decoded frames
+CACHE_BYTES = 256 * 1024 * 1024
+
+
+class FrameCache:
+    def __init__(self, max_bytes=CACHE_BYTES):
+        '''
+        Creates a thread safe cache of decoded frames that evicts the least recently used frames past a byte budget
+        :param max_bytes: the memory budget, as an integer number of bytes
+        '''
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.nbytes = 0
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __contains__(self, key):
+        with self.lock:
+            return key in self.entries
+
+    def get(self, key):
+        '''
+        Looks up a cached value and marks it as recently used
+        :param key: the cache key
+        :return: the cached value, or None if it is not cached
+        '''
+        with self.lock:
+            value = self.entries.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return value[0]
+
+    def put(self, key, value, nbytes):
+        '''
+        Caches a value, evicting the least recently used values until it fits the budget
+        :param key: the cache key
+        :param value: the value to cache
+        :param nbytes: the memory used by the value, as an integer number of bytes
+        '''
+        if nbytes > self.max_bytes:
+            return
+
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.nbytes -= old[1]
+
+            while self.entries and self.nbytes + nbytes > self.max_bytes:
+                _, (_, evicted_bytes) = self.entries.popitem(last=False)
+                self.nbytes -= evicted_bytes
+                self.evictions += 1
+
+            self.entries[key] = (value, nbytes)
+            self.nbytes += nbytes
+
+    def clear(self):
+        '''
+        Empties the cache, keeping the hit and miss counts
+        '''
+        with self.lock:
+            self.entries.clear()
+            self.nbytes = 0
+
+    def stats(self):
+        '''
+        Gets the cache counters
+        :return: the hits, misses, evictions, cached entries, bytes used and byte budget, as a dictionary
+        '''
+        with self.lock:
+            return {"hits": self.hits,
+                    "misses": self.misses,
+                    "evictions": self.evictions,
+                    "entries": len(self.entries),
+                    "bytes": self.nbytes,
+                    "max_bytes": self.max_bytes}
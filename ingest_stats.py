@@ -0,0 +1,216 @@
+import json
+import threading
+import time
+from contextlib import contextmanager
+
+# hot-path phases of ingest: opening files, reading datasets, computing intensity statistics, serializing pixel
+# data, rendering thumbnails and pyramids, and writing to the database
+PHASES = ("open", "read", "stats", "serialize", "render", "write")
+
+
+def format_duration(seconds):
+    '''
+    Formats a duration for progress output
+    :param seconds: the duration, in seconds, as a float
+    :return: the duration, as a string in the form [H:]MM:SS
+    '''
+    minutes, seconds = divmod(int(round(seconds)), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}:{minutes:02d}:{seconds:02d}" if hours else f"{minutes:02d}:{seconds:02d}"
+
+
+class IngestStats:
+    def __init__(self):
+        '''
+        Creates thread safe counters of an ingest run: time spent in each phase, files and bytes done, and the files
+        skipped or failed with their reasons. Shared between the thread running the ingest and the UI reporting it.
+        '''
+        self.lock = threading.Lock()
+        self.start()
+
+    def start(self, total_files=0, total_bytes=0, final=True):
+        '''
+        Resets the counters for a new run
+        :param total_files: the number of files the run will process, as an integer
+        :param total_bytes: the size of those files, as an integer number of bytes
+        :param final: whether the totals are known, as a boolean, or only estimated while files are still being found
+        '''
+        with self.lock:
+            self.started = time.perf_counter()
+            self.finished = None
+            self.total_files = total_files
+            self.total_bytes = total_bytes
+            self.estimating = not final
+            self.highest_percent = 0
+            self.files_done = 0
+            self.bytes_done = 0
+            self.phase_seconds = dict.fromkeys(PHASES, 0.0)
+            self.unchanged = 0
+            self.skipped = []
+            self.failed = []
+
+    def set_total(self, total_files, total_bytes, final=True):
+        '''
+        Updates the size of the run as files are found
+        :param total_files: the number of files the run will process, as an integer
+        :param total_bytes: the size of those files, as an integer number of bytes
+        :param final: whether the totals are known, as a boolean, or only estimated
+        '''
+        with self.lock:
+            self.total_files = total_files
+            self.total_bytes = total_bytes
+            self.estimating = not final
+
+    def add_time(self, phase, seconds):
+        with self.lock:
+            self.phase_seconds[phase] = self.phase_seconds.get(phase, 0.0) + seconds
+
+    def add_times(self, timings):
+        '''
+        Adds the phase timings of one file, e.g. as measured in a worker process
+        :param timings: the seconds spent in each phase, as a dictionary
+        '''
+        with self.lock:
+            for phase, seconds in timings.items():
+                self.phase_seconds[phase] = self.phase_seconds.get(phase, 0.0) + seconds
+
+    @contextmanager
+    def timed(self, phase):
+        '''
+        Adds the time spent in a with block to a phase
+        :param phase: the phase, one of PHASES
+        '''
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(phase, time.perf_counter() - start)
+
+    def file_done(self, nbytes=0):
+        '''
+        Counts a processed file, whether it was added, skipped or failed
+        :param nbytes: the size of the file, as an integer number of bytes
+        '''
+        with self.lock:
+            self.files_done += 1
+            self.bytes_done += nbytes
+
+    def record(self, file, report):
+        '''
+        Counts a file read by prepare_database.read_file, adding its timings and any reason it was skipped or failed
+        :param file: the full filepath of the file, as a string
+        :param report: the read report, as a dictionary
+        '''
+        self.add_times(report["timings"])
+        if "skipped" in report:
+            self.skip(file, report["skipped"])
+        if "failed" in report:
+            self.fail(file, report["failed"])
+        self.file_done(report["bytes"])
+
+    def add_unchanged(self, count):
+        '''
+        Counts files a sync left alone because they have not changed
+        :param count: the number of files, as an integer
+        '''
+        with self.lock:
+            self.unchanged += count
+
+    def skip(self, file, reason):
+        with self.lock:
+            self.skipped.append((file, reason))
+
+    def fail(self, file, reason):
+        with self.lock:
+            self.failed.append((file, reason))
+
+    def finish(self):
+        with self.lock:
+            self.finished = time.perf_counter()
+
+    def rates(self):
+        '''
+        Gets the throughput so far and the time left at that pace
+        :return: the files per second, megabytes per second and estimated seconds left (None until a file is done),
+        as a tuple of floats
+        '''
+        with self.lock:
+            elapsed = (self.finished or time.perf_counter()) - self.started
+            files_done, bytes_done, total_files = self.files_done, self.bytes_done, self.total_files
+        if elapsed <= 0 or files_done == 0:
+            return 0.0, 0.0, None
+        files_per_s = files_done / elapsed
+        return files_per_s, bytes_done / 2 ** 20 / elapsed, max(0, total_files - files_done) / files_per_s
+
+    def percent(self):
+        '''
+        Gets the percent completion of the run, held below 100 while the total is only estimated and never going
+        back as estimates grow
+        :return: the percent completion, as an integer
+        '''
+        with self.lock:
+            if self.total_files == 0:
+                percent = 0 if self.estimating else 100
+            else:
+                percent = min(100, int(self.files_done / self.total_files * 100))
+                if self.estimating:
+                    percent = min(99, percent)
+            self.highest_percent = max(self.highest_percent, percent)
+            return self.highest_percent
+
+    def progress_text(self):
+        '''
+        Describes the progress of the run, marking estimates with ~
+        :return: the files done, throughput and time left, as a string
+        '''
+        files_per_s, mb_per_s, eta = self.rates()
+        about = "~" if self.estimating else ""
+        text = f"{self.files_done}/{about}{self.total_files} files, {files_per_s:.1f} files/s, {mb_per_s:.1f} MB/s"
+        if eta is not None and self.files_done < self.total_files:
+            text += f", ETA {about}{format_duration(eta)}"
+        return text
+
+    def summary(self):
+        '''
+        Gets the results of the run
+        :return: the counters, throughput, phase timings and skipped and failed files, as a dictionary
+        '''
+        files_per_s, mb_per_s, _ = self.rates()
+        with self.lock:
+            return {"seconds": round((self.finished or time.perf_counter()) - self.started, 3),
+                    "files": self.files_done,
+                    "megabytes": round(self.bytes_done / 2 ** 20, 1),
+                    "files_per_s": round(files_per_s, 1),
+                    "mb_per_s": round(mb_per_s, 1),
+                    "unchanged": self.unchanged,
+                    # summed over worker processes, so phases can add up to more than the wall time
+                    "phase_seconds": {phase: round(seconds, 3) for phase, seconds in self.phase_seconds.items()},
+                    "skipped": [{"file_path": file, "reason": reason} for file, reason in self.skipped],
+                    "failed": [{"file_path": file, "reason": reason} for file, reason in self.failed]}
+
+    def report(self, max_skipped=20):
+        '''
+        Describes the results of the run for a log. Failed files are left to the caller, which reports them as errors.
+        :param max_skipped: the most skipped files to list, as an integer
+        :return: the report, as a list of lines
+        '''
+        summary = self.summary()
+        total = sum(summary["phase_seconds"].values()) or 1.0
+        lines = [f"{summary['files']} files ({summary['megabytes']} MB) in {summary['seconds']} s: "
+                 f"{summary['files_per_s']} files/s, {summary['mb_per_s']} MB/s, "
+                 f"{summary['unchanged']} unchanged, {len(summary['skipped'])} skipped, "
+                 f"{len(summary['failed'])} failed",
+                 "Time per phase: " + ", ".join(f"{phase} {seconds:.2f} s ({seconds / total:.0%})"
+                                                for phase, seconds in summary["phase_seconds"].items())]
+        lines += [f"Skipped {item['file_path']}: {item['reason']}" for item in summary["skipped"][:max_skipped]]
+        if len(summary["skipped"]) > max_skipped:
+            lines.append(f"... and {len(summary['skipped']) - max_skipped} more skipped")
+        return lines
+
+    def write_report(self, path):
+        '''
+        Writes the results of the run as JSON
+        :param path: the report file, as a string
+        '''
+        with open(path, "w") as f:
+            json.dump(self.summary(), f, indent=2)
@@ -0,0 +1,155 @@
+import warnings
+import bson
+import numpy as np
+import array_codec
+
+# percentiles kept for each frame, covering the clip levels of rendering.CONTRAST_MODES and the median
+PERCENTILES = (0.1, 1.0, 5.0, 50.0, 95.0, 99.0, 99.9)
+# columns of the per-frame statistics
+FRAME_COLUMNS = ("min", "max", "mean") + tuple(f"p{percentile:g}" for percentile in PERCENTILES)
+# histogram bins spanning the scan's intensity range
+BINS = 64
+# pixels worked on at once, bounding the temporary arrays of large stacks
+BLOCK_PIXELS = 1 << 22
+# evenly spaced pixels the percentiles of a stack are taken from
+SAMPLE_PIXELS = 1 << 18
+
+
+def sorted_percentiles(block):
+    '''
+    Finds percentiles of each row of a block by sorting it, which is faster than the partitions of np.percentile for
+    this many percentiles. Interpolates linearly between pixels as np.percentile does.
+    :param block: the rows, as a 2D numpy array without NaN values
+    :return: the minimum, maximum and PERCENTILES of each row, as a 2D numpy array of one row per row of the block
+    '''
+    ordered = np.sort(block, axis=1)
+    position = np.array(PERCENTILES) / 100 * (block.shape[1] - 1)
+    below = np.floor(position).astype(np.intp)
+    above = np.minimum(below + 1, block.shape[1] - 1)
+    weight = position - below
+    values = ordered[:, below] * (1 - weight) + ordered[:, above] * weight
+    return np.column_stack([ordered[:, 0], ordered[:, -1], values])
+
+
+def compute(data):
+    '''
+    Computes intensity statistics of a scan and of each of its frames while the data is in memory, a block of
+    frames at a time: the minimum, maximum, mean and PERCENTILES of each frame, and histograms of each frame over the
+    scan's intensity range that add up to the scan's histogram
+    :param data: the pixel data, as a 2D or 3D numpy array
+    :return: the catalog fields, as a dictionary. The percentiles of stacks are taken from an evenly spaced sample
+    of SAMPLE_PIXELS pixels, those of single frames are exact.
+    '''
+    data = np.asarray(data)
+    if data.size == 0:
+        return {}
+    frames = data.reshape(-1, data.shape[-2] * data.shape[-1]) if data.ndim >= 2 else data.reshape(1, -1)
+    count, pixels = frames.shape
+
+    # NaN pixels (e.g. dropped points) need the slower NaN aware reductions
+    has_nan = data.dtype.kind == "f" and bool(np.isnan(data).any())
+    nanmin, nanmax, mean, percentile = (np.nanmin, np.nanmax, np.nanmean, np.nanpercentile) if has_nan \
+        else (np.min, np.max, np.mean, np.percentile)
+
+    with warnings.catch_warnings():
+        # frames that are all NaN get NaN statistics
+        warnings.simplefilter("ignore", RuntimeWarning)
+        low = float(nanmin(data))
+        high = float(nanmax(data))
+        scale = BINS / (high - low) if high > low else 0.0
+
+        stats = np.empty((count, len(FRAME_COLUMNS)))
+        histograms = np.empty((count, BINS), dtype=np.uint32)
+        step = max(1, BLOCK_PIXELS // pixels)
+        for start in range(0, count, step):
+            block = frames[start:start + step]
+            stats[start:start + step, 2] = mean(block, axis=1, dtype=np.float64)
+            if has_nan:
+                stats[start:start + step, 0] = nanmin(block, axis=1)
+                stats[start:start + step, 1] = nanmax(block, axis=1)
+                stats[start:start + step, 3:] = percentile(block, PERCENTILES, axis=1).T
+            else:
+                stats[start:start + step, [0, 1] + list(range(3, 3 + len(PERCENTILES)))] = sorted_percentiles(block)
+
+            # bin every pixel of the block in one bincount, offsetting each frame's bins, with NaN pixels put in an
+            # extra bin that is dropped
+            bins = np.subtract(block, low, dtype=np.float64)
+            bins *= scale
+            np.clip(bins, 0, BINS - 1, out=bins)
+            if has_nan:
+                bins[np.isnan(bins)] = BINS
+            bins = bins.astype(np.intp)
+            bins += (np.arange(block.shape[0]) * (BINS + 1))[:, np.newaxis]
+            counts = np.bincount(bins.ravel(), minlength=block.shape[0] * (BINS + 1))
+            histograms[start:start + step] = counts.reshape(-1, BINS + 1)[:, :BINS]
+
+        if count == 1:
+            scan_percentiles = stats[0, 3:]
+        else:
+            flat = data.reshape(-1)
+            sample = flat[::max(1, flat.size // SAMPLE_PIXELS)]
+            scan_percentiles = percentile(sample, PERCENTILES) if has_nan \
+                else sorted_percentiles(sample[np.newaxis])[0, 2:]
+        scan_mean = float(np.average(stats[:, 2])) if not has_nan else float(np.nanmean(data))
+
+    return {"intensity_min": low,
+            "intensity_max": high,
+            "intensity_mean": scan_mean,
+            "intensity": {"percentiles": [float(value) for value in scan_percentiles],
+                          "histogram": [int(value) for value in histograms.sum(axis=0)],
+                          "frames": bson.Binary(array_codec.encode(stats, "none")),
+                          "frame_histograms": bson.Binary(array_codec.encode(histograms))}}
+
+
+def frame_stats(entry, index=0):
+    '''
+    Gets the stored intensity statistics of one frame of an entry
+    :param entry: the entry, as a dictionary
+    :param index: the frame (energy) index, as an integer
+    :return: the statistics by FRAME_COLUMNS name, as a dictionary of floats, or None for entries built before
+    statistics were stored
+    '''
+    info = entry.get("intensity") if entry is not None else None
+    if info is None:
+        return None
+    stats = array_codec.decode(info["frames"])
+    if not 0 <= index < stats.shape[0]:
+        return None
+    return dict(zip(FRAME_COLUMNS, stats[index].tolist()))
+
+
+def contrast_limits(entry, index=0, percentile=None):
+    '''
+    Gets the contrast limits of a frame from its stored statistics, saving a pass over the pixels at view time
+    :param entry: the entry, as a dictionary
+    :param index: the frame (energy) index, as an integer
+    :param percentile: the percentage of pixels clipped at each end, as a float, or None for the full range
+    :return: the low and high limits, as floats, or None if they are not stored
+    '''
+    stats = frame_stats(entry, index)
+    if stats is None:
+        return None
+    if not percentile:
+        return stats["min"], stats["max"]
+    low, high = f"p{percentile:g}", f"p{100 - percentile:g}"
+    if low not in stats or high not in stats:
+        return None
+    return stats[low], stats[high]
+
+
+def preview_limits(entry, low, high):
+    '''
+    Converts contrast limits to the grey levels of an entry's thumbnail and pyramid, which map the first frame's
+    minimum and maximum to 0 and 255
+    :param entry: the entry, as a dictionary
+    :param low: the intensity mapped to black, as a float
+    :param high: the intensity mapped to white, as a float
+    :return: the low and high limits in grey levels, as floats, or None if the statistics are not stored
+    '''
+    stats = frame_stats(entry, 0)
+    if stats is None:
+        return None
+    span = stats["max"] - stats["min"]
+    if not span > 0:
+        return 0.0, 255.0
+    return (low - stats["min"]) * 255.0 / span, (high - stats["min"]) * 255.0 / span
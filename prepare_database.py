@@ -1,129 +1,518 @@
-
 import numpy as np
 import os
 import h5py
 import bson
-import pickle
+import hashlib
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
+import array_codec
+import catalog_query
+import data_store
+import intensity
+from bulk_writer import BulkWriter, BATCH_SIZE
+from file_discovery import Discoverer, iter_files
+from ingest_stats import IngestStats
+
+
+def find_files(directory):
+    '''
+    Walks a directory tree and collects the paths of all HDF5 files in it
+    :param directory: the root directory in which to find files, as a string
+    :return: the full filepaths of the HDF5 files found, as a list of strings
+    '''
+    return [file for file, size in iter_files(directory)]
+
+
+def total_size(file_paths):
+    '''
+    Adds up the sizes of files, for throughput and time estimates
+    :param file_paths: the full filepaths of the files, as a list of strings
+    :return: the total size, as an integer number of bytes. Files that cannot be read count as empty.
+    '''
+    total = 0
+    for file in file_paths:
+        try:
+            total += os.path.getsize(file)
+        except OSError as e:
+            pass
+    return total
+
+
+def time_to_int(time_str):
+    '''
+    Converts an HDF5 timestamp to an integer matching the dateTime().toString() format used for filtering
+    :param time_str: the timestamp, as a string in the form "YYYY-MM-DDTHH:MM..."
+    :return: the timestamp, as an integer in the form YYYYMMDDHHMM
+    '''
+    year = time_str[:4]
+    month = time_str[5:7]
+    day = time_str[8:10]
+
+    hour = time_str[11:13]
+    minute = time_str[14:16]
+
+    # an empty timestamp raises a ValueError here
+    return int(year + month + day + hour + minute)
+
+
+def file_hash(file):
+    '''
+    Computes a content hash of a file, used to recognize copies of the same scan
+    :param file: the full filepath of the file, as a string
+    :return: the SHA-1 hex digest of the file contents, as a string, or None if the file could not be read
+    '''
+    sha = hashlib.sha1()
+    try:
+        with open(file, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                sha.update(block)
+    except OSError as e:
+        return None
+    return sha.hexdigest()
+
 
-def prepare_database(collection, directory, progress_callback):
+def file_signature(file):
+    '''
+    Gets the size and modification time recorded in the manifest of a database entry
+    :param file: the full filepath of the file, as a string
+    :return: the size in bytes and the modification time in nanoseconds, as a tuple of integers
+    '''
+    stat = os.stat(file)
+    return stat.st_size, stat.st_mtime_ns
+
+
+def read_file(file, storage=data_store.DEFAULT_STORAGE):
+    '''
+    Reads an HDF5 file and builds its database entry, timing each phase. Safe to run in a worker process.
+    :param file: the full filepath of the HDF5 file, as a string
+    :param storage: where the entry's pixel data is kept, one of data_store.STORAGE_MODES
+    :return: the database entry, as a dictionary, or None if the file could not be read, and the read report, as a
+    dictionary of the file size, the seconds spent in each phase and any reason the file was skipped or failed
+    '''
+    timings = {}
+    report = {"bytes": 0, "timings": timings}
+    start = time.perf_counter()
+    try:
+        file_size, file_mtime = file_signature(file)
+        report["bytes"] = file_size
+        f = h5py.File(file, "r")
+    except Exception as e:
+        report["failed"] = f"cannot open file: {e}"
+        return None, report
+    finally:
+        timings["open"] = time.perf_counter() - start
+
+    try:
+        start = time.perf_counter()
+        try:
+            dataset = f['entry0']['counter0']['data']
+        except KeyError as e:
+            report["skipped"] = "not an STXM scan, no entry0/counter0/data"
+            return None, report
+
+        # get info to put into database
+
+        data_ref = data_store.make_ref(storage, file, dataset)
+
+        scan_type = f['entry0']['counter0']['stxm_scan_type'][()].decode('utf8')
+
+        # make start_time and end_time match the dateTime().toString() format
+        start_int = time_to_int(f['entry0']['start_time'][()].decode('utf8'))
+        end_int = time_to_int(f['entry0']['end_time'][()].decode('utf8'))
+
+        xpoints = (f['entry0']['counter0']['sample_x'][()])
+        # pad with 0 if needed
+        if xpoints.size == 1:
+            xpoints = np.append(xpoints, 0)
+            xres = 1
+        else:
+            xres = xpoints.size
+        xstart = xpoints[0]
+        xstop = xpoints[-1]
+        xrange = np.fabs(xstop - xstart)
+        ypoints = (f['entry0']['counter0']['sample_y'][()])
+
+        # pad with 0 if needed
+        if ypoints.size == 1:
+            ypoints = np.append(ypoints, 0)
+            yres = 1
+        else:
+            yres = ypoints.size
+        ystart = ypoints[0]
+        ystop = ypoints[-1]
+        yrange = np.fabs(ystop - ystart)
+
+        energies = np.atleast_1d(f['entry0']['counter0']['energy'][()])
+        # convert energies to integers for database storage and filtering
+        energies_lst = [int(energy) for energy in energies]
+
+        entry = {"name": os.path.basename(file),
+                 "file_path": file,
+                 "file_size": file_size,
+                 "file_mtime": file_mtime,
+                 "data_ref": data_ref,
+                 "scan_type": scan_type,
+                 "start_time": start_int,
+                 "end_time": end_int,
+                 "xrange": int(xrange),
+                 "yrange": int(yrange),
+                 "xresolution": int(xres),
+                 "yresolution": int(yres),
+                 "energy_min": min(energies_lst),
+                 "energy_max": max(energies_lst),
+                 # energy of each frame, for browsing stacks
+                 "energies": [float(energy) for energy in energies]
+                 }
+
+        # all of the pixel data is read for its intensity statistics, even when it stays in the file
+        data = dataset[()]
+        frame = data[0] if data.ndim >= 3 else data
+        timings["read"] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        entry.update(intensity.compute(data))
+        timings["stats"] = time.perf_counter() - start
+
+        if storage != "hdf5":
+            start = time.perf_counter()
+            if storage == "embedded":
+                # dtype and shape header and little-endian bytes, compressed when the scan compresses well
+                entry["data"] = bson.Binary(array_codec.encode(data))
+            else:
+                # raw bytes, written to GridFS by the process that writes the entry
+                entry["_blob"] = np.ascontiguousarray(data).tobytes()
+            timings["serialize"] = time.perf_counter() - start
+
+        # thumbnail and pyramid tiles of the displayed frame, point spectra have no image to preview
+        if frame.ndim >= 2:
+            start = time.perf_counter()
+            entry.update(data_store.make_preview(f"{file}:{file_mtime}", frame, intensity.contrast_limits(entry, 0)))
+            timings["render"] = time.perf_counter() - start
+
+        return entry, report
+    except Exception as e:
+        report["failed"] = f"cannot read scan: {type(e).__name__}: {e}"
+        return None, report
+    finally:
+        # clean up
+        f.close()
+
+
+def map_files(fn, files, workers=1, max_pending=None):
+    '''
+    Applies a function to every file in a worker thread, or in parallel worker processes if requested, while the
+    caller handles the results. Files are taken from the iterable as results are consumed, so it may be a stream
+    that is still being discovered.
+    :param fn: a module level function taking a filepath, so that it can be sent to worker processes
+    :param files: the full filepaths of the files, as an iterable of strings
+    :param workers: the number of worker processes to use, as an integer. 1 uses a single thread in this process.
+    :param max_pending: the most files being worked on or waiting to be consumed, as an integer, or None for twice
+    the number of workers. Bounds the memory held by results.
+    :return: a generator of (file, result) tuples, in the order of files
+    '''
+    if max_pending is None:
+        max_pending = 2 * max(1, workers)
+
+    executor = ThreadPoolExecutor(max_workers=1) if workers <= 1 else ProcessPoolExecutor(max_workers=workers)
+    with executor:
+        pending = deque()
+        try:
+            for file in files:
+                pending.append((file, executor.submit(fn, file)))
+                if len(pending) >= max_pending:
+                    file, future = pending.popleft()
+                    yield file, future.result()
+            while pending:
+                file, future = pending.popleft()
+                yield file, future.result()
+        finally:
+            # closed early, e.g. cancelled: only wait for the files already being worked on
+            for file, future in pending:
+                future.cancel()
+
+
+def read_files(files, workers=1, storage=data_store.DEFAULT_STORAGE):
+    '''
+    Reads HDF5 files into database entries, in parallel worker processes if requested
+    :param files: the full filepaths of the HDF5 files, as an iterable of strings
+    :param workers: the number of worker processes to use, as an integer. 1 reads in a single thread.
+    :param storage: where the entries' pixel data is kept, one of data_store.STORAGE_MODES
+    :return: a generator of each filepath with its database entry (or None for unreadable files) and read report,
+    as (file, (entry, report)) tuples, in the order of files
+    '''
+    return map_files(partial(read_file, storage=storage), files, workers)
+
+
+def prepare_database(collection, directory, progress_callback, workers=1, batch_size=BATCH_SIZE,
+                     storage=data_store.DEFAULT_STORAGE, stats=None):
     '''
     Finds and submits HDF5 files in a specified directory to the database
     :param collection: the database collection to write to
     :param directory: the root directory in which to find files, as a string
     :param progress_callback: the percent completion of the database, as an integer
+    :param workers: the number of worker processes used to read files, as an integer
+    :param batch_size: the number of entries written to the database at once, as an integer
+    :param storage: where the entries' pixel data is kept, one of data_store.STORAGE_MODES
+    :param stats: the counters to record timings, throughput and skipped and failed files in, as an IngestStats,
+    or None
+    :return: the files that could not be read or written, as a list of (file path, reason) tuples
     '''
-    collection.delete_many({})
+    if stats is None:
+        stats = IngestStats()
 
-    file_paths = []  # List which will store all the full filepaths.
+    data_store.clear(collection)
+    catalog_query.ensure_indexes(collection)
+    data_store.ensure_tile_index(collection)
 
-    # Walk the tree.
-    for root, directories, files in os.walk(directory):
-        for filename in files:
-            if filename[-5:] == ".hdf5":
-                # Join the two strings in order to form the full filepath.
-                filepath = os.path.join(root, filename)
-                file_paths.append(filepath)  # Add it to the list.
+    # files are read and written as they are found, the total is estimated until the walk is over
+    stats.start(final=False)
+    discoverer = Discoverer(directory, stats)
+    discoverer.start()
+    try:
+        with BulkWriter(collection, batch_size) as writer, \
+                BulkWriter(data_store.tile_store(collection), batch_size) as tile_writer:
+            for file, (entry, report) in read_files(discoverer, workers, storage):
+                if entry is not None:
+                    entry["directory"] = directory
+                    with stats.timed("write"):
+                        data_store.store_blob(collection, entry)
+                        data_store.store_tiles(entry, tile_writer)
+                        # store entry in db
+                        writer.insert(entry)
+                stats.record(file, report)
+                progress_callback.emit(stats.percent())
 
-    # max index and current index for calculation of % completion
-    max_index = len(file_paths)
-    index = 1
+            with stats.timed("write"):
+                writer.flush()
+                tile_writer.flush()
+    finally:
+        discoverer.stop()
 
-    if len(file_paths) == 0:
-        # self.textBrowser.append("No hdf5 files found in directory.")
+    if stats.files_done == 0:
+        # no hdf5 files found in directory
         progress_callback.emit(100)
 
-    for file in file_paths:
-        name = os.path.basename(file)
+    for file, reason in writer.failures:
+        stats.fail(file, reason)
+    stats.finish()
+    return stats.failed
 
-        f = h5py.File(file, "r")
 
-        try:
-            # get info to put into database
+def add_files(collection, directory, file_paths, storage=data_store.DEFAULT_STORAGE, batch_size=BATCH_SIZE,
+              stats=None):
+    '''
+    Adds a few files to the database, replacing any entries they already have, without touching the rest of it.
+    Used for scans that have just been written.
+    :param collection: the database collection to write to
+    :param directory: the root directory the files were found in, as a string
+    :param file_paths: the full filepaths of the HDF5 files, as a list of strings
+    :param storage: where the entries' pixel data is kept, one of data_store.STORAGE_MODES
+    :param batch_size: the number of entries written to the database at once, as an integer
+    :param stats: the counters to record timings and skipped and failed files in, as an IngestStats, or None
+    :return: the entries added without their pixel data and previews, as a list of dictionaries, and the files
+    that could not be read or written, as a list of (file path, reason) tuples
+    '''
+    if stats is None:
+        stats = IngestStats()
+    stats.start(len(file_paths), total_size(file_paths))
+    catalog_query.ensure_indexes(collection)
 
-            data = f['entry0']['counter0']['data'][()]
-            # put data into serialized binary form for database storage
-            serialized_data = bson.Binary(pickle.dumps(data, protocol=2))
+    added = []
+    with BulkWriter(collection, batch_size) as writer, \
+            BulkWriter(data_store.tile_store(collection), batch_size) as tile_writer:
+        for file, (entry, report) in read_files(file_paths, 1, storage):
+            if entry is not None:
+                entry["directory"] = directory
+                with stats.timed("write"):
+                    # the old entry is only dropped once the file has been read again
+                    data_store.delete_entries(collection, {"file_path": file})
+                    data_store.store_blob(collection, entry)
+                    data_store.store_tiles(entry, tile_writer)
+                    writer.insert(entry)
+                added.append(entry)
+            stats.record(file, report)
 
-            scan_type = f['entry0']['counter0']['stxm_scan_type'][()].decode('utf8')
+        with stats.timed("write"):
+            writer.flush()
+            tile_writer.flush()
 
-            start_time = f['entry0']['start_time'][()].decode('utf8')
-            # make start_time match the dateTime().toSting() format
-            if start_time != "":
-                start_year = start_time[:4]
-                start_month = start_time[5:7]
-                start_day = start_time[8:10]
+    failed = set()
+    for file, reason in writer.failures:
+        stats.fail(file, reason)
+        failed.add(file)
+    stats.finish()
 
-                start_hour = start_time[11:13]
-                start_minute = start_time[14:16]
+    # what the file list needs to place the new entries
+    light = [{key: value for key, value in entry.items() if key not in ("data", "thumbnail")}
+             for entry in added if entry["file_path"] not in failed]
+    return light, stats.failed
 
-                start_int = int(start_year + start_month + start_day + start_hour + start_minute)
 
-            end_time = f['entry0']['end_time'][()].decode('utf8')
-            # make end_time match the dateTime().toString() format
-            if end_time != "":
-                end_year = end_time[:4]
-                end_month = end_time[5:7]
-                end_day = end_time[8:10]
+def sync_database(collection, directory, progress_callback, workers=1, use_hash=False, batch_size=BATCH_SIZE,
+                  storage=data_store.DEFAULT_STORAGE, stats=None):
+    '''
+    Brings the database in line with a directory without rebuilding it. Only new or modified files are read,
+    entries of deleted files are removed, and unchanged files are left alone.
+    :param collection: the database collection to write to
+    :param directory: the root directory in which to find files, as a string
+    :param progress_callback: the percent completion of the database, as an integer
+    :param workers: the number of worker processes used to read files, as an integer
+    :param use_hash: whether to hash new or modified files so copies of an already indexed scan are not read again,
+    as a boolean
+    :param batch_size: the number of entries written to the database at once, as an integer
+    :param storage: where the pixel data of new entries is kept, one of data_store.STORAGE_MODES
+    :param stats: the counters to record timings, throughput and skipped and failed files in, as an IngestStats,
+    or None
+    :return: the files that could not be read or written, as a list of (file path, reason) tuples
+    '''
+    if stats is None:
+        stats = IngestStats()
+    # lookups by path, and of the blobs and pyramids still used when entries are replaced
+    catalog_query.ensure_indexes(collection)
 
-                end_hour = end_time[11:13]
-                end_minute = end_time[14:16]
+    # the manifest of what is already in the database
+    manifest = {}
+    for item in collection.find({}, {"file_path": 1, "file_size": 1, "file_mtime": 1, "file_hash": 1}):
+        manifest[item["file_path"]] = item
 
-                end_int = int(end_year + end_month + end_day + end_hour + end_minute)
+    # compare against what is on disk
+    signatures = {}
+    unreadable = []
+    for file in find_files(directory):
+        try:
+            signatures[file] = file_signature(file)
+        except OSError as e:
+            unreadable.append((file, f"cannot open file: {e}"))
 
-            xpoints = (f['entry0']['counter0']['sample_x'][()])
-            # pad with 0 if needed
-            if xpoints.size == 1:
-                xpoints = np.append(xpoints, 0)
-                xres = 1
-            else:
-                xres = xpoints.size
-            xstart = xpoints[0]
-            xstop = xpoints[-1]
-            xrange = np.fabs(xstop - xstart)
-            ypoints = (f['entry0']['counter0']['sample_y'][()])
-
-            # pad with 0 if needed
-            if ypoints.size == 1:
-                ypoints = np.append(ypoints, 0)
-                yres = 1
+    removed = [file for file in manifest if file not in signatures]
+    changed = [file for file, signature in signatures.items()
+               if file not in manifest
+               or (manifest[file].get("file_size"), manifest[file].get("file_mtime")) != signature]
+
+    stats.start(len(changed), total_size(changed))
+    stats.add_unchanged(len(signatures) - len(changed))
+    for file, reason in unreadable:
+        stats.fail(file, reason)
+
+    # entries of changed files are replaced once their file has been read, so a file that can no longer be read
+    # keeps its old entry
+    if removed:
+        with stats.timed("write"):
+            data_store.delete_entries(collection, {"file_path": {"$in": removed}})
+
+    # max index and current index for calculation of % completion
+    max_index = len(changed)
+    index = 1
+
+    if len(changed) == 0:
+        progress_callback.emit(100)
+        stats.finish()
+        return stats.failed
+
+    # group the files to read by content, so that each distinct scan is only read once
+    to_read = changed
+    copies = {}
+    if use_hash:
+        known = {}
+        # unchanged entries indexed before hashing was used, hashed only when a new file has the same size
+        unhashed = {}
+        changed_set = set(changed)
+        for file, item in manifest.items():
+            if file in signatures and file not in changed_set:
+                if item.get("file_hash"):
+                    known[item["file_hash"]] = file
+                else:
+                    unhashed.setdefault(signatures[file][0], []).append(file)
+
+        to_read = []
+        hash_start = time.perf_counter()
+        for file, digest in map_files(file_hash, changed, workers):
+            if digest is not None and digest not in known:
+                for candidate in unhashed.pop(signatures[file][0], []):
+                    candidate_digest = file_hash(candidate)
+                    if candidate_digest is not None:
+                        known.setdefault(candidate_digest, candidate)
+                        collection.update_one({"file_path": candidate}, {"$set": {"file_hash": candidate_digest}})
+
+            if digest is None:
+                to_read.append(file)
+            elif digest in known:
+                # copy of a scan already in the database
+                copies.setdefault(known[digest], []).append((file, digest))
             else:
-                yres = ypoints.size
-            ystart = ypoints[0]
-            ystop = ypoints[-1]
-            yrange = np.fabs(ystop - ystart)
-
-            energies_lst = list(f['entry0']['counter0']['energy'][()])
-            # convert energies to integers for database storage and filtering
-            i = 0
-            for energy in energies_lst:
-                energies_lst[i] = int(energy)
-                i += 1
-
-        except Exception as e:
-            pass
-        else:
-            try:
-                # store entry in db
-                result = collection.insert_one({"name": name,
-                                                     "directory": directory,
-                                                     "file_path": file,
-                                                     "data": serialized_data,
-                                                     "scan_type": scan_type,
-                                                     "start_time": start_int,
-                                                     "end_time": end_int,
-                                                     "xrange": int(xrange),
-                                                     "yrange": int(yrange),
-                                                     "xresolution": xres,
-                                                     "yresolution": yres,
-                                                     "energy_min": min(energies_lst),
-                                                     "energy_max": max(energies_lst)
-                                                     })
-
-            except Exception as e:
-                pass
-        finally:
-            # clean up
-            f.close()
+                known[digest] = file
+                to_read.append(file)
+                copies[file] = [(file, digest)]
+        stats.add_time("hash", time.perf_counter() - hash_start)
+
+    def store(entry, file, digest):
+        entry["name"] = os.path.basename(file)
+        entry["directory"] = directory
+        entry["file_path"] = file
+        entry["file_size"], entry["file_mtime"] = signatures[file]
+        if digest is not None:
+            entry["file_hash"] = digest
+        if data_store.storage_of(entry) == "hdf5":
+            # read a copy's data from the copy itself
+            entry["data_ref"] = dict(entry["data_ref"], file_path=file)
+        # store entry in db
+        with stats.timed("write"):
+            writer.insert(entry)
+
+    def replace(files):
+        # drops the old entries of files about to be stored again
+        replaced = [file for file in files if file in manifest]
+        if replaced:
+            with stats.timed("write"):
+                data_store.delete_entries(collection, {"file_path": {"$in": replaced}})
+
+    reading = set(to_read)
+    data_store.ensure_tile_index(collection)
+    with BulkWriter(collection, batch_size) as writer, \
+            BulkWriter(data_store.tile_store(collection), batch_size) as tile_writer:
+        # copies of unchanged entries
+        for source, targets in list(copies.items()):
+            if source in reading:
+                continue
+            entry = collection.find_one({"file_path": source}, {"_id": 0})
+            for file, digest in targets:
+                if entry is not None:
+                    replace([file])
+                    store(dict(entry), file, digest)
+                else:
+                    stats.fail(file, f"copy of {source}, which is no longer in the database")
+                # copies are not read
+                stats.file_done()
+                progress_callback.emit(int((index / max_index) * 100))
+                index += 1
+
+        for file, (entry, report) in read_files(to_read, workers, storage):
+            if entry is not None:
+                replace([copy for copy, _ in copies.get(file, [(file, None)])])
+                # copies share the stored pixel data and pyramid
+                with stats.timed("write"):
+                    data_store.store_blob(collection, entry)
+                    data_store.store_tiles(entry, tile_writer)
+            stats.record(file, report)
+            for copy, digest in copies.get(file, [(file, None)]):
+                if entry is not None:
+                    store(dict(entry), copy, digest)
+                if copy != file:
+                    if "skipped" in report:
+                        stats.skip(copy, report["skipped"])
+                    elif "failed" in report:
+                        stats.fail(copy, report["failed"])
+                    stats.file_done()
+                progress_callback.emit(int((index / max_index) * 100))
+                index += 1
+
+        with stats.timed("write"):
+            writer.flush()
+            tile_writer.flush()
 
-        progress_callback.emit(int((index / max_index) * 100))
-        index += 1
+    for file, reason in writer.failures:
+        stats.fail(file, reason)
+    stats.finish()
+    return stats.failed
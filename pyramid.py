@@ -0,0 +1,99 @@
+import math
+import numpy as np
+import rendering
+
+# edge length of pyramid tiles and the largest edge of thumbnails, in pixels
+TILE_SIZE = 256
+THUMBNAIL_SIZE = 128
+
+
+def downsample(image, factor):
+    '''
+    Shrinks an image by averaging square blocks of pixels, repeating the last row and column to fill partial blocks
+    :param image: the image, as a 2D numpy array
+    :param factor: the edge length of the blocks, as an integer
+    :return: the shrunk image, as a 2D uint8 numpy array
+    '''
+    height, width = image.shape
+    pad_h, pad_w = -height % factor, -width % factor
+    if pad_h or pad_w:
+        image = np.pad(image, ((0, pad_h), (0, pad_w)), mode="edge")
+
+    blocks = image.reshape(image.shape[0] // factor, factor, image.shape[1] // factor, factor)
+    return (blocks.mean(axis=(1, 3), dtype=np.float32) + 0.5).astype(np.uint8)
+
+
+def thumbnail(grey):
+    '''
+    Makes a thumbnail no larger than THUMBNAIL_SIZE on either edge
+    :param grey: the full frame, as a 2D uint8 numpy array
+    :return: the thumbnail, as a 2D uint8 numpy array
+    '''
+    factor = math.ceil(max(grey.shape) / THUMBNAIL_SIZE)
+    if factor <= 1:
+        return grey
+    return downsample(grey, factor)
+
+
+def build_levels(grey):
+    '''
+    Makes a multi-resolution pyramid, halving the frame until it fits in a single tile
+    :param grey: the full frame, as a 2D uint8 numpy array
+    :return: the levels from full resolution down, as a list of 2D uint8 numpy arrays
+    '''
+    levels = [grey]
+    while max(levels[-1].shape) > TILE_SIZE:
+        levels.append(downsample(levels[-1], 2))
+    return levels
+
+
+def split_tiles(level):
+    '''
+    Cuts a pyramid level into tiles
+    :param level: the level, as a 2D uint8 numpy array
+    :return: a generator of (row, column, tile) tuples, the tiles as 2D uint8 numpy arrays
+    '''
+    height, width = level.shape
+    for row in range(0, math.ceil(height / TILE_SIZE)):
+        for col in range(0, math.ceil(width / TILE_SIZE)):
+            yield row, col, level[row * TILE_SIZE:(row + 1) * TILE_SIZE, col * TILE_SIZE:(col + 1) * TILE_SIZE]
+
+
+def level_for(shapes, size):
+    '''
+    Picks the coarsest pyramid level that still fills a display of the given size
+    :param shapes: the shapes of the levels from full resolution down, as a list of [height, width] lists
+    :param size: the edge length of the display, in pixels
+    :return: the level index, as an integer
+    '''
+    for level in range(len(shapes) - 1, -1, -1):
+        if max(shapes[level]) >= size:
+            return level
+    return 0
+
+
+def assemble(tiles, shape):
+    '''
+    Puts the tiles of a pyramid level back together
+    :param tiles: the tiles, as (row, column, tile) tuples
+    :param shape: the shape of the level, as a [height, width] list
+    :return: the level, as a 2D uint8 numpy array
+    '''
+    image = np.zeros(shape, dtype=np.uint8)
+    for row, col, tile in tiles:
+        image[row * TILE_SIZE:row * TILE_SIZE + tile.shape[0], col * TILE_SIZE:col * TILE_SIZE + tile.shape[1]] = tile
+    return image
+
+
+def preview(frame, low=None, high=None):
+    '''
+    Builds the thumbnail and, for frames larger than a tile, the pyramid of a frame
+    :param frame: the frame, as a 2D numpy array
+    :param low: the frame's minimum, as a float, or None to find it
+    :param high: the frame's maximum, as a float, or None to find it
+    :return: the thumbnail, as a 2D uint8 numpy array, and the pyramid levels, as a list of 2D uint8 numpy arrays
+    (empty for frames that fit in a tile)
+    '''
+    grey = rendering.to_uint8(frame, low, high)
+    levels = build_levels(grey) if max(grey.shape) > TILE_SIZE else []
+    return thumbnail(grey), levels
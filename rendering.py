@@ -0,0 +1,68 @@
+import numpy as np
+
+# contrast modes offered in the UI, as the percentile clipped at each end of the intensity range
+CONTRAST_MODES = {"Min/Max": None, "Clip 0.1%": 0.1, "Clip 1%": 1.0, "Clip 5%": 5.0}
+
+
+def contrast_limits(frame, percentile=None):
+    '''
+    Finds the intensities mapped to black and white
+    :param frame: the frame, as a numpy array
+    :param percentile: the percentage of pixels clipped at each end, as a float, or None for the full range
+    :return: the low and high limits, as floats
+    '''
+    if percentile:
+        low, high = np.nanpercentile(frame, [percentile, 100 - percentile])
+    else:
+        low, high = np.nanmin(frame), np.nanmax(frame)
+    return float(low), float(high)
+
+
+def to_uint8(frame, low=None, high=None, percentile=None, gamma=1.0):
+    '''
+    Maps a frame's intensities to 8 bit grey levels in a few vectorized passes
+    :param frame: the frame, as a numpy array
+    :param low: the intensity mapped to black, as a float, or None to find it from the frame
+    :param high: the intensity mapped to white, as a float, or None to find it from the frame
+    :param percentile: the percentage of pixels clipped at each end when finding the limits, as a float
+    :param gamma: the exponent applied to the scaled intensities, as a float. Below 1 brightens dark areas.
+    :return: the grey levels, as a uint8 numpy array with the frame's shape
+    '''
+    if low is None or high is None:
+        found_low, found_high = contrast_limits(frame, percentile)
+        low = found_low if low is None else low
+        high = found_high if high is None else high
+
+    scale = 1.0 / (high - low) if high > low else 0.0
+
+    # scale to 0..1 in a single float32 buffer, then work in place
+    scaled = np.subtract(frame, low, dtype=np.float32)
+    scaled *= scale
+    np.clip(scaled, 0.0, 1.0, out=scaled)
+    np.nan_to_num(scaled, copy=False)
+    if gamma != 1.0:
+        np.power(scaled, gamma, out=scaled)
+    scaled *= 255.0
+    scaled += 0.5
+    return scaled.astype(np.uint8)
+
+
+def to_qimage(grey, flip=True):
+    '''
+    Copies 8 bit grey levels straight into a QImage buffer, without going through an image file
+    :param grey: the grey levels, as a 2D uint8 numpy array
+    :param flip: whether to flip the image vertically so the first row is at the bottom, as a boolean
+    :return: the image, as a QImage
+    '''
+    # imported here so contrast mapping works without Qt, e.g. in the command line tools
+    from PyQt5 import QtGui
+
+    height, width = grey.shape
+    image = QtGui.QImage(width, height, QtGui.QImage.Format_Grayscale8)
+
+    # view the image's own rows (padded to 4 bytes) as an array and copy into it, flipping on the way
+    bits = image.bits()
+    bits.setsize(image.bytesPerLine() * height)
+    buffer = np.frombuffer(bits, dtype=np.uint8).reshape(height, image.bytesPerLine())
+    buffer[:, :width] = grey[::-1] if flip else grey
+    return image
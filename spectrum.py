@@ -0,0 +1,64 @@
+import numpy as np
+import data_store
+
+# frames reduced at a time, bounding the memory used for a stack
+CHUNK_FRAMES = 32
+
+
+def region_of(roi):
+    '''
+    Finds the rows and columns that bound a region of interest
+    :param roi: the region, as an (x0, y0, x1, y1) rectangle in pixels with exclusive ends, or a 2D boolean mask
+    :return: the rows and columns, as slices, and the mask cropped to them (None for rectangles)
+    '''
+    if isinstance(roi, np.ndarray):
+        ys, xs = np.nonzero(roi)
+        if ys.size == 0:
+            raise ValueError("The region of interest is empty")
+        rows = slice(int(ys.min()), int(ys.max()) + 1)
+        cols = slice(int(xs.min()), int(xs.max()) + 1)
+        return rows, cols, roi[rows, cols]
+
+    x0, y0, x1, y1 = roi
+    if x1 <= x0 or y1 <= y0:
+        raise ValueError("The region of interest is empty")
+    return slice(y0, y1), slice(x0, x1), None
+
+
+def roi_spectrum(collection, entry, roi, reduce="mean", chunk_frames=CHUNK_FRAMES, progress_callback=None):
+    '''
+    Computes the spectrum of a region of interest, streaming through the stack a block of frames at a time and
+    reading only the rows and columns around the region
+    :param collection: the database collection the entry belongs to
+    :param entry: the entry, as a dictionary
+    :param roi: the region, as an (x0, y0, x1, y1) rectangle in pixels with exclusive ends, or a 2D boolean mask
+    :param reduce: how pixels are combined per energy, "mean" or "sum"
+    :param chunk_frames: the number of frames reduced at a time, as an integer
+    :param progress_callback: the percent completion, as an integer, or None
+    :return: the energies, in eV, and the reduced intensities, as 1D numpy arrays
+    '''
+    if reduce not in ("mean", "sum"):
+        raise ValueError(f"Unknown reduction {reduce}, expected mean or sum")
+
+    rows, cols, mask = region_of(roi)
+    count = data_store.frame_count(entry)
+
+    values = []
+    done = 0
+    for block in data_store.iter_blocks(collection, entry, chunk_frames, rows, cols):
+        if mask is None:
+            sums = block.sum(axis=(1, 2), dtype=np.float64)
+            pixels = block.shape[1] * block.shape[2]
+        else:
+            # (frames, pixels in the mask)
+            sums = block[:, mask].sum(axis=1, dtype=np.float64)
+            pixels = int(np.count_nonzero(mask))
+        values.append(sums / pixels if reduce == "mean" else sums)
+
+        done += block.shape[0]
+        if progress_callback is not None:
+            progress_callback.emit(int(done / count * 100))
+
+    values = np.concatenate(values) if values else np.empty(0)
+    energies = np.asarray(entry.get("energies", np.arange(values.size)), dtype=np.float64)
+    return energies[:values.size], values
@@ -0,0 +1,595 @@
+import bson
+import json
+import sqlite3
+import threading
+import bson.errors
+from pymongo.errors import BulkWriteError, WriteError
+import catalog_query
+
+# comparison operators translated to SQL, other predicates are checked on the decoded documents
+OPERATORS = {"$eq": "=", "$ne": "IS NOT", "$gt": ">", "$gte": ">=", "$lt": "<", "$lte": "<="}
+SCALARS = (int, float, str)
+# bulky top level fields, each kept in a column of its own, "_<field>", so reading metadata never decodes them
+PAYLOAD_FIELDS = ("data", "thumbnail")
+# rows fetched from SQLite at a time while a cursor is iterated
+FETCH_SIZE = 64
+
+
+def _quote(name):
+    return '"' + name.replace('"', '""') + '"'
+
+
+def _is_scalar(value):
+    return value is None or (isinstance(value, SCALARS) and not isinstance(value, bool))
+
+
+def _set_field(document, field, value):
+    parts = field.split(".")
+    for part in parts[:-1]:
+        document = document.setdefault(part, {})
+    document[parts[-1]] = value
+
+
+def _is_inclusion(projection):
+    fields = [flag for field, flag in projection.items() if field != "_id"]
+    return all(fields) if fields else bool(projection.get("_id", 1))
+
+
+def _payload_fields(projection, query):
+    '''
+    Finds the bulky fields a query has to read
+    :param projection: the projection, as a dictionary, or None
+    :param query: the part of the query checked on decoded documents, as a dictionary
+    :return: those of PAYLOAD_FIELDS that are returned or filtered on, as a list of strings
+    '''
+    used = {field.split(".")[0] for field in query}
+    if not projection:
+        return list(PAYLOAD_FIELDS)
+    if _is_inclusion(projection):
+        used.update(field.split(".")[0] for field, flag in projection.items() if field != "_id")
+        return [field for field in PAYLOAD_FIELDS if field in used]
+    return [field for field in PAYLOAD_FIELDS if field in used or projection.get(field, 1)]
+
+
+def _project(document, projection):
+    '''
+    Applies a MongoDB style projection to a decoded document
+    :param document: the document, as a dictionary
+    :param projection: the fields to include ({field: 1}) or exclude ({field: 0}), as a dictionary, or None
+    :return: the projected document, as a dictionary
+    '''
+    if not projection:
+        return document
+
+    keep_id = projection.get("_id", 1)
+    fields = {field: flag for field, flag in projection.items() if field != "_id"}
+    if _is_inclusion(projection):
+        projected = {"_id": document["_id"]} if keep_id else {}
+        for field in fields:
+            value = catalog_query.get_field(document, field)
+            if value is not None or field in document:
+                _set_field(projected, field, value)
+        return projected
+
+    projected = dict(document)
+    if not keep_id:
+        projected.pop("_id", None)
+    for field in fields:
+        parts = field.split(".")
+        parent = projected
+        for part in parts[:-1]:
+            if not isinstance(parent.get(part), dict):
+                break
+            parent[part] = dict(parent[part])
+            parent = parent[part]
+        else:
+            parent.pop(parts[-1], None)
+    return projected
+
+
+class InsertOneResult:
+    def __init__(self, inserted_id):
+        self.inserted_id = inserted_id
+
+
+class InsertManyResult:
+    def __init__(self, inserted_ids):
+        self.inserted_ids = inserted_ids
+
+
+class DeleteResult:
+    def __init__(self, deleted_count):
+        self.deleted_count = deleted_count
+
+
+class UpdateResult:
+    def __init__(self, matched_count, modified_count):
+        self.matched_count = matched_count
+        self.modified_count = modified_count
+
+
+class SQLiteDatabase:
+    def __init__(self, path):
+        '''
+        Opens an embedded catalog database in a single SQLite file, creating it if needed
+        :param path: the database file, as a string, or ":memory:"
+        '''
+        self.path = path
+        self.name = path
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        # the UI reads and writes from worker threads, one statement at a time
+        self.lock = threading.RLock()
+        with self.lock:
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.collections = {}
+
+    def __getitem__(self, name):
+        with self.lock:
+            if name not in self.collections:
+                self.collections[name] = SQLiteCollection(self, name)
+            return self.collections[name]
+
+    def execute(self, sql, params=()):
+        '''
+        Runs a single statement in its own transaction
+        :param sql: the statement, as a string
+        :param params: the statement parameters, as a sequence
+        :return: the result rows, as a list of tuples
+        '''
+        with self.lock, self.connection:
+            return self.connection.execute(sql, params).fetchall()
+
+    def iterate(self, sql, params=()):
+        '''
+        Runs a query, fetching its rows a few at a time as they are used rather than all at once
+        :param sql: the query, as a string
+        :param params: the query parameters, as a sequence
+        :return: a generator of the result rows, as tuples
+        '''
+        with self.lock:
+            cursor = self.connection.execute(sql, params)
+        try:
+            while True:
+                # other threads may use the connection between fetches
+                with self.lock:
+                    rows = cursor.fetchmany(FETCH_SIZE)
+                if not rows:
+                    return
+                yield from rows
+        finally:
+            with self.lock:
+                cursor.close()
+
+    def drop_collection(self, name):
+        with self.lock:
+            self.execute(f"DROP TABLE IF EXISTS {_quote(name)}")
+            # collections stay usable after a drop, as in MongoDB
+            if name in self.collections:
+                self.collections[name].create()
+
+    def blob_store(self, name):
+        '''
+        Gets the store holding raw pixel data, standing in for GridFS
+        :param name: the store name, as a string
+        :return: the store, as a SQLiteBlobStore
+        '''
+        return SQLiteBlobStore(self, name)
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+
+class SQLiteCursor:
+    def __init__(self, collection, query, projection):
+        '''
+        Lazily runs a query, in the manner of a pymongo cursor, fetching rows as they are iterated
+        :param collection: the collection queried, as a SQLiteCollection
+        :param query: the query, as a dictionary
+        :param projection: the projection, as a dictionary, or None
+        '''
+        self.collection = collection
+        self.query = query or {}
+        self.projection = projection
+        self.order = []
+        self.skip_count = 0
+        self.limit_count = 0
+
+    def sort(self, key, direction=1):
+        self.order.extend([(key, direction)] if isinstance(key, str) else key)
+        return self
+
+    def skip(self, count):
+        self.skip_count = count
+        return self
+
+    def limit(self, count):
+        self.limit_count = count
+        return self
+
+    def __iter__(self):
+        collection = self.collection
+        where, params, rest = collection.translate(self.query)
+        in_sql = all(key == "_id" or key in collection.columns for key, _ in self.order)
+
+        # projections of indexed fields are answered from their columns alone, without decoding documents
+        fields = None
+        if self.projection and not rest and in_sql:
+            fields = [field for field, flag in self.projection.items() if flag and field != "_id"]
+            if not (fields and all(field in collection.columns for field in fields)
+                    and all(flag for field, flag in self.projection.items() if field != "_id")):
+                fields = None
+        # pixel data and thumbnails are only read by the queries that return them
+        payload = _payload_fields(self.projection, rest) if fields is None else []
+        select = ["_id"] + (fields if fields is not None else ["doc"] + [f"_{field}" for field in payload])
+
+        sql = f"SELECT {', '.join(_quote(field) for field in select)} FROM {collection.table}"
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        if self.order and in_sql:
+            sql += " ORDER BY " + ", ".join(f"{_quote(key)} {'DESC' if direction < 0 else 'ASC'}"
+                                            for key, direction in self.order)
+        if not rest and in_sql:
+            sql += " LIMIT ? OFFSET ?"
+            params = params + [self.limit_count or -1, self.skip_count]
+        rows = collection.database.iterate(sql, params)
+
+        if fields is not None:
+            keep_id = self.projection.get("_id", 1)
+            for row in rows:
+                document = {"_id": row[0]} if keep_id else {}
+                for field, value in zip(fields, row[1:]):
+                    if value is not None:
+                        _set_field(document, field, value)
+                yield document
+            return
+
+        documents = (collection.decode(row) for row in rows)
+        if rest:
+            documents = (document for document in documents if catalog_query.matches(rest, document))
+        if not in_sql:
+            # one stable sort per key, last key first, so each key keeps its own direction. Missing fields sort
+            # first, as in MongoDB.
+            documents = list(documents)
+            for key, direction in reversed(self.order):
+                documents.sort(key=lambda document: (catalog_query.get_field(document, key) is not None,
+                                                     catalog_query.get_field(document, key)), reverse=direction < 0)
+            documents = iter(documents)
+        if rest or not in_sql:
+            skipped = 0
+            yielded = 0
+            for document in documents:
+                if skipped < self.skip_count:
+                    skipped += 1
+                    continue
+                yield _project(document, self.projection)
+                yielded += 1
+                if self.limit_count and yielded >= self.limit_count:
+                    return
+            return
+
+        for document in documents:
+            yield _project(document, self.projection)
+
+
+class SQLiteCollection:
+    def __init__(self, database, name):
+        '''
+        Holds a collection of documents in a SQLite table, supporting the subset of the pymongo Collection interface
+        the viewer uses. Documents are stored BSON encoded, with their pixel data and thumbnail encoded apart so
+        queries for metadata alone never decode them, and every indexed field is also copied into a column of its
+        own so filters and sorts on it run in SQL against a real index.
+        :param database: the database, as a SQLiteDatabase
+        :param name: the collection name, as a string
+        '''
+        self.database = database
+        self.name = name
+        self.table = _quote(name)
+        self.columns = []
+        self.create()
+
+    def create(self):
+        '''
+        Creates the collection's table if it does not exist yet and finds its indexed columns
+        '''
+        self.database.execute(f"CREATE TABLE IF NOT EXISTS {self.table} (_id INTEGER PRIMARY KEY, doc BLOB NOT NULL)")
+        columns = [row[1] for row in self.database.execute(f"PRAGMA table_info({self.table})")]
+        missing = [field for field in PAYLOAD_FIELDS if f"_{field}" not in columns]
+        for field in missing:
+            self.database.execute(f"ALTER TABLE {self.table} ADD COLUMN {_quote('_' + field)} BLOB")
+        self.payload_columns = [_quote(f"_{field}") for field in PAYLOAD_FIELDS]
+        self.columns = [column for column in columns
+                        if column not in ["_id", "doc"] + [f"_{field}" for field in PAYLOAD_FIELDS]]
+        if missing:
+            self.split_payloads()
+
+    def split_payloads(self):
+        '''
+        Moves the bulky fields of documents written by earlier versions, which kept everything in doc, to their own
+        columns. Run once, when a catalog from an earlier version is first opened.
+        '''
+        ids = [row[0] for row in self.database.execute(f"SELECT _id FROM {self.table}")]
+        assignments = ", ".join(["doc = ?"] + [f"{column} = ?" for column in self.payload_columns])
+        for start in range(0, len(ids), FETCH_SIZE):
+            updates = []
+            for row in self.database.execute(f"SELECT _id, doc FROM {self.table} "
+                                             f"WHERE _id IN (SELECT value FROM json_each(?))",
+                                             [json.dumps(ids[start:start + FETCH_SIZE])]):
+                document = self.decode(row)
+                if any(field in document for field in PAYLOAD_FIELDS):
+                    body, payload, _ = self.encode(document)
+                    updates.append([body] + payload + [row[0]])
+            with self.database.lock, self.database.connection as connection:
+                connection.executemany(f"UPDATE {self.table} SET {assignments} WHERE _id = ?", updates)
+
+    def translate(self, query):
+        '''
+        Splits a query into SQL predicates on indexed columns and a remainder checked on the decoded documents
+        :param query: the query, as a dictionary
+        :return: the SQL predicates, as a list of strings, their parameters, as a list, and the rest of the query,
+        as a dictionary
+        '''
+        where = []
+        params = []
+        rest = {}
+        for field, condition in (query or {}).items():
+            if field != "_id" and field not in self.columns:
+                rest[field] = condition
+                continue
+
+            column = _quote(field)
+            if not (isinstance(condition, dict) and condition and all(op.startswith("$") for op in condition)):
+                condition = {"$eq": condition}
+            for op, operand in condition.items():
+                if op in OPERATORS and _is_scalar(operand):
+                    where.append(f"{column} {'IS' if op == '$eq' and operand is None else OPERATORS[op]} ?")
+                    params.append(operand)
+                elif op == "$in" and all(_is_scalar(value) and value is not None for value in operand):
+                    # a single parameter however long the list is
+                    where.append(f"{column} IN (SELECT value FROM json_each(?))")
+                    params.append(json.dumps(list(operand)))
+                else:
+                    rest.setdefault(field, {})[op] = operand
+        return where, params, rest
+
+    def encode(self, document):
+        body = bson.encode({key: value for key, value in document.items()
+                            if key != "_id" and key not in PAYLOAD_FIELDS})
+        payload = [bson.encode({key: document[key]}) if key in document else None for key in PAYLOAD_FIELDS]
+        values = []
+        for column in self.columns:
+            value = catalog_query.get_field(document, column)
+            values.append(value if _is_scalar(value) else None)
+        return body, payload, values
+
+    def decode(self, row):
+        '''
+        Rebuilds a document from its row
+        :param row: the _id and doc columns followed by any of the PAYLOAD_FIELDS columns, as a tuple
+        :return: the document, as a dictionary
+        '''
+        document = {"_id": row[0]}
+        document.update(bson.decode(row[1]))
+        for payload in row[2:]:
+            if payload is not None:
+                document.update(bson.decode(payload))
+        return document
+
+    def find(self, query=None, projection=None):
+        return SQLiteCursor(self, query, projection)
+
+    def find_one(self, query=None, projection=None):
+        return next(iter(self.find(query, projection).limit(1)), None)
+
+    def insert_many(self, documents, ordered=True):
+        '''
+        Inserts documents in a single transaction, setting their _id as pymongo does. A document that cannot be
+        inserted only fails itself: ordered inserts stop there, unordered inserts carry on with the rest, and either
+        way the documents before it are kept.
+        :param documents: the documents, as an iterable of dictionaries
+        :param ordered: whether to stop at the first document that fails, as a boolean
+        :return: the inserted ids, as an InsertManyResult
+        :raises BulkWriteError: if any document failed, with pymongo's details of which ones
+        '''
+        columns = ", ".join(["_id", "doc"] + self.payload_columns + [_quote(column) for column in self.columns])
+        marks = ", ".join("?" * (len(self.columns) + len(self.payload_columns) + 2))
+        sql = f"INSERT INTO {self.table} ({columns}) VALUES ({marks})"
+
+        inserted = []
+        errors = []
+        with self.database.lock, self.database.connection as connection:
+            for index, document in enumerate(documents):
+                try:
+                    body, payload, values = self.encode(document)
+                    given = document.get("_id")
+                    # a failed statement is rolled back on its own, leaving the transaction open
+                    cursor = connection.execute(sql, [given if isinstance(given, int) else None, body] + payload
+                                                + values)
+                except (sqlite3.Error, bson.errors.BSONError, TypeError, ValueError, OverflowError) as e:
+                    errors.append({"index": index,
+                                   "code": 11000 if isinstance(e, sqlite3.IntegrityError) else 2,
+                                   "errmsg": str(e),
+                                   "op": document})
+                    if ordered:
+                        break
+                    continue
+                document["_id"] = cursor.lastrowid
+                inserted.append(cursor.lastrowid)
+
+        if errors:
+            raise BulkWriteError({"writeErrors": errors,
+                                  "writeConcernErrors": [],
+                                  "nInserted": len(inserted),
+                                  "nUpserted": 0,
+                                  "nMatched": 0,
+                                  "nModified": 0,
+                                  "nRemoved": 0,
+                                  "upserted": []})
+        return InsertManyResult(inserted)
+
+    def insert_one(self, document):
+        try:
+            return InsertOneResult(self.insert_many([document]).inserted_ids[0])
+        except BulkWriteError as e:
+            error = e.details["writeErrors"][0]
+            raise WriteError(error["errmsg"], error["code"])
+
+    def delete_many(self, query):
+        where, params, rest = self.translate(query)
+        if rest:
+            ids = [document["_id"] for document in self.find(query, {"_id": 1})]
+            where = ["_id IN (SELECT value FROM json_each(?))"]
+            params = [json.dumps(ids)]
+        sql = f"DELETE FROM {self.table}"
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        with self.database.lock, self.database.connection as connection:
+            return DeleteResult(connection.execute(sql, params).rowcount)
+
+    def update_one(self, query, update):
+        '''
+        Updates the first document matching a query
+        :param query: the query, as a dictionary
+        :param update: the update, as a dictionary holding only a "$set" of fields to values
+        :return: the counts of matched and modified documents, as an UpdateResult
+        '''
+        if set(update) != {"$set"}:
+            raise ValueError("Only $set updates are supported")
+
+        with self.database.lock:
+            document = self.find_one(query)
+            if document is None:
+                return UpdateResult(0, 0)
+            for field, value in update["$set"].items():
+                _set_field(document, field, value)
+            self.replace(document)
+        return UpdateResult(1, 1)
+
+    def replace(self, document):
+        body, payload, values = self.encode(document)
+        assignments = ", ".join(["doc = ?"] + [f"{column} = ?" for column in self.payload_columns]
+                                + [f"{_quote(column)} = ?" for column in self.columns])
+        self.database.execute(f"UPDATE {self.table} SET {assignments} WHERE _id = ?",
+                              [body] + payload + values + [document["_id"]])
+
+    def count_documents(self, query, limit=0):
+        where, params, rest = self.translate(query)
+        if rest:
+            count = 0
+            for _ in self.find(query, {"_id": 1}).limit(limit):
+                count += 1
+            return count
+
+        sql = f"SELECT 1 FROM {self.table}"
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        sql = f"SELECT COUNT(*) FROM ({sql} LIMIT ?)"
+        return self.database.execute(sql, params + [limit or -1])[0][0]
+
+    def estimated_document_count(self):
+        return self.database.execute(f"SELECT COUNT(*) FROM {self.table}")[0][0]
+
+    def create_index(self, keys):
+        '''
+        Creates an index, first copying each of its fields into a column of its own
+        :param keys: the field, as a string, or the fields and directions, as a list of tuples
+        :return: the index name, as a string
+        '''
+        if isinstance(keys, str):
+            keys = [(keys, 1)]
+        fields = [field for field, _ in keys]
+
+        with self.database.lock:
+            added = [field for field in fields if field != "_id" and field not in self.columns]
+            for field in added:
+                self.database.execute(f"ALTER TABLE {self.table} ADD COLUMN {_quote(field)}")
+                self.columns.append(field)
+            if added:
+                # fill the new columns from the documents already stored
+                rows = self.database.iterate(f"SELECT _id, doc FROM {self.table}")
+                assignments = ", ".join(f"{_quote(field)} = ?" for field in added)
+                updates = []
+                for row in rows:
+                    document = self.decode(row)
+                    values = [catalog_query.get_field(document, field) for field in added]
+                    updates.append([value if _is_scalar(value) else None for value in values] + [row[0]])
+                with self.database.connection as connection:
+                    connection.executemany(f"UPDATE {self.table} SET {assignments} WHERE _id = ?", updates)
+
+            name = f"{self.name}_{'_'.join(f'{field}_{direction}' for field, direction in keys)}"
+            order = ", ".join(f"{_quote(field)} {'DESC' if direction == -1 else 'ASC'}" for field, direction in keys)
+            self.database.execute(f"CREATE INDEX IF NOT EXISTS {_quote(name)} ON {self.table} ({order})")
+        return name
+
+    def explain_query(self, query):
+        '''
+        Describes how SQLite runs a query
+        :param query: the query, as a dictionary
+        :return: the query plan and any predicates left to check on decoded documents, as a dictionary
+        '''
+        where, params, rest = self.translate(query)
+        sql = f"SELECT _id FROM {self.table}"
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        plan = self.database.execute("EXPLAIN QUERY PLAN " + sql, params)
+        return {"plan": [row[-1] for row in plan], "unindexed": sorted(rest)}
+
+    def drop(self):
+        self.database.drop_collection(self.name)
+
+
+class SQLiteBlob:
+    def __init__(self, store, blob_id, length):
+        '''
+        Reads a stored blob piecewise, in the manner of a GridFS file
+        :param store: the store holding the blob, as a SQLiteBlobStore
+        :param blob_id: the blob id, as an integer
+        :param length: the blob size, as an integer number of bytes
+        '''
+        self.store = store
+        self.blob_id = blob_id
+        self.length = length
+        self.position = 0
+
+    def seek(self, position):
+        self.position = position
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = self.length - self.position
+        rows = self.store.database.execute(f"SELECT substr(data, ?, ?) FROM {self.store.table} WHERE _id = ?",
+                                           [self.position + 1, size, self.blob_id])
+        data = rows[0][0] if rows else b""
+        self.position += len(data)
+        return data
+
+
+class SQLiteBlobStore:
+    def __init__(self, database, name):
+        '''
+        Keeps raw pixel data in a table of its own, standing in for GridFS
+        :param database: the database, as a SQLiteDatabase
+        :param name: the store name, as a string
+        '''
+        self.database = database
+        self.table = _quote(name)
+        database.execute(f"CREATE TABLE IF NOT EXISTS {self.table} "
+                         "(_id INTEGER PRIMARY KEY, filename TEXT, data BLOB NOT NULL)")
+
+    def put(self, data, filename=None):
+        with self.database.lock, self.database.connection as connection:
+            return connection.execute(f"INSERT INTO {self.table} (filename, data) VALUES (?, ?)",
+                                      [filename, data]).lastrowid
+
+    def get(self, blob_id):
+        rows = self.database.execute(f"SELECT length(data) FROM {self.table} WHERE _id = ?", [blob_id])
+        if not rows:
+            raise KeyError(f"No blob with id {blob_id}")
+        return SQLiteBlob(self, blob_id, rows[0][0])
+
+    def delete(self, blob_id):
+        self.database.execute(f"DELETE FROM {self.table} WHERE _id = ?", [blob_id])
+
+    def clear(self):
+        self.database.execute(f"DELETE FROM {self.table}")
@@ -0,0 +1,404 @@
+import csv
+import getopt
+import json
+import os
+import re
+import sys
+import time
+import catalog
+
+# the database modules are imported by the commands that need them, keeping startup light
+
+USAGE = f'''Usage: python {sys.argv[0]} <command> [options]
+
+Commands:
+  build -d <dir>   rebuild the database from the HDF5 files in a directory
+  sync -d <dir>    update the database with new, modified and deleted files only
+  watch -d <dir>   add new scans to the database as they are written, until interrupted
+  migrate          re-encode pixel data pickled by earlier versions in the compact format and
+                   compute intensity statistics missing from older entries
+  query            list the files matching filters
+  export -o <dir>  write the files matching filters as images or arrays, with their catalog
+                   fields in metadata.csv
+
+Options:
+  -h, --help                  show this message
+  -u, --uri <uri>             database to use, mongodb://host:port or
+                              sqlite://path (default mongodb://localhost:27017)
+  -p, --progress              print progress while building, syncing or exporting
+  -d, --directory <dir>       directory to build or sync from
+  -w, --workers <n>           worker processes reading files, 0 uses every core (default 1,
+                              every core when exporting)
+  -b, --batch-size <n>        entries written to the database at once
+  -m, --storage <mode>        where pixel data is kept: embedded, hdf5 or gridfs
+      --hash                  hash files when syncing so copies are only read once
+      --report <file>         write timings, throughput and skipped and failed files as JSON
+      --poll                  watch by polling, e.g. on network file systems without inotify
+      --compression <c>       compression of migrated pixel data: auto, none, zlib or lz4 (default auto)
+  -s, --scan-type <type>      filter by scan type
+      --start <time>          filter by earliest start time, as YYYY-MM-DD[ HH:MM]
+      --end <time>            filter by latest end time, as YYYY-MM-DD[ HH:MM]
+      --xres <n>, --yres <n>  filter by x or y resolution
+      --xrange <n>, --yrange <n>
+                              filter by x or y range
+      --emin <eV>, --emax <eV>
+                              filter by lowest start and highest end energy
+      --peak-min <n>, --peak-max <n>
+                              filter by the brightest pixel of a scan, e.g. to leave out
+                              empty or saturated scans
+  -f, --format <json|csv>     query output format (default json)
+  -o, --output <file>         write query output to a file instead of the screen, or the
+                              directory to export to
+      --formats <list>        comma separated export formats: png, tiff, npy, npz (default npz)
+  -l, --limit <n>             list at most n files'''
+
+class PrintProgress:
+    def __init__(self, enabled, stats):
+        '''
+        Stands in for the progress signal of the GUI, printing the percent completion, throughput and time left
+        :param enabled: whether to print anything, as a boolean
+        :param stats: the counters of the run, as an IngestStats
+        '''
+        self.enabled = enabled
+        self.stats = stats
+
+    def emit(self, progress):
+        if self.enabled:
+            # pad over the end of a longer previous line
+            print(f"Database creation: {progress}%  {self.stats.progress_text():<60}",
+                  end="\r" if progress < 100 else "\n", flush=True)
+
+
+class PrintExportProgress:
+    def emit(self, progress):
+        print(f"Export: {progress}%", end="\r" if progress < 100 else "\n", flush=True)
+
+
+def parse_time(text, end=False):
+    '''
+    Converts a date and optional time to the integer form stored in the database
+    :param text: the date, as a string in the form YYYY-MM-DD[ HH:MM]
+    :param end: whether a date without a time means the end of that day, as a boolean
+    :return: the time, as an integer in the form YYYYMMDDHHMM
+    '''
+    digits = re.sub(r"\D", "", text)
+    if len(digits) == 8:
+        digits += "2359" if end else "0000"
+    if len(digits) != 12:
+        raise ValueError(f"Cannot read time {text}, expected YYYY-MM-DD[ HH:MM]")
+    return int(digits)
+
+
+def build(collection, directory, progress, workers, batch_size, storage, sync=False, use_hash=False, report=""):
+    '''
+    Builds or syncs the database from a directory, printing a summary and any failures
+    :param collection: the database collection
+    :param directory: the root directory in which to find files, as a string
+    :param progress: whether to print progress, as a boolean
+    :param workers: the number of worker processes reading files, as an integer
+    :param batch_size: the number of entries written at once, as an integer, or None for the default
+    :param storage: where pixel data is kept, as a string, or None for the default
+    :param sync: whether to only read new and modified files, as a boolean
+    :param use_hash: whether to hash files when syncing, as a boolean
+    :param report: the file to write the JSON summary of the run to, as a string, or "" for none
+    :return: the number of files that could not be added, as an integer
+    '''
+    import catalog_query
+    import prepare_database
+    from ingest_stats import IngestStats
+
+    stats = IngestStats()
+    kwargs = {"workers": workers, "stats": stats}
+    if batch_size is not None:
+        kwargs["batch_size"] = batch_size
+    if storage is not None:
+        kwargs["storage"] = storage
+
+    start = time.perf_counter()
+    if sync:
+        failures = prepare_database.sync_database(collection, directory, PrintProgress(progress, stats),
+                                                  use_hash=use_hash, **kwargs)
+    else:
+        failures = prepare_database.prepare_database(collection, directory, PrintProgress(progress, stats), **kwargs)
+    catalog_query.ensure_indexes(collection)
+
+    for file_path, reason in failures:
+        print(f"{file_path} not added to database: {reason}", file=sys.stderr)
+    for line in stats.report():
+        print(line)
+    if report != "":
+        stats.write_report(report)
+    print(f"Database ready: {collection.estimated_document_count()} files, {len(failures)} failed, "
+          f"{time.perf_counter() - start:.1f} s.")
+    return len(failures)
+
+
+def watch(collection, directory, batch_size, storage, use_inotify=True):
+    '''
+    Adds new scans to the database as they are written to a directory, printing each one, until interrupted
+    :param collection: the database collection
+    :param directory: the root directory to watch, as a string
+    :param batch_size: the number of entries written at once, as an integer, or None for the default
+    :param storage: where pixel data is kept, as a string, or None for the default
+    :param use_inotify: whether to use inotify when available, as a boolean
+    '''
+    import prepare_database
+    import watcher
+
+    kwargs = {}
+    if batch_size is not None:
+        kwargs["batch_size"] = batch_size
+    if storage is not None:
+        kwargs["storage"] = storage
+
+    def ingest(file_paths):
+        entries, failures = prepare_database.add_files(collection, directory, file_paths, **kwargs)
+        for entry in entries:
+            print(f"New scan added: {entry['file_path']}", flush=True)
+        for file_path, reason in failures:
+            print(f"{file_path} not added to database: {reason}", file=sys.stderr, flush=True)
+
+    known = [item["file_path"] for item in collection.find({}, {"file_path": 1})]
+    thread = watcher.Watcher(directory, ingest, known, use_inotify=use_inotify)
+    thread.start()
+    print(f"Watching {directory} for new scans, press Ctrl+C to stop.", flush=True)
+    try:
+        while thread.is_alive():
+            thread.join(1.0)
+    except KeyboardInterrupt:
+        thread.stop()
+        thread.join()
+
+
+def migrate(collection, compression):
+    '''
+    Re-encodes pickled pixel data in the compact format, printing how much smaller it got, then fills in missing
+    intensity statistics
+    :param collection: the database collection
+    :param compression: one of array_codec.COMPRESSIONS, or "auto" to choose per scan
+    :return: the number of entries whose statistics could not be computed, as an integer
+    '''
+    import catalog_query
+    import data_store
+
+    start = time.perf_counter()
+    migrated, size_before, size_after = data_store.migrate_embedded(collection, compression)
+    saved = f", {size_before / 2 ** 20:.1f} MB to {size_after / 2 ** 20:.1f} MB" if migrated else ""
+    print(f"Migrated {migrated} entries{saved} in {time.perf_counter() - start:.1f} s.")
+
+    start = time.perf_counter()
+    updated, failures = data_store.backfill_intensity(collection)
+    catalog_query.ensure_indexes(collection)
+    for file_path, reason in failures:
+        print(f"{file_path} has no intensity statistics: {reason}", file=sys.stderr)
+    print(f"Computed intensity statistics of {updated} entries in {time.perf_counter() - start:.1f} s.")
+    return len(failures)
+
+
+def query(collection, filters, output_format, output, limit):
+    '''
+    Writes the files matching filters as JSON or CSV, streaming them from the database
+    :param collection: the database collection
+    :param filters: the filter values, as keyword arguments of catalog_query.build_query
+    :param output_format: "json" or "csv"
+    :param output: the file to write to, as an open text file
+    :param limit: the most files to write, as an integer, 0 for no limit
+    '''
+    import catalog_query
+
+    projection = {field: 1 for field in catalog_query.FIELDS}
+    projection["_id"] = 0
+    cursor = collection.find(catalog_query.build_query(**filters), projection).limit(limit)
+
+    if output_format == "csv":
+        writer = csv.DictWriter(output, fieldnames=catalog_query.FIELDS, extrasaction="ignore")
+        writer.writeheader()
+        for item in cursor:
+            writer.writerow(item)
+    else:
+        # one entry per line inside the array, without holding the result in memory
+        output.write("[")
+        for index, item in enumerate(cursor):
+            output.write(("," if index else "") + "\n  " + json.dumps(item))
+        output.write("\n]\n")
+
+
+def export(collection, uri, filters, directory, formats, workers, progress):
+    '''
+    Exports the files matching filters, printing progress, a summary and any failures
+    :param collection: the database collection
+    :param uri: the database URI, as a string
+    :param filters: the filter values, as keyword arguments of catalog_query.build_query
+    :param directory: the directory to write to, as a string
+    :param formats: the formats to write, as a list of batch_export.FORMATS
+    :param workers: the number of worker processes, as an integer
+    :param progress: whether to print progress, as a boolean
+    :return: the number of files that could not be exported, as an integer
+    '''
+    import batch_export
+    import catalog_query
+
+    start = time.perf_counter()
+    exported, failures = batch_export.export(collection, uri, catalog_query.build_query(**filters), directory,
+                                             formats, workers, progress_callback=PrintExportProgress() if progress else None)
+    for file_path, reason in failures:
+        print(f"{file_path} not exported: {reason}", file=sys.stderr)
+    print(f"Exported {exported} files to {directory}, {len(failures)} failed, "
+          f"{time.perf_counter() - start:.1f} s.")
+    return len(failures)
+
+
+def main(args):
+    if not args or args[0] in ("-h", "--help"):
+        print(USAGE)
+        sys.exit()
+
+    command = args[0]
+    if command not in ("build", "sync", "watch", "migrate", "query", "export"):
+        print(f"Unknown command {command}")
+        raise SystemExit(USAGE)
+
+    try:
+        options, arguments = getopt.getopt(
+            args[1:],
+            "hu:pd:w:b:m:s:f:o:l:",
+            ["help", "uri=", "progress", "directory=", "workers=", "batch-size=", "storage=", "hash", "report=", "poll", "compression=",
+             "formats=", "scan-type=", "start=", "end=", "xres=", "yres=", "xrange=", "yrange=", "emin=", "emax=", "peak-min=", "peak-max=", "format=",
+             "output=", "limit="])
+    except getopt.GetoptError as err:
+        print(err)
+        raise SystemExit(USAGE)
+
+    if arguments:
+        raise SystemExit(USAGE)
+
+    uri = catalog.URI
+    progress = False
+    directory = ""
+    workers = None
+    batch_size = None
+    storage = None
+    use_hash = False
+    report = ""
+    use_inotify = True
+    compression = "auto"
+    formats = ["npz"]
+    filters = {}
+    output_format = "json"
+    output = ""
+    limit = 0
+    try:
+        for o, a in options:
+            if o in ("-h", "--help"):
+                print(USAGE)
+                sys.exit()
+            if o in ("-u", "--uri"):
+                uri = a
+            if o in ("-p", "--progress"):
+                progress = True
+            if o in ("-d", "--directory"):
+                directory = a
+            if o in ("-w", "--workers"):
+                workers = int(a)
+                if workers <= 0:
+                    workers = os.cpu_count() or 1
+            if o in ("-b", "--batch-size"):
+                batch_size = int(a)
+            if o in ("-m", "--storage"):
+                import data_store
+                if a not in data_store.STORAGE_MODES:
+                    raise ValueError(f"Storage must be one of {', '.join(data_store.STORAGE_MODES)}")
+                storage = a
+            if o == "--hash":
+                use_hash = True
+            if o == "--report":
+                report = a
+            if o == "--poll":
+                use_inotify = False
+            if o == "--compression":
+                compression = a
+            if o == "--formats":
+                formats = a.split(",")
+            if o in ("-s", "--scan-type"):
+                filters["scan_type"] = a
+            if o == "--start":
+                filters["start_time"] = parse_time(a)
+            if o == "--end":
+                filters["end_time"] = parse_time(a, end=True)
+            if o == "--xres":
+                filters["xresolution"] = int(a)
+            if o == "--yres":
+                filters["yresolution"] = int(a)
+            if o == "--xrange":
+                filters["xrange"] = int(a)
+            if o == "--yrange":
+                filters["yrange"] = int(a)
+            if o == "--emin":
+                filters["energy_min"] = int(a)
+            if o == "--emax":
+                filters["energy_max"] = int(a)
+            if o == "--peak-min":
+                filters["peak_min"] = float(a)
+            if o == "--peak-max":
+                filters["peak_max"] = float(a)
+            if o in ("-f", "--format"):
+                if a not in ("json", "csv"):
+                    raise ValueError("Format must be json or csv")
+                output_format = a
+            if o in ("-o", "--output"):
+                output = a
+            if o in ("-l", "--limit"):
+                limit = int(a)
+    except ValueError as err:
+        print(err)
+        raise SystemExit(USAGE)
+
+    try:
+        collection = catalog.open_catalog(uri)
+    except ValueError as err:
+        print(err)
+        raise SystemExit(USAGE)
+
+    if command in ("build", "sync"):
+        if directory == "":
+            print(f"{command} needs a directory")
+            raise SystemExit(USAGE)
+        failed = build(collection, directory, progress, workers or 1, batch_size, storage, command == "sync", use_hash,
+                       report)
+        sys.exit(1 if failed else 0)
+
+    if command == "watch":
+        if directory == "":
+            print("watch needs a directory")
+            raise SystemExit(USAGE)
+        watch(collection, directory, batch_size, storage, use_inotify)
+        return
+
+    if command == "migrate":
+        try:
+            failed = migrate(collection, compression)
+        except ValueError as err:
+            print(err)
+            raise SystemExit(USAGE)
+        sys.exit(1 if failed else 0)
+
+    if command == "export":
+        if output == "":
+            print("export needs an output directory")
+            raise SystemExit(USAGE)
+        try:
+            failed = export(collection, uri, filters, output, formats, workers or os.cpu_count() or 1, progress)
+        except ValueError as err:
+            print(err)
+            raise SystemExit(USAGE)
+        sys.exit(1 if failed else 0)
+
+    if output == "":
+        query(collection, filters, output_format, sys.stdout, limit)
+    else:
+        with open(output, "w", newline="") as f:
+            query(collection, filters, output_format, f, limit)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
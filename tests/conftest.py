@@ -0,0 +1,73 @@
+import os
+import sys
+import uuid
+import numpy as np
+import pytest
+
+# the modules live at the top of the repository rather than in a package
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import catalog
+from benchmarks import synthetic_data
+
+BACKENDS = ["mongomock", "sqlite"]
+# (subdirectory, scan type, resolution, energies, start time) of each scan written
+SCANS = [("", "sample image", 32, 1, "2021-03-01T09:00:00"),
+         ("", "sample image stack", 40, 4, "2021-03-02T10:00:00"),
+         ("", "osa image", 24, 1, "2021-03-03T11:00:00"),
+         ("sub", "sample image", 48, 1, "2021-03-04T12:00:00"),
+         ("sub", "detector image", 32, 1, "2021-03-05T13:00:00")]
+
+
+@pytest.fixture(params=BACKENDS)
+def collection(request, tmp_path):
+    '''
+    An empty catalog of each backend
+    '''
+    if request.param == "sqlite":
+        pytest.importorskip("sqlite3")
+        collection = catalog.open_catalog(f"sqlite://{tmp_path / 'catalog.db'}")
+        yield collection
+        collection.database.close()
+    else:
+        pytest.importorskip("mongomock")
+        # a database of its own, as mongomock clients share their data
+        collection = catalog.open_catalog("mongomock://", database=f"test_{uuid.uuid4().hex}")
+        yield collection
+        collection.database.client.drop_database(collection.database.name)
+
+
+def write_scans(directory, scans=SCANS, seed=0):
+    '''
+    Writes synthetic scans
+    :param directory: the directory to write to, as a pathlib.Path
+    :param scans: the scans, as a list of tuples like SCANS
+    :param seed: the random seed, as an integer
+    :return: the full filepaths of the files written, as a list of strings
+    '''
+    rng = np.random.default_rng(seed)
+    file_paths = []
+    for index, (subdirectory, scan_type, resolution, energies, start) in enumerate(scans):
+        os.makedirs(directory / subdirectory, exist_ok=True)
+        file = str(directory / subdirectory / f"scan_{index:03d}.hdf5")
+        synthetic_data.write_scan(file, rng, scan_type, resolution, energies, start)
+        file_paths.append(file)
+    return file_paths
+
+
+@pytest.fixture
+def scans(tmp_path):
+    '''
+    A directory of synthetic scans, with one subdirectory
+    '''
+    directory = tmp_path / "data"
+    return str(directory), write_scans(directory)
+
+
+class Progress:
+    # stands in for the progress signal of the GUI
+    def __init__(self):
+        self.values = []
+
+    def emit(self, value):
+        self.values.append(value)
@@ -0,0 +1,333 @@
+import os
+import h5py
+import numpy as np
+import bson
+import pytest
+from pymongo.errors import BulkWriteError
+import catalog_query
+import data_store
+import prepare_database
+from bulk_writer import BulkWriter, encoded_size
+from ingest_stats import IngestStats
+from conftest import Progress, SCANS, write_scans
+
+
+def names(cursor):
+    return sorted(item["name"] for item in cursor)
+
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_ingest(collection, scans, workers):
+    directory, file_paths = scans
+    failures = prepare_database.prepare_database(collection, directory, Progress(), workers=workers)
+
+    assert failures == []
+    assert collection.count_documents({}) == len(SCANS)
+    for file in file_paths:
+        entry = collection.find_one({"file_path": file})
+        assert entry["name"] == os.path.basename(file)
+        assert entry["directory"] == directory
+        with h5py.File(file, "r") as f:
+            np.testing.assert_array_equal(data_store.load_data(collection, entry), f[data_store.DATASET][()])
+
+
+def test_ingest_storage_modes(collection, scans):
+    directory, file_paths = scans
+    for storage in data_store.STORAGE_MODES:
+        assert prepare_database.prepare_database(collection, directory, Progress(), storage=storage) == []
+        entry = collection.find_one({"file_path": file_paths[1]}, {"data": 0})
+        assert data_store.storage_of(entry) == storage
+        with h5py.File(file_paths[1], "r") as f:
+            expected = f[data_store.DATASET][()]
+        np.testing.assert_array_equal(data_store.load_data(collection, entry), expected)
+        np.testing.assert_array_equal(data_store.load_frame(collection, entry, 2), expected[2])
+
+
+def test_find_one_lookup(collection, scans):
+    directory, file_paths = scans
+    prepare_database.prepare_database(collection, directory, Progress())
+
+    entry = collection.find_one({"name": "scan_001.hdf5"}, {"data": 0})
+    assert entry["scan_type"] == "sample image stack"
+    assert entry["xresolution"] == 40
+    assert len(entry["energies"]) == 4
+    assert "data" not in entry
+    assert collection.find_one({"name": "missing.hdf5"}) is None
+
+
+def test_sync(collection, scans, tmp_path):
+    directory, file_paths = scans
+    prepare_database.prepare_database(collection, directory, Progress())
+    ids = {item["file_path"]: item["_id"] for item in collection.find({}, {"file_path": 1})}
+
+    # one scan rewritten, one deleted and one added
+    write_scans(tmp_path / "data", [SCANS[0]], seed=1)
+    os.utime(file_paths[0], ns=(0, os.stat(file_paths[0]).st_mtime_ns + 10 ** 9))
+    os.remove(file_paths[2])
+    added = write_scans(tmp_path / "data" / "new", [SCANS[1]])[0]
+
+    failures = prepare_database.sync_database(collection, directory, Progress())
+
+    assert failures == []
+    assert sorted(item["file_path"] for item in collection.find({}, {"file_path": 1})) == \
+        sorted([file_paths[0], file_paths[1], file_paths[3], file_paths[4], added])
+    # unchanged scans keep their entries
+    for file in (file_paths[1], file_paths[3], file_paths[4]):
+        assert collection.find_one({"file_path": file}, {"_id": 1})["_id"] == ids[file]
+    entry = collection.find_one({"file_path": file_paths[0]})
+    assert entry["file_mtime"] == os.stat(file_paths[0]).st_mtime_ns
+    with h5py.File(file_paths[0], "r") as f:
+        np.testing.assert_array_equal(data_store.load_data(collection, entry), f[data_store.DATASET][()])
+
+
+def test_sync_keeps_entries_of_files_that_cannot_be_read(collection, scans):
+    directory, file_paths = scans
+    prepare_database.prepare_database(collection, directory, Progress())
+    old = collection.find_one({"file_path": file_paths[1]})
+
+    with open(file_paths[1], "wb") as f:
+        f.write(b"not an hdf5 file")
+    failures = prepare_database.sync_database(collection, directory, Progress())
+
+    assert [file for file, _ in failures] == [file_paths[1]]
+    entry = collection.find_one({"file_path": file_paths[1]})
+    assert entry["_id"] == old["_id"]
+    np.testing.assert_array_equal(data_store.load_data(collection, entry), data_store.load_data(collection, old))
+    assert collection.count_documents({}) == len(SCANS)
+
+
+def test_sync_copies_with_hash(collection, scans, tmp_path):
+    directory, file_paths = scans
+    prepare_database.prepare_database(collection, directory, Progress())
+
+    copy = str(tmp_path / "data" / "sub" / "copy.hdf5")
+    with open(file_paths[1], "rb") as source, open(copy, "wb") as target:
+        target.write(source.read())
+
+    assert prepare_database.sync_database(collection, directory, Progress(), use_hash=True) == []
+    entry = collection.find_one({"file_path": copy})
+    assert entry["name"] == "copy.hdf5"
+    np.testing.assert_array_equal(data_store.load_data(collection, entry),
+                                  data_store.load_data(collection, collection.find_one({"file_path": file_paths[1]})))
+
+
+def test_sync_reads_only_the_files_that_changed(collection, tmp_path):
+    scans = [(f"run_{index // 10}", "sample image", 24, 1, f"2021-03-{index % 28 + 1:02d}T09:00:00")
+             for index in range(60)]
+    file_paths = write_scans(tmp_path / "data", scans)
+    directory = str(tmp_path / "data")
+    prepare_database.prepare_database(collection, directory, Progress())
+    ids = {item["file_path"]: item["_id"] for item in collection.find({}, {"file_path": 1})}
+
+    changed = file_paths[::10]
+    for file in changed:
+        os.utime(file, ns=(0, os.stat(file).st_mtime_ns + 10 ** 9))
+    stats = IngestStats()
+    assert prepare_database.sync_database(collection, directory, Progress(), stats=stats) == []
+
+    assert (stats.files_done, stats.unchanged) == (len(changed), len(file_paths) - len(changed))
+    assert collection.count_documents({}) == len(file_paths)
+    for file in file_paths:
+        entry = collection.find_one({"file_path": file}, {"file_mtime": 1})
+        assert entry["file_mtime"] == os.stat(file).st_mtime_ns
+        assert (entry["_id"] == ids[file]) == (file not in changed)
+
+
+def test_deleting_entries_keeps_what_copies_still_use(collection, tmp_path):
+    # large enough for a pyramid
+    original, = write_scans(tmp_path / "data", [("", "sample image", 300, 1, "2021-03-01T09:00:00")])
+    prepare_database.prepare_database(collection, str(tmp_path / "data"), Progress(), storage="gridfs")
+    copy = str(tmp_path / "data" / "copy.hdf5")
+    with open(original, "rb") as source, open(copy, "wb") as target:
+        target.write(source.read())
+    prepare_database.sync_database(collection, str(tmp_path / "data"), Progress(), use_hash=True, storage="gridfs")
+    entry = collection.find_one({"file_path": copy})
+    tiles = data_store.tile_store(collection)
+
+    data_store.delete_entries(collection, {"file_path": original})
+    assert data_store.load_data(collection, entry).shape == (1, 300, 300)
+    assert tiles.count_documents({"pyramid_id": entry["pyramid"]["id"]}) > 0
+
+    data_store.delete_entries(collection, {"file_path": copy})
+    assert tiles.count_documents({"pyramid_id": entry["pyramid"]["id"]}) == 0
+    with pytest.raises(Exception):
+        data_store.blob_store(collection).get(entry["data_ref"]["blob_id"]).read()
+
+
+def test_sync_is_a_no_op_when_nothing_changed(collection, scans):
+    directory, _ = scans
+    prepare_database.prepare_database(collection, directory, Progress())
+    before = sorted((item["file_path"], item["_id"]) for item in collection.find({}, {"file_path": 1}))
+
+    progress = Progress()
+    assert prepare_database.sync_database(collection, directory, progress) == []
+    assert progress.values == [100]
+    assert sorted((item["file_path"], item["_id"]) for item in collection.find({}, {"file_path": 1})) == before
+
+
+@pytest.mark.parametrize("filters, expected", [
+    ({}, ["scan_000.hdf5", "scan_001.hdf5", "scan_002.hdf5", "scan_003.hdf5", "scan_004.hdf5"]),
+    ({"scan_type": "sample image"}, ["scan_000.hdf5", "scan_003.hdf5"]),
+    ({"xresolution": 32}, ["scan_000.hdf5", "scan_004.hdf5"]),
+    ({"xresolution": 32, "yresolution": 32, "scan_type": "detector image"}, ["scan_004.hdf5"]),
+    ({"start_time": 202103030000}, ["scan_002.hdf5", "scan_003.hdf5", "scan_004.hdf5"]),
+    ({"end_time": 202103021200}, ["scan_000.hdf5", "scan_001.hdf5"]),
+    ({"start_time": 202103020000, "end_time": 202103041300}, ["scan_001.hdf5", "scan_002.hdf5", "scan_003.hdf5"]),
+    ({"scan_type": "osa focus"}, []),
+])
+def test_query_filters(collection, scans, filters, expected):
+    directory, _ = scans
+    prepare_database.prepare_database(collection, directory, Progress())
+    catalog_query.ensure_indexes(collection)
+
+    query = catalog_query.build_query(**filters)
+    assert names(collection.find(query, {"name": 1})) == expected
+    assert collection.count_documents(query) == len(expected)
+
+
+def test_query_ranges_match_entries(collection, scans):
+    directory, _ = scans
+    prepare_database.prepare_database(collection, directory, Progress())
+    catalog_query.ensure_indexes(collection)
+    entries = list(collection.find({}, {"data": 0}))
+
+    for field, low, high in (("energy_min", "energy_min", None), ("xrange", None, None),
+                             ("intensity_max", "peak_min", "peak_max")):
+        values = sorted(entry[field] for entry in entries)
+        middle = values[len(values) // 2]
+        if low is None:
+            filters = {field: middle}
+            expected = [entry["name"] for entry in entries if entry[field] == middle]
+        else:
+            filters = {low: middle}
+            if high is not None:
+                filters[high] = values[-1]
+            expected = [entry["name"] for entry in entries if middle <= entry[field] <= values[-1]]
+        assert names(collection.find(catalog_query.build_query(**filters))) == sorted(expected)
+
+    energy_max = max(entry["energy_max"] for entry in entries) - 1
+    assert names(collection.find(catalog_query.build_query(energy_max=energy_max))) == \
+        sorted(entry["name"] for entry in entries if entry["energy_max"] <= energy_max)
+
+
+@pytest.mark.parametrize("indexed", [False, True])
+def test_collection_api(collection, indexed):
+    documents = [{"name": f"file_{index}", "group": index % 3, "size": index * 10, "meta": {"kind": "a" if index < 4
+                  else "b", "note": "x"}} for index in range(10)]
+    collection.insert_many(documents, ordered=False)
+    assert all("_id" in document for document in documents)
+    if indexed:
+        collection.create_index([("group", 1), ("size", 1)])
+        collection.create_index("meta.kind")
+
+    # filters, on indexed columns or checked on documents
+    assert collection.count_documents({"group": 1}) == 3
+    assert names(collection.find({"size": {"$gte": 30, "$lt": 70}})) == ["file_3", "file_4", "file_5", "file_6"]
+    assert names(collection.find({"group": {"$in": [0, 2]}, "meta.kind": "a"})) == ["file_0", "file_2", "file_3"]
+    assert names(collection.find({"group": {"$ne": 0}, "size": {"$lte": 20}})) == ["file_1", "file_2"]
+    assert collection.count_documents({"group": 0}, limit=2) == 2
+
+    # sort, skip and limit
+    ordered = [item["name"] for item in collection.find({}, {"name": 1}).sort("size", -1).skip(2).limit(3)]
+    assert ordered == ["file_7", "file_6", "file_5"]
+    ordered = [item["size"] for item in collection.find({"meta.kind": "b"}).sort([("group", 1), ("size", -1)])]
+    assert ordered == [90, 60, 70, 40, 80, 50]
+
+    # projections
+    item = collection.find_one({"name": "file_4"}, {"name": 1, "meta.kind": 1, "_id": 0})
+    assert item == {"name": "file_4", "meta": {"kind": "b"}}
+    item = collection.find_one({"name": "file_4"}, {"meta.note": 0, "size": 0})
+    assert set(item) == {"_id", "name", "group", "meta"} and item["meta"] == {"kind": "b"}
+
+    # updates and deletes
+    result = collection.update_one({"name": "file_4"}, {"$set": {"size": 400, "meta.note": "y"}})
+    assert result.matched_count == 1
+    item = collection.find_one({"name": "file_4"})
+    assert item["size"] == 400 and item["meta"] == {"kind": "b", "note": "y"}
+    assert collection.find_one({"size": 400})["name"] == "file_4"
+    assert collection.update_one({"name": "missing"}, {"$set": {"size": 1}}).matched_count == 0
+    assert collection.delete_many({"group": 2}).deleted_count == 3
+    assert collection.count_documents({}) == 7
+    assert collection.delete_many({"meta.kind": "a"}).deleted_count == 3
+    assert names(collection.find()) == ["file_4", "file_6", "file_7", "file_9"]
+
+
+def test_unordered_insert_keeps_the_other_documents(collection):
+    collection.insert_one({"_id": 5, "name": "existing"})
+    batch = [{"_id": 1, "name": "first"}, {"_id": 5, "name": "duplicate"}, {"_id": 7, "name": "last"}]
+
+    with pytest.raises(BulkWriteError) as error:
+        collection.insert_many(batch, ordered=False)
+
+    details = error.value.details
+    assert details["nInserted"] == 2
+    assert [write_error["index"] for write_error in details["writeErrors"]] == [1]
+    assert names(collection.find()) == ["existing", "first", "last"]
+
+
+def test_ordered_insert_stops_at_the_first_failure(collection):
+    collection.insert_one({"_id": 5, "name": "existing"})
+
+    with pytest.raises(BulkWriteError) as error:
+        collection.insert_many([{"_id": 1, "name": "first"}, {"_id": 5, "name": "duplicate"},
+                                {"_id": 7, "name": "last"}], ordered=True)
+
+    assert error.value.details["nInserted"] == 1
+    assert names(collection.find()) == ["existing", "first"]
+
+
+def test_bulk_writer_reports_only_failing_documents(collection):
+    collection.insert_one({"_id": 3, "name": "existing", "file_path": "existing.hdf5"})
+
+    with BulkWriter(collection, batch_size=10) as writer:
+        for index in range(5):
+            writer.insert({"_id": index + 1, "name": f"file_{index}", "file_path": f"file_{index}.hdf5"})
+
+    assert writer.inserted == 4
+    assert [file_path for file_path, _ in writer.failures] == ["file_2.hdf5"]
+    assert collection.count_documents({}) == 5
+
+
+def test_encoded_size_matches_bson(scans):
+    directory, file_paths = scans
+    for file in file_paths:
+        entry, _ = prepare_database.read_file(file)
+        for tile in entry.pop("_tiles", []):
+            assert encoded_size(tile) == len(bson.encode(tile))
+        assert encoded_size(entry) == len(bson.encode(entry))
+
+
+def test_blob_store(collection):
+    store = data_store.blob_store(collection)
+    payload = bytes(range(256)) * 1000
+    blob_id = store.put(payload, filename="scan.hdf5")
+
+    blob = store.get(blob_id)
+    assert blob.read() == payload
+    blob = store.get(blob_id)
+    blob.seek(1000)
+    assert blob.read(300) == payload[1000:1300]
+    assert blob.read(100) == payload[1300:1400]
+
+    store.delete(blob_id)
+    with pytest.raises(Exception):
+        store.get(blob_id).read()
+
+
+def test_ingest_point_spectrum(collection, scans):
+    directory, file_paths = scans
+    spectrum = os.path.join(directory, "point.hdf5")
+    with h5py.File(spectrum, "w") as f:
+        counter = f.create_group("entry0/counter0")
+        counter["data"] = np.arange(20, dtype=np.float32)
+        counter["stxm_scan_type"] = np.bytes_("sample point spectrum")
+        counter["sample_x"] = np.array([1.0])
+        counter["sample_y"] = np.array([2.0])
+        counter["energy"] = np.linspace(700.0, 720.0, 20)
+        f["entry0/start_time"] = np.bytes_("2021-03-06T09:00:00")
+        f["entry0/end_time"] = np.bytes_("2021-03-06T09:59:59")
+
+    assert prepare_database.prepare_database(collection, directory, Progress()) == []
+    entry = collection.find_one({"name": "point.hdf5"})
+    assert "thumbnail" not in entry and "pyramid" not in entry
+    np.testing.assert_array_equal(data_store.load_data(collection, entry), np.arange(20, dtype=np.float32))
@@ -0,0 +1,53 @@
+import sqlite3
+import bson
+import catalog
+import prepare_database
+import sqlite_catalog
+from conftest import Progress
+
+
+def test_metadata_reads_leave_pixel_data_alone(scans, tmp_path):
+    directory, file_paths = scans
+    collection = catalog.open_catalog(f"sqlite://{tmp_path / 'catalog.db'}")
+    prepare_database.prepare_database(collection, directory, Progress())
+    # anything that decodes the pixel data or thumbnails now fails
+    collection.database.execute(f"UPDATE {collection.table} SET _data = x'00', _thumbnail = x'00'")
+
+    assert len(list(collection.find({}, {"file_path": 1, "file_size": 1, "file_mtime": 1, "file_hash": 1}))) == 5
+    assert collection.find_one({"name": "scan_001.hdf5"}, {"data": 0, "thumbnail": 0})["xresolution"] == 40
+    assert collection.count_documents({"scan_type": "sample image", "file_size": {"$gt": 0}}) == 2
+    assert prepare_database.sync_database(collection, directory, Progress()) == []
+    collection.database.close()
+
+
+def test_cursors_fetch_rows_as_they_are_used(tmp_path, monkeypatch):
+    monkeypatch.setattr(sqlite_catalog, "FETCH_SIZE", 2)
+    collection = catalog.open_catalog(f"sqlite://{tmp_path / 'catalog.db'}")
+    collection.insert_many([{"name": f"file_{index}"} for index in range(5)])
+
+    cursor = iter(collection.find({}, {"name": 1}))
+    assert next(cursor)["name"] == "file_0"
+    # the connection stays usable while a cursor is open
+    collection.insert_one({"name": "file_5"})
+    assert collection.count_documents({}) == 6
+    assert [item["name"] for item in cursor][:4] == ["file_1", "file_2", "file_3", "file_4"]
+    collection.database.close()
+
+
+def test_catalogs_of_earlier_versions_are_upgraded(tmp_path):
+    path = tmp_path / "catalog.db"
+    connection = sqlite3.connect(path)
+    connection.execute('CREATE TABLE "STXM_data" (_id INTEGER PRIMARY KEY, doc BLOB NOT NULL, "name")')
+    connection.execute('INSERT INTO "STXM_data" VALUES (1, ?, ?)',
+                       [bson.encode({"name": "a.hdf5", "file_size": 3, "data": b"pixels", "thumbnail": b"t"}),
+                        "a.hdf5"])
+    connection.commit()
+    connection.close()
+
+    collection = catalog.open_catalog(f"sqlite://{path}", collection="STXM_data")
+    assert collection.find_one({"name": "a.hdf5"}) == {"_id": 1, "name": "a.hdf5", "file_size": 3,
+                                                       "data": b"pixels", "thumbnail": b"t"}
+    doc, = collection.database.execute('SELECT doc FROM "STXM_data"')[0]
+    assert bson.decode(doc) == {"name": "a.hdf5", "file_size": 3}
+    assert collection.find_one({}, {"data": 0, "thumbnail": 0}) == {"_id": 1, "name": "a.hdf5", "file_size": 3}
+    collection.database.close()
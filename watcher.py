@@ -0,0 +1,226 @@
+import os
+import threading
+import time
+import h5py
+import file_discovery
+
+# seconds between checks of files still being written, and between directory scans when polling
+TICK = 0.5
+POLL_INTERVAL = 2.0
+# seconds a file's size and modification time must stay the same before it counts as fully written
+SETTLE_TIME = 2.0
+
+
+def is_complete(file):
+    '''
+    Checks that an HDF5 file can be opened, i.e. its writer has finished with it and released its lock
+    :param file: the full filepath of the file, as a string
+    :return: whether the file opens, as a boolean
+    '''
+    try:
+        with h5py.File(file, "r"):
+            return True
+    except Exception as e:
+        return False
+
+
+class Watcher(threading.Thread):
+    def __init__(self, directory, on_ready, known=(), settle_time=SETTLE_TIME, poll_interval=POLL_INTERVAL,
+                 use_inotify=True):
+        '''
+        Watches a directory tree for new or rewritten HDF5 files, reporting each once it has been fully written.
+        Uses inotify on Linux when the optional inotify_simple package is installed, and otherwise polls, rescanning
+        only the directories whose modification time changed, and comparing the size and modification time of each
+        file to catch files rewritten in place, so each poll costs one stat per directory and per file.
+        :param directory: the root directory, as a string
+        :param on_ready: called from the watcher thread with the full filepaths of files ready to be read, as a list
+        of strings
+        :param known: the files already in the database, as a collection of strings. Files found at the start that
+        are not known are reported once they are complete.
+        :param settle_time: the seconds a file must stay unchanged before it is reported, as a float
+        :param poll_interval: the seconds between directory scans when polling, as a float
+        :param use_inotify: whether to use inotify when available, as a boolean. Network file systems need polling.
+        '''
+        super(Watcher, self).__init__(daemon=True)
+        self.directory = directory
+        self.on_ready = on_ready
+        self.known = set(known)
+        self.settle_time = settle_time
+        self.poll_interval = poll_interval
+        self.use_inotify = use_inotify
+        self.stopped = threading.Event()
+
+        # files seen so far, and files waiting to settle with their last signature and when it changed
+        self.seen = set()
+        self.pending = {}
+        # size and modification time of each file seen when polling, as of the last poll
+        self.signatures = {}
+        self.mode = None
+
+    def stop(self):
+        self.stopped.set()
+
+    def run(self):
+        inotify_simple = None
+        if self.use_inotify:
+            try:
+                import inotify_simple
+            except ImportError as e:
+                pass
+
+        if inotify_simple is not None:
+            try:
+                self.mode = "inotify"
+                self.watch_inotify(inotify_simple)
+                return
+            except OSError as e:
+                # e.g. out of watches, fall back to polling
+                pass
+        self.mode = "polling"
+        self.watch_polling()
+
+    def found(self, file, initial=False):
+        '''
+        Starts waiting for a file to settle
+        :param file: the full filepath of the file, as a string
+        :param initial: whether the file was there when watching started, as a boolean
+        '''
+        if initial and file in self.known:
+            return
+        self.pending[file] = (None, time.monotonic())
+
+    def check_pending(self):
+        '''
+        Reports the pending files that have stopped changing and can be opened
+        '''
+        now = time.monotonic()
+        ready = []
+        for file, (signature, since) in list(self.pending.items()):
+            try:
+                stat = os.stat(file)
+            except OSError as e:
+                # deleted or renamed before it was complete
+                del self.pending[file]
+                continue
+
+            current = (stat.st_size, stat.st_mtime_ns)
+            if current != signature:
+                self.pending[file] = (current, now)
+            elif now - since >= self.settle_time and is_complete(file):
+                del self.pending[file]
+                ready.append(file)
+
+        if ready:
+            self.on_ready(ready)
+
+    def watch_polling(self):
+        '''
+        Polls the modification times of the directories, rescanning those that changed, and the signatures of the
+        files
+        '''
+        directories = {}
+        self.scan_tree(self.directory, directories, initial=True)
+
+        # rescanned once more after a change, in case files landed within the file system's time resolution
+        recent = set()
+        last_poll = time.monotonic()
+        while not self.stopped.wait(TICK):
+            if time.monotonic() - last_poll >= self.poll_interval:
+                last_poll = time.monotonic()
+                changed = set()
+                for directory, mtime in list(directories.items()):
+                    try:
+                        current = os.stat(directory).st_mtime_ns
+                    except OSError as e:
+                        del directories[directory]
+                        continue
+                    if current != mtime:
+                        directories[directory] = current
+                        changed.add(directory)
+                for directory in changed | recent:
+                    if directory in directories:
+                        self.scan_tree(directory, directories)
+                recent = changed
+                self.check_rewritten()
+            self.check_pending()
+
+    def check_rewritten(self):
+        '''
+        Waits again for files written to since the last poll, which leaves the modification time of their directory
+        as it was, and forgets deleted files so they are found again if they come back
+        '''
+        for file, signature in list(self.signatures.items()):
+            try:
+                stat = os.stat(file)
+            except OSError as e:
+                del self.signatures[file]
+                self.seen.discard(file)
+                continue
+
+            current = (stat.st_size, stat.st_mtime_ns)
+            if current != signature:
+                self.signatures[file] = current
+                if file not in self.pending:
+                    self.found(file)
+
+    def scan_tree(self, root, directories, initial=False):
+        '''
+        Lists a directory and any subdirectories not seen before, noting new files
+        :param root: the directory, as a string
+        :param directories: the modification time of each directory watched, as a dictionary, updated in place
+        :param initial: whether this is the scan made when watching starts, as a boolean
+        '''
+        stack = [root]
+        while stack:
+            directory = stack.pop()
+            try:
+                directories[directory] = os.stat(directory).st_mtime_ns
+            except OSError as e:
+                continue
+            subdirectories, files = file_discovery.scan_directory(directory)
+            stack.extend(subdirectory for subdirectory in subdirectories if subdirectory not in directories)
+            for file, size in files:
+                if file not in self.seen:
+                    try:
+                        stat = os.stat(file)
+                    except OSError as e:
+                        continue
+                    self.seen.add(file)
+                    self.signatures[file] = (stat.st_size, stat.st_mtime_ns)
+                    self.found(file, initial)
+
+    def watch_inotify(self, inotify_simple):
+        '''
+        Waits for file system events on every directory of the tree
+        :param inotify_simple: the inotify_simple module
+        '''
+        flags = inotify_simple.flags
+        mask = flags.CREATE | flags.MODIFY | flags.CLOSE_WRITE | flags.MOVED_TO
+        with inotify_simple.INotify() as inotify:
+            watches = {}
+
+            def add_tree(root, initial):
+                stack = [root]
+                while stack:
+                    directory = stack.pop()
+                    # watch before listing, so nothing created in between is missed
+                    watches[inotify.add_watch(directory, mask)] = directory
+                    subdirectories, files = file_discovery.scan_directory(directory)
+                    stack.extend(subdirectories)
+                    for file, size in files:
+                        self.seen.add(file)
+                        self.found(file, initial)
+
+            add_tree(self.directory, True)
+            while not self.stopped.is_set():
+                for event in inotify.read(timeout=int(TICK * 1000)):
+                    if event.wd not in watches or not event.name:
+                        continue
+                    path = os.path.join(watches[event.wd], event.name)
+                    if event.mask & flags.ISDIR:
+                        if event.mask & (flags.CREATE | flags.MOVED_TO):
+                            add_tree(path, False)
+                    elif event.name.endswith(".hdf5"):
+                        # written to again, wait for it to settle from now
+                        self.found(path)
+                self.check_pending()